@@ -5,10 +5,16 @@ from gi.repository import Gst, GstApp, GLib
 import pygame
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
+import json
 import os
 import threading
 import numpy as np
 import time
+from collections import deque
+from payload_codec import decode_payload
+import ringlog
+
+log = ringlog.get_logger('camera')
 
 # Global variables
 VIDEO_PORT = 5000
@@ -20,6 +26,12 @@ MQTT_TOPIC_TEMP = "sensors/sens_temp"
 MQTT_TOPIC_HUMID = "sensors/sens_humid"
 MQTT_TOPIC_PHOTO = "sensors/sens_photo"
 MQTT_TOPIC_DIST = "sensors/sens_range"
+MQTT_TOPIC_ALL = "sensors/all"
+MQTT_TOPIC_SNAPSHOT = "sensors/snapshot"
+# Retained joystick latency summary of mqtt_send_rpi2.py (latency_probe.py)
+MQTT_TOPIC_LATENCY = "joystick/latency"
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 60
 
 # Pygame Setup
 os.environ['SDL_FBDEV'] = '/dev/fb1'
@@ -35,17 +47,87 @@ sensor_data = {
     "distance": "N/A"
 }
 data_lock = threading.Lock()
+# Capture time of the values shown, so an older snapshot never overwrites them
+sensor_data_ts = 0.0
+
+
+class FrameAgeTracker:
+    """Age and gap statistics of the frames on the sensors/all topic
+
+    The payload carries the Motor Pi's frame capture time and a sequence
+    number of the published messages (frames without changes are not
+    published, so only pub_seq gaps are lost messages). Ages assume both
+    Pis keep their clocks in sync (NTP).
+    """
+
+    def __init__(self, window=500):
+        self.ages = deque(maxlen=window)
+        self.last_seq = None
+        self.gaps = 0
+        self.last_age = None
+
+    def update(self, seq, captured_at):
+        self.last_age = time.time() - captured_at
+        self.ages.append(self.last_age)
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.gaps += seq - self.last_seq - 1
+        self.last_seq = seq
+
+    def percentile(self, p):
+        if not self.ages:
+            return None
+        ages = sorted(self.ages)
+        return ages[min(len(ages) - 1, int(len(ages) * p / 100))]
+
+
+frame_ages = FrameAgeTracker()
+
+# Newest latency probe report, None until the first one arrives
+latency_report = None
 
 # MQTT Client Setup
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
-        print("MQTT: Connected to Broker!")
-        client.subscribe([(MQTT_TOPIC_TEMP, 0), (MQTT_TOPIC_PHOTO, 0), (MQTT_TOPIC_HUMID, 0), (MQTT_TOPIC_DIST, 0)])
+        log.info("MQTT: Connected to Broker!")
+        client.subscribe([(MQTT_TOPIC_TEMP, 0), (MQTT_TOPIC_PHOTO, 0), (MQTT_TOPIC_HUMID, 0), (MQTT_TOPIC_DIST, 0),
+                          (MQTT_TOPIC_ALL, 0), (MQTT_TOPIC_SNAPSHOT, 0), (MQTT_TOPIC_LATENCY, 0)])
     else:
-        print(f"MQTT: Failed to connect, return code {rc}")
+        log.error("MQTT: Failed to connect, return code %s", rc)
 
 def on_message(client, userdata, msg):
-    global sensor_data
+    global sensor_data, sensor_data_ts, latency_report
+    if msg.topic == MQTT_TOPIC_LATENCY:
+        try:
+            report = json.loads(msg.payload)
+        except ValueError as e:
+            log.rate_limited(1.0, ringlog.WARNING, "MQTT: Invalid latency report: %s", e)
+            return
+        with data_lock:
+            latency_report = report
+        return
+
+    if msg.topic in (MQTT_TOPIC_ALL, MQTT_TOPIC_SNAPSHOT):
+        # Compact binary (or legacy JSON) payload with all values at once.
+        # The retained snapshot arrives right after subscribing, so the
+        # display is filled without waiting for the next publish.
+        try:
+            values = decode_payload(msg.payload)
+        except ValueError as e:
+            log.rate_limited(1.0, ringlog.WARNING, "MQTT: Invalid payload on %s: %s", msg.topic, e)
+            return
+        with data_lock:
+            if msg.topic == MQTT_TOPIC_SNAPSHOT:
+                if values.get('ts', 0) < sensor_data_ts:
+                    return
+            elif 'pub_seq' in values and 'ts' in values:
+                frame_ages.update(values['pub_seq'], values['ts'])
+            sensor_data_ts = values.get('ts', sensor_data_ts)
+            for key, name in (('sens_temp', 'temperature'), ('sens_humid', 'humidity'),
+                              ('sens_photo', 'photo'), ('sens_range', 'distance')):
+                if key in values:
+                    sensor_data[name] = str(values[key])
+        return
+
     payload = msg.payload.decode()
     with data_lock:
         if msg.topic == MQTT_TOPIC_TEMP:
@@ -60,16 +142,21 @@ def on_message(client, userdata, msg):
 mqtt_client = mqtt.Client(client_id="ScreenPiSubscriber", callback_api_version=CallbackAPIVersion.VERSION1)
 mqtt_client.on_connect = on_connect
 mqtt_client.on_message = on_message
+# loop_forever() reconnects on its own with this backoff once connected
+mqtt_client.reconnect_delay_set(MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY)
 
 def mqtt_thread_func():
+    delay = MQTT_RECONNECT_MIN_DELAY
     while True:
         try:
-            print("Attempting MQTT connection...")
+            log.info("Attempting MQTT connection...")
             mqtt_client.connect(MQTT_BROKER_IP, MQTT_PORT, 60)
+            delay = MQTT_RECONNECT_MIN_DELAY
             mqtt_client.loop_forever()
         except Exception as e:
-            print(f"MQTT connection error: {e}. Retrying in 5s...")
-            time.sleep(5)
+            log.error("MQTT connection error: %s. Retrying in %ss...", e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
 
 # GStreamer Frame Handling
 gst_frame = None
@@ -105,21 +192,22 @@ def on_new_sample(appsink):
                         # Convert to Pygame surface (swap axes for width/height)
                         gst_frame = pygame.surfarray.make_surface(frame_data.swapaxes(0, 1))
                 else:
-                    print(f"Buffer size mismatch: got {len(map_info.data)}, expected {expected_size}")
+                    log.rate_limited(1.0, ringlog.WARNING, "Buffer size mismatch: got %d, expected %d",
+                                     len(map_info.data), expected_size)
 
             except Exception as e:
-                print(f"Error processing frame: {e}")
+                log.rate_limited(1.0, ringlog.ERROR, "Error processing frame: %s", e)
             finally:
                 buf.unmap(map_info)
         else:
-            print("Failed to map buffer")
+            log.rate_limited(1.0, ringlog.WARNING, "Failed to map buffer")
     else:
-        print("No sample received")
+        log.rate_limited(1.0, ringlog.WARNING, "No sample received")
 
     return Gst.FlowReturn.OK
 
 # GStreamer Pipeline
-print("Initializing GStreamer...")
+log.info("Initializing GStreamer...")
 Gst.init(None)
 
 gst_pipeline_str = (
@@ -137,14 +225,15 @@ appsink.connect('new-sample', on_new_sample)
 
 # Main Loop
 if __name__ == "__main__":
-    print("Starting MQTT thread...")
+    log.info("Starting MQTT thread...")
     mqtt_thread = threading.Thread(target=mqtt_thread_func, daemon=True)
     mqtt_thread.start()
 
-    print("Starting GStreamer pipeline...")
+    log.info("Starting GStreamer pipeline...")
     ret = pipeline.set_state(Gst.State.PLAYING)
     if ret == Gst.StateChangeReturn.FAILURE:
-        print("ERROR: Failed to start GStreamer pipeline!")
+        log.error("Failed to start GStreamer pipeline!")
+        ringlog.flush()
         exit(1)
 
     running = True
@@ -173,22 +262,40 @@ if __name__ == "__main__":
                 hum_text = font.render(f"Hum: {sensor_data['humidity']} %", True, (0, 255, 255))
                 photo_text = font.render(f"Photo: {sensor_data['photo']} lm", True, (255, 255, 255))
                 dist_text = font.render(f"Dist: {sensor_data['distance']} mm", True, (255, 0, 255))
+                if frame_ages.last_age is not None:
+                    age_text = small_font.render(
+                        f"Age {frame_ages.last_age * 1000:.0f} ms  p50 {frame_ages.percentile(50) * 1000:.0f}"
+                        f"  p99 {frame_ages.percentile(99) * 1000:.0f}  gaps {frame_ages.gaps}",
+                        True, (255, 255, 255))
+                else:
+                    age_text = small_font.render("Age N/A", True, (255, 255, 255))
+                round_trip = latency_report['round_trip'] if latency_report else {}
+                if round_trip.get('count'):
+                    latency_text = small_font.render(
+                        f"RTT p50 {round_trip['p50_ms']:.0f}  p99 {round_trip['p99_ms']:.0f} ms"
+                        f"  1-way p50 {latency_report['one_way']['p50_ms']:.0f} ms  lost {latency_report['lost']}",
+                        True, (255, 255, 255))
+                else:
+                    latency_text = small_font.render("RTT N/A", True, (255, 255, 255))
 
             screen.blit(temp_text, (5, 5))
             screen.blit(hum_text, (5, 35))
             screen.blit(photo_text, (5, 65))
             screen.blit(dist_text, (5, 95))
+            screen.blit(age_text, (5, 125))
+            screen.blit(latency_text, (5, 145))
 
             pygame.display.flip()
             clock.tick(30)
 
     except KeyboardInterrupt:
-        print("Stopping Screen Receiver...")
+        log.info("Stopping Screen Receiver...")
     finally:
-        print("Cleaning up...")
+        log.info("Cleaning up...")
         pipeline.set_state(Gst.State.NULL)
         if mqtt_client.is_connected():
             mqtt_client.loop_stop()
             mqtt_client.disconnect()
         pygame.quit()
-        print("Screen Receiver cleanup complete.")
+        log.info("Screen Receiver cleanup complete.")
+        ringlog.flush()
@@ -0,0 +1,123 @@
+import threading
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+import ringlog
+from publish_queue import BoundedPublisher, DROP_OLDEST
+
+log = ringlog.get_logger('mqtt')
+
+
+def _make_client(client_id, protocol):
+    # paho 2.x needs the callback version, 1.x does not know the argument
+    if hasattr(mqtt, 'CallbackAPIVersion'):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, protocol=protocol)
+    return mqtt.Client(client_id=client_id, protocol=protocol)
+
+
+class MqttConnection:
+    """The one broker connection of a process
+
+    Subscribers register their topics with ``subscribe`` and are
+    resubscribed after every reconnect; everything is published through
+    ``publisher``, a BoundedPublisher on top of this connection. Extra
+    on_connect callbacks go into ``connect_handlers``.
+
+    With use_v5 the connection speaks MQTT 5: QoS 0 messages use topic
+    aliases, so a topic string is only sent once per connection (up to the
+    broker's Topic Alias Maximum), and topics in message_expiry get a
+    message expiry interval in seconds, so the broker discards them instead
+    of delivering them late.
+    """
+
+    def __init__(self, client_id, use_v5=False, message_expiry=None, min_delay=1, max_delay=60,
+                 queue_size=64, drop_policy=DROP_OLDEST):
+        self.use_v5 = use_v5
+        self.message_expiry = dict(message_expiry or {})
+        self.client = _make_client(client_id, mqtt.MQTTv5 if use_v5 else mqtt.MQTTv311)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay, max_delay)
+
+        self.connect_handlers = []
+        self._subscriptions = {}
+        self._aliases = {}
+        self._alias_maximum = 0
+        self._alias_lock = threading.Lock()
+
+        self.publisher = BoundedPublisher(self, max_queued=queue_size, policy=drop_policy)
+        self.client.on_publish = self.publisher.on_publish
+
+    def connect(self, host, port=1883, keepalive=60, start_loop=True):
+        """Connect in the background, paho retries with backoff until it succeeds
+
+        start_loop=False leaves driving the client to the caller, e.g. an
+        asyncio adapter.
+        """
+        self.client.connect_async(host, port, keepalive)
+        if start_loop:
+            self.client.loop_start()
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def subscribe(self, topic, qos, callback):
+        """Deliver messages on topic to callback(client, userdata, msg)"""
+        self._subscriptions[topic] = qos
+        self.client.message_callback_add(topic, callback)
+        if self.client.is_connected():
+            self.client.subscribe(topic, qos)
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def max_inflight_messages_set(self, inflight):
+        self.client.max_inflight_messages_set(inflight)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if not self.use_v5:
+            return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+        properties = Properties(PacketTypes.PUBLISH)
+        expiry = self.message_expiry.get(topic)
+        if expiry is not None:
+            properties.MessageExpiryInterval = expiry
+        if not qos:
+            # QoS 1/2 messages may be resent on a new connection, where the
+            # alias is unknown, so only QoS 0 uses them
+            topic, alias = self._alias(topic)
+            if alias is not None:
+                properties.TopicAlias = alias
+        return self.client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+
+    def _alias(self, topic):
+        """Topic to send and its alias, the topic is empty once the broker knows the alias"""
+        with self._alias_lock:
+            alias = self._aliases.get(topic)
+            if alias is not None:
+                return "", alias
+            if len(self._aliases) < self._alias_maximum:
+                alias = self._aliases[topic] = len(self._aliases) + 1
+                return topic, alias
+            return topic, None
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        # MQTT 5 passes a reason code object, handlers expect the number
+        rc = getattr(rc, 'value', rc)
+        with self._alias_lock:
+            # Aliases only live as long as the network connection
+            self._aliases = {}
+            self._alias_maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
+
+        if rc == 0:
+            if self._subscriptions:
+                client.subscribe(list(self._subscriptions.items()))
+            self.publisher.flush()
+        for handler in self.connect_handlers:
+            handler(client, userdata, flags, rc)
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        self.publisher.on_disconnect(client, userdata, getattr(rc, 'value', rc))
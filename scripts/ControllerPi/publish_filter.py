@@ -0,0 +1,103 @@
+import math
+import time
+
+
+def _is_nan(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+class ChangeFilter:
+    """Pick the sensor values that are worth publishing
+
+    A value is published when it moved by at least its deadband since it was
+    last published (any change for a deadband of 0), or when it has not been
+    published for max_interval seconds, which doubles as a heartbeat for
+    subscribers. Comparing against the last published value rather than the
+    last reading keeps slow drifts from being swallowed. A change to or from
+    a sentinel (e.g. sens_range=-1) or NaN is always published, however
+    small the difference.
+    """
+
+    def __init__(self, deadbands=None, max_interval=5.0, sentinels=None):
+        self.deadbands = deadbands or {}
+        self.sentinels = sentinels or {}
+        self.max_interval = max_interval
+        self._published = {}
+
+        self.published = 0
+        self.skipped = 0
+
+    def changes(self, values, now=None):
+        """Return the subset of values to publish and remember it as published"""
+        if now is None:
+            now = time.monotonic()
+
+        changed = {}
+        for key, value in values.items():
+            last = self._published.get(key)
+            if last is None or now - last[1] >= self.max_interval or self._differs(key, value, last[0]):
+                changed[key] = value
+                self._published[key] = (value, now)
+
+        self.published += len(changed)
+        self.skipped += len(values) - len(changed)
+        return changed
+
+    def _differs(self, key, value, last):
+        if _is_nan(value) or _is_nan(last):
+            return _is_nan(value) != _is_nan(last)
+        deadband = self.deadbands.get(key, 0)
+        sentinels = self.sentinels.get(key, ())
+        if not deadband or isinstance(value, bool) or value in sentinels or last in sentinels:
+            return value != last
+        return abs(value - last) >= deadband
+
+    def reset(self):
+        """Publish everything again on the next call, e.g. after a reconnect"""
+        self._published.clear()
+
+
+class RateLimit:
+    """Allow an action at most max_rate times per second
+
+    offer() makes it a trailing limiter: a value offered too early is held
+    and handed out by due() when the interval ends, so the last state is
+    never lost, only delayed by at most one interval.
+    """
+
+    def __init__(self, max_rate):
+        self.interval = 1.0 / max_rate
+        self._last = None
+        self._held = None
+
+    def ready(self, now=None):
+        """True, and start a new interval, if the last allowed call is long enough ago"""
+        if now is None:
+            now = time.monotonic()
+        if self._last is not None and now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
+
+    def offer(self, value, now=None):
+        """Return value if it may be used now, otherwise hold it for due() and return None"""
+        if self.ready(now):
+            self._held = None
+            return value
+        self._held = value
+        return None
+
+    def due(self, now=None):
+        """Return the held value once its interval has ended, None until then or if there is none"""
+        if self._held is None or not self.ready(now):
+            return None
+        value, self._held = self._held, None
+        return value
+
+    def wait_time(self, now=None):
+        """Seconds until the held value is due, None if there is none"""
+        if self._held is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._last + self.interval - now)
@@ -0,0 +1,194 @@
+import atexit
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+LEVELS = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+
+class RingLog:
+    """Preallocated ring of log records, written out by a background thread
+
+    Logging from a hot path only stores a tuple in the next slot; formatting
+    and the write to stdout (which blocks under journald) happen on the
+    flush thread. When the ring is full the oldest unwritten records are
+    overwritten and counted in ``dropped``, so a slow console can never stall
+    the caller.
+    """
+
+    def __init__(self, capacity=4096, stream=None, flush_interval=0.2):
+        self.capacity = capacity
+        self.stream = stream or sys.stdout
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        self._slots = [None] * capacity
+        self._written = 0
+        self._flushed = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ringlog", daemon=True)
+        self._thread.start()
+
+    def emit(self, subsystem, level, message, args):
+        record = (time.time(), subsystem, level, message, args)
+        with self._lock:
+            self._slots[self._written % self.capacity] = record
+            self._written += 1
+            pending = self._written - self._flushed
+            if pending > self.capacity:
+                self.dropped += pending - self.capacity
+                self._flushed = self._written - self.capacity
+        if pending >= self.capacity // 2:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write out everything logged so far"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            start, end = self._flushed, self._written
+            records = [self._slots[i % self.capacity] for i in range(start, end)]
+            self._flushed = end
+
+        if not records:
+            return
+        lines = []
+        for created, subsystem, level, message, args in records:
+            if args:
+                try:
+                    message = message % args
+                except (TypeError, ValueError):
+                    message = f"{message} {args}"
+            stamp = time.strftime('%H:%M:%S', time.localtime(created))
+            lines.append(f"{stamp}.{int(created % 1 * 1000):03d} {LEVEL_NAMES.get(level, level)} "
+                         f"[{subsystem}] {message}\n")
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class Logger:
+    """Logging front end for one subsystem, e.g. 'serial', 'mqtt' or 'motors'
+
+    Messages use %-style arguments, which are only formatted on the flush
+    thread and not at all when the level is disabled.
+    """
+
+    def __init__(self, ring, subsystem, level):
+        self.ring = ring
+        self.subsystem = subsystem
+        self.level = level
+        self._counts = {}
+        self._last = {}
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self.ring.emit(self.subsystem, level, message, args)
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.ring.emit(self.subsystem, DEBUG, message, args)
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self.ring.emit(self.subsystem, INFO, message, args)
+
+    def warning(self, message, *args):
+        if WARNING >= self.level:
+            self.ring.emit(self.subsystem, WARNING, message, args)
+
+    def error(self, message, *args):
+        if ERROR >= self.level:
+            self.ring.emit(self.subsystem, ERROR, message, args)
+
+    def sampled(self, every, level, message, *args):
+        """Log only every n-th call with this message"""
+        if level < self.level:
+            return
+        count = self._counts.get(message, 0)
+        self._counts[message] = count + 1
+        if count % every == 0:
+            self.ring.emit(self.subsystem, level, message, args)
+
+    def rate_limited(self, interval, level, message, *args):
+        """Log this message at most once per interval seconds"""
+        if level < self.level:
+            return
+        now = time.monotonic()
+        if now - self._last.get(message, -interval) >= interval:
+            self._last[message] = now
+            self.ring.emit(self.subsystem, level, message, args)
+
+
+_ring = None
+_loggers = {}
+_default_level = INFO
+_levels = {}
+
+
+def _parse_levels(spec):
+    """Parse LOG_LEVELS, e.g. "info,motors=debug,mqtt=warning" """
+    default, levels = None, {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, sep, level = item.rpartition('=')
+        level = LEVELS.get(level.lower())
+        if level is None:
+            continue
+        if sep:
+            levels[name] = level
+        else:
+            default = level
+    return default, levels
+
+
+def get_logger(subsystem):
+    """Logger of a subsystem, created on first use with its configured level"""
+    global _ring, _default_level
+    logger = _loggers.get(subsystem)
+    if logger is None:
+        if _ring is None:
+            default, levels = _parse_levels(os.environ.get('LOG_LEVELS', ''))
+            _default_level = default or _default_level
+            _levels.update(levels)
+            _ring = RingLog()
+            atexit.register(_ring.flush)
+        logger = _loggers[subsystem] = Logger(_ring, subsystem, _levels.get(subsystem, _default_level))
+    return logger
+
+
+def set_level(level, subsystem=None):
+    """Change the level of one subsystem, or the default of all of them"""
+    global _default_level
+    if subsystem is None:
+        _default_level = level
+        for name, logger in _loggers.items():
+            logger.level = _levels.get(name, level)
+    else:
+        _levels[subsystem] = level
+        if subsystem in _loggers:
+            _loggers[subsystem].level = level
+
+
+def flush():
+    """Write out everything logged so far, e.g. before exiting"""
+    if _ring is not None:
+        _ring.flush()
@@ -0,0 +1,246 @@
+import math
+from collections import Counter, namedtuple
+
+# One entry per key the Arduinos print. min/max bound the valid range,
+# sentinels are special values that are passed through unchecked
+# (e.g. sens_range=-1 when the target is out of range). deadband is the
+# smallest change worth publishing, 0 publishes every change.
+SensorField = namedtuple(
+    'SensorField',
+    ['key', 'type', 'unit', 'min', 'max', 'sentinels', 'deadband'],
+    defaults=(None, None, None, (), 0),
+)
+
+SENSOR_SCHEMA = (
+    SensorField('sens_photo', int, 'raw', 0, 1023, deadband=8),
+    SensorField('sens_humid', float, '%', 0.0, 100.0, deadband=0.5),
+    SensorField('sens_temp', float, 'C', -40.0, 80.0, deadband=0.2),
+    SensorField('sens_lux', float, 'lx', 0.0, 100000.0, deadband=5.0),
+    SensorField('sens_range', int, 'mm', 0, 255, sentinels=(-1,), deadband=2),
+    SensorField('led_red', bool),
+)
+
+JOYSTICK_SCHEMA = (
+    SensorField('sens_joy_x', int, 'raw', 0, 1023, deadband=4),
+    SensorField('sens_joy_y', int, 'raw', 0, 1023, deadband=4),
+)
+
+
+class OutOfRange(ValueError):
+    pass
+
+
+def _to_float(text):
+    value = float(text)
+    # nan would pass every range check and inf overflows int()
+    if not math.isfinite(value):
+        raise ValueError(text)
+    return value
+
+
+def _to_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        # Tolerate "12.00" style output for integer sensors
+        return int(_to_float(text))
+
+
+def _to_bool(text):
+    text = text.strip().lower()
+    if text == 'true':
+        return True
+    if text == 'false':
+        return False
+    raise ValueError(text)
+
+
+_PARSERS = {int: _to_int, float: _to_float, bool: _to_bool}
+
+
+def _make_converter(field):
+    parse = _PARSERS[field.type]
+    low, high, sentinels = field.min, field.max, field.sentinels
+
+    if low is None and high is None:
+        return parse
+
+    def convert(text):
+        value = parse(text)
+        if value in sentinels:
+            return value
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise OutOfRange(value)
+        return value
+
+    return convert
+
+
+def _make_check(field):
+    low, high, sentinels = field.min, field.max, field.sentinels
+
+    def check(value):
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError(value)
+        if value in sentinels:
+            return value
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise OutOfRange(value)
+        return value
+
+    return check
+
+
+class SchemaDecoder:
+    """Decoder for key=value frames, compiled once from a sensor schema
+
+    Every line costs one dict lookup for its converter, which parses and
+    range checks the value. Bad values are counted in ``errors`` under
+    (key, reason) instead of being printed, reason being 'malformed',
+    'out_of_range' or 'unknown'. ``validate`` applies the same checks to
+    values that arrive already parsed, e.g. from binary frames.
+    """
+
+    def __init__(self, fields):
+        self.fields = {field.key: field for field in fields}
+        self.converters = {field.key: _make_converter(field) for field in fields}
+        self.checks = {field.key: _make_check(field) for field in fields}
+        self.errors = Counter()
+
+    def defaults(self):
+        """Initial value for every key, as used for the sensor_data dicts"""
+        return {key: field.type() for key, field in self.fields.items()}
+
+    def deadbands(self):
+        """Publish deadband of every key"""
+        return {key: field.deadband for key, field in self.fields.items()}
+
+    def sentinels(self):
+        """Sentinel values of every key that has some"""
+        return {key: field.sentinels for key, field in self.fields.items() if field.sentinels}
+
+    def decode_frame(self, text):
+        """Decode one frame of key=value lines into a dict of valid values"""
+        values = {}
+        converters = self.converters
+
+        for line in text.split('\n'):
+            key, sep, value = line.partition('=')
+            if not sep:
+                continue
+            key = key.strip()
+            convert = converters.get(key)
+            if convert is None:
+                self.errors[(key, 'unknown')] += 1
+                continue
+            try:
+                values[key] = convert(value)
+            except OutOfRange:
+                self.errors[(key, 'out_of_range')] += 1
+            except ValueError:
+                self.errors[(key, 'malformed')] += 1
+
+        return values
+
+    def validate(self, values):
+        """Check a dict of parsed values like decode_frame checks text, returns the valid ones"""
+        valid = {}
+        checks = self.checks
+
+        for key, value in values.items():
+            check = checks.get(key)
+            if check is None:
+                self.errors[(key, 'unknown')] += 1
+                continue
+            try:
+                valid[key] = check(value)
+            except OutOfRange:
+                self.errors[(key, 'out_of_range')] += 1
+            except ValueError:
+                self.errors[(key, 'malformed')] += 1
+
+        return valid
+
+    def decode_batch(self, frames):
+        """Decode many recorded frames at once into NumPy columns for analysis
+
+        Returns a dict of key -> float64 array with one row per frame. Rows
+        where the key was missing, malformed or out of range hold NaN;
+        sentinel values are kept as they are. Needs NumPy, which is only
+        required for offline analysis.
+        """
+        import numpy as np
+
+        rows = {key: [] for key in self.fields}
+        texts = {key: [] for key in self.fields}
+
+        for index, frame in enumerate(frames):
+            for line in frame.split('\n'):
+                key, sep, value = line.partition('=')
+                if not sep:
+                    continue
+                key = key.strip()
+                if key in rows:
+                    rows[key].append(index)
+                    texts[key].append(value.strip())
+                else:
+                    self.errors[(key, 'unknown')] += 1
+
+        columns = {}
+        for key, field in self.fields.items():
+            column = np.full(len(frames), np.nan)
+            if texts[key]:
+                values = self._convert_column(np, field, texts[key])
+                if field.type is not bool:
+                    valid = np.isfinite(values)
+                    if field.min is not None:
+                        valid &= values >= field.min
+                    if field.max is not None:
+                        valid &= values <= field.max
+                    if field.sentinels:
+                        valid |= np.isin(values, field.sentinels)
+                    out_of_range = np.isfinite(values) & ~valid
+                    if out_of_range.any():
+                        self.errors[(key, 'out_of_range')] += int(out_of_range.sum())
+                    values = np.where(valid, values, np.nan)
+                column[np.asarray(rows[key])] = values
+            columns[key] = column
+
+        return columns
+
+    def _convert_column(self, np, field, texts):
+        strings = np.asarray(texts)
+
+        if field.type is bool:
+            lowered = np.char.lower(strings)
+            values = np.where(lowered == 'true', 1.0, np.nan)
+            values[lowered == 'false'] = 0.0
+            malformed = int(np.isnan(values).sum())
+            if malformed:
+                self.errors[(field.key, 'malformed')] += malformed
+            return values
+
+        try:
+            values = strings.astype(np.float64)
+        except ValueError:
+            # Fall back to element by element for the column with bad values
+            values = np.empty(len(texts))
+            for i, text in enumerate(texts):
+                try:
+                    values[i] = _to_float(text)
+                except ValueError:
+                    values[i] = np.nan
+                    self.errors[(field.key, 'malformed')] += 1
+            return values
+
+        # "nan" and "inf" parse as floats but are no readings
+        non_finite = ~np.isfinite(values)
+        if non_finite.any():
+            self.errors[(field.key, 'malformed')] += int(non_finite.sum())
+            values[non_finite] = np.nan
+        return values
+
+
+def compile_schema(fields):
+    """Compile a tuple of SensorField into a SchemaDecoder"""
+    return SchemaDecoder(fields)
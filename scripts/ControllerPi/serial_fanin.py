@@ -0,0 +1,93 @@
+import selectors
+import time
+from collections import namedtuple
+
+import serial
+
+import ringlog
+
+log = ringlog.get_logger('serial')
+
+# A frame as it leaves the fan-in. seq counts every frame ingested by this
+# process, captured is the time.monotonic() the bytes were read at.
+IngestedFrame = namedtuple('IngestedFrame', ['seq', 'captured', 'source', 'frame'])
+
+
+class SerialFanIn:
+    """Read any number of serial devices at once and merge their frames
+
+    Every device gets its own assembler (text or binary). ``poll`` waits on
+    all of them through one selector (epoll on the Pi) and returns the
+    frames of every device that had data as IngestedFrame tuples, ordered
+    by the time they were read and numbered across all devices. A device
+    that fails is dropped instead of taking the others down.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.devices = {}
+        self.read_errors = 0
+        self.seq = 0
+
+    def add(self, source, ser, assembler):
+        """Start reading ser, frames are tagged with source"""
+        self.devices[source] = (ser, assembler)
+        self.selector.register(ser.fileno(), selectors.EVENT_READ, source)
+
+    def remove(self, source):
+        ser, _ = self.devices.pop(source)
+        self.selector.unregister(ser.fileno())
+        ser.close()
+
+    def read(self, source):
+        """Read what one device has buffered and return its stamped frames"""
+        ser, assembler = self.devices[source]
+        try:
+            data = ser.read(ser.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            log.error("Serial device %s failed: %s", source, e)
+            self.read_errors += 1
+            self.remove(source)
+            return []
+
+        captured = time.monotonic()
+        frames = []
+        for frame in assembler.feed(data):
+            frames.append(IngestedFrame(self.seq, captured, source, frame))
+            self.seq += 1
+        return frames
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds for any device and return the merged frames"""
+        if not self.devices:
+            time.sleep(timeout or 0)
+            return []
+
+        frames = []
+        for key, _ in self.selector.select(timeout):
+            frames.extend(self.read(key.data))
+
+        frames.sort(key=lambda ingested: ingested.captured)
+        return frames
+
+    def close(self):
+        for source in list(self.devices):
+            self.remove(source)
+        self.selector.close()
+
+
+def open_serial_devices(ports, baudrate=9600, timeout=0.05):
+    """Open every port that is present, returns {port: Serial}"""
+    devices = {}
+    for port in ports:
+        try:
+            devices[port] = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+            log.info("Connected to serial port: %s", port)
+        except serial.SerialException as e:
+            log.warning("Error opening serial port: %s", e)
+    return devices
+
+
+def capture_wall_time(captured):
+    """Wall clock time of a monotonic capture time, for consumers on other hosts"""
+    return time.time() - (time.monotonic() - captured)
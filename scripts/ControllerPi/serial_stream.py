@@ -0,0 +1,62 @@
+class SerialFrameAssembler:
+    """Assemble key=value lines from an Arduino serial feed into complete frames
+
+    Raw bytes are kept in a persistent buffer between reads, so a partially
+    received line is completed by the next read instead of being thrown away.
+    A frame is closed by the line that starts with ``end_key``, which is the
+    last value the sketch prints per cycle ('sens_photo' on the Uno,
+    'sens_joy_y' on the Nano).
+    """
+
+    def __init__(self, end_key, max_line_length=256, max_frame_lines=32):
+        self.end_key = end_key.encode('ascii') + b'='
+        self.max_line_length = max_line_length
+        self.max_frame_lines = max_frame_lines
+        self._buffer = bytearray()
+        self._lines = []
+
+    def feed(self, data):
+        """Append raw bytes to the buffer and return the frames they completed"""
+        self._buffer += data
+        frames = []
+        start = 0
+
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end < 0:
+                break
+            line = bytes(self._buffer[start:end]).strip()
+            start = end + 1
+            if not line:
+                continue
+
+            self._lines.append(line.decode('utf-8', errors='ignore'))
+            if line.startswith(self.end_key):
+                frames.append('\n'.join(self._lines))
+                self._lines = []
+            elif len(self._lines) > self.max_frame_lines:
+                # The end key never arrived, drop the oldest line
+                del self._lines[0]
+
+        del self._buffer[:start]
+        if len(self._buffer) > self.max_line_length:
+            # No newline in sight, this is line noise rather than a reading
+            del self._buffer[:-self.max_line_length]
+
+        return frames
+
+    def read(self, ser):
+        """Read everything the port has buffered and return the completed frames
+
+        Blocks for at most ``ser.timeout`` when nothing is waiting, instead of
+        spinning on ``in_waiting``.
+        """
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            return []
+        return self.feed(data)
+
+    def reset(self):
+        """Forget any partially received line or frame"""
+        self._buffer.clear()
+        self._lines = []
@@ -0,0 +1,201 @@
+import fcntl
+import math
+import os
+import random
+import select
+import termios
+import threading
+import time
+
+from serial_binary import FRAME_JOYSTICK, FRAME_SENSORS, encode_frame
+
+# Bytes a batch of frames may take, one Linux pipe buffer
+pipe_buffer = 65536
+
+
+class SyntheticSensors:
+    """Seeded, deterministic stand-in for the Uno's sensor readings
+
+    Values depend only on the seed and the frame time, never on the wall
+    clock, so the same seed and rate always produce the same byte stream.
+    """
+
+    frame_type = FRAME_SENSORS
+    end_key = 'sens_photo'
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.temp = 22.0
+        self.humid = 45.0
+        self.obstacle_start = None
+        self.obstacle_length = 0.0
+        self.last_t = 0.0
+
+    def frame(self, t):
+        rnd = self.random
+        dt = t - self.last_t
+        self.last_t = t
+
+        # Slow random walk around room temperature, humidity follows inversely.
+        # Steps scale with the frame interval so the rate does not change the
+        # shape of the waveform.
+        walk = math.sqrt(dt)
+        self.temp = min(max(self.temp + rnd.gauss(0, 0.05 * walk) + (22.0 - self.temp) * 0.005 * dt, 15.0), 35.0)
+        self.humid = min(max(self.humid + rnd.gauss(0, 0.1 * walk) - (self.temp - 22.0) * 0.01 * dt, 20.0), 80.0)
+
+        # Light level swings over a few minutes with flicker on top
+        lux = max(0.0, 400.0 + 300.0 * math.sin(t / 120.0) + rnd.gauss(0, 5))
+        photo = min(1023, max(0, int(lux * 0.9 + rnd.gauss(0, 8))))
+
+        # Open space most of the time, about every 20 s an obstacle approaches
+        # and recedes again
+        if self.obstacle_start is None and rnd.random() < dt / 20.0:
+            self.obstacle_start = t
+            self.obstacle_length = rnd.uniform(2.0, 8.0)
+        if self.obstacle_start is not None:
+            phase = (t - self.obstacle_start) / self.obstacle_length
+            if phase >= 1.0:
+                self.obstacle_start = None
+                distance = -1
+            else:
+                distance = int(30 + 200 * abs(2 * phase - 1) + rnd.gauss(0, 3))
+                distance = distance if 0 <= distance <= 255 else -1
+        else:
+            distance = -1
+
+        return {
+            'sens_humid': round(self.humid, 2),
+            'sens_temp': round(self.temp, 2),
+            'sens_lux': round(lux, 2),
+            'sens_range': distance,
+            'led_red': photo < 320,
+            'sens_photo': photo,
+        }
+
+    def encode_text(self, frame):
+        # Same lines, order and float format as the Uno sketch
+        return (
+            f"sens_humid={frame['sens_humid']:.2f}\r\n"
+            f"sens_temp={frame['sens_temp']:.2f}\r\n"
+            f"sens_lux={frame['sens_lux']:.2f}\r\n"
+            f"sens_range={frame['sens_range']}\r\n"
+            f"led_red={'true' if frame['led_red'] else 'false'}\r\n"
+            f"sens_photo={frame['sens_photo']}\r\n"
+        ).encode('ascii')
+
+
+class SyntheticJoystick:
+    """Seeded, deterministic stand-in for the Nano's joystick readings
+
+    Alternates between resting at the centre and sweeping the stick through
+    its full range, with some ADC noise.
+    """
+
+    frame_type = FRAME_JOYSTICK
+    end_key = 'sens_joy_y'
+    center = 504
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+
+    def frame(self, t):
+        rnd = self.random
+        cycle = t % 12.0
+
+        if cycle < 4.0:
+            x = y = self.center
+        else:
+            # Sweep forward/back on x, slower left/right on y
+            x = self.center + 510 * math.sin((cycle - 4.0) * math.pi / 2.0)
+            y = self.center + 510 * math.sin((cycle - 4.0) * math.pi / 4.0)
+
+        return {
+            'sens_joy_x': min(1023, max(0, int(x + rnd.gauss(0, 2)))),
+            'sens_joy_y': min(1023, max(0, int(y + rnd.gauss(0, 2)))),
+        }
+
+    def encode_text(self, frame):
+        return f"sens_joy_x={frame['sens_joy_x']}\r\nsens_joy_y={frame['sens_joy_y']}\r\n".encode('ascii')
+
+
+class SyntheticSerial:
+    """Serial port look-alike that streams synthetic frames at rate_hz
+
+    Backed by a pipe fed from a background thread, so it has a real file
+    descriptor and works with SerialFanIn, the asyncio reader and the frame
+    assemblers exactly like a pyserial port. Frames are written in batches
+    of however many are due, which keeps up with tens of thousands of
+    frames per second. A batch fits one pipe buffer; when the reader
+    stalls, the oldest frames it fell behind by are skipped and counted in
+    frames_skipped instead of piling up.
+    """
+
+    def __init__(self, source, rate_hz=1.0, protocol='text', timeout=1.0, name='synthetic'):
+        self.source = source
+        self.rate_hz = rate_hz
+        self.protocol = protocol
+        self.timeout = timeout
+        self.name = name
+        self.frames_written = 0
+        self.frames_skipped = 0
+
+        self._read_fd, self._write_fd = os.pipe()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def encode(self, seq, frame):
+        if self.protocol == 'binary':
+            return encode_frame(self.source.frame_type, seq, frame)
+        return self.source.encode_text(frame)
+
+    def _run(self):
+        period = 1.0 / self.rate_hz
+        start = time.monotonic()
+        seq = 0
+        frame_bytes = 0
+
+        while not self._stopped.is_set():
+            due = int((time.monotonic() - start) * self.rate_hz) + 1
+            if frame_bytes and due - seq > pipe_buffer // frame_bytes:
+                # The reader fell behind, only the newest frames are written
+                self.frames_skipped += due - seq - pipe_buffer // frame_bytes
+                seq = due - pipe_buffer // frame_bytes
+            count = due - seq
+            chunk = b''.join(
+                self.encode(n, self.source.frame(n * period)) for n in range(seq, due))
+            seq = due
+            if count:
+                frame_bytes = max(frame_bytes, -(-len(chunk) // count))
+
+            try:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(self._write_fd, view):]
+            except OSError:
+                return
+            self.frames_written += count
+
+            self._stopped.wait(max(start + seq * period - time.monotonic(), 0.001))
+
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def in_waiting(self):
+        return int.from_bytes(fcntl.ioctl(self._read_fd, termios.FIONREAD, b'\0\0\0\0'), 'little')
+
+    def read(self, size=1):
+        ready, _, _ = select.select([self._read_fd], [], [], self.timeout)
+        if not ready:
+            return b''
+        return os.read(self._read_fd, max(size, 1))
+
+    def close(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        # Closing the read end first makes a blocked write fail with EPIPE
+        os.close(self._read_fd)
+        self._thread.join()
+        os.close(self._write_fd)
@@ -0,0 +1,67 @@
+import math
+import random
+
+import pytest
+
+from latency_probe import ClockOffset, LatencyHistogram
+
+
+def exact_percentile(values, p):
+    return sorted(values)[max(1, math.ceil(len(values) * p / 100)) - 1]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_percentiles_within_one_percent(seed):
+    rng = random.Random(seed)
+    histogram = LatencyHistogram()
+    values = [min(int(rng.lognormvariate(9, 2)), histogram.highest_us) for _ in range(20000)]
+    for value in values:
+        histogram.record(value / 1e6)
+
+    for p in (0.1, 1, 10, 50, 90, 99, 99.9, 100):
+        exact = exact_percentile(values, p)
+        estimate = histogram.percentile(p) * 1e6
+        assert exact <= round(estimate) <= exact * 1.01, p
+
+
+def test_every_bucket_within_one_percent():
+    histogram = LatencyHistogram()
+    for value in range(1, histogram.highest_us, 997):
+        highest = histogram._highest_equivalent(histogram._index(value))
+        assert value <= highest <= value * 1.01
+
+
+def test_small_values_are_exact_and_extremes_clamped():
+    histogram = LatencyHistogram(highest_us=1_000_000)
+    for seconds in (-0.5, 0.000017, 0.000018, 5.0):
+        histogram.record(seconds)
+    assert histogram.percentile(25) == 0
+    assert histogram.percentile(50) == pytest.approx(0.000017)
+    assert histogram.percentile(75) == pytest.approx(0.000018)
+    assert histogram.percentile(100) == 1.0
+    assert histogram.summary()['count'] == 4
+    assert LatencyHistogram().percentile(50) is None
+
+
+def test_clock_offset_of_symmetric_exchange():
+    clock = ClockOffset()
+    # Motor Pi clock 2.5 s ahead, 3 ms each way, 1 ms between receive and act
+    clock.update(100.0, 102.503, 102.504, 100.007)
+    assert clock.offset == pytest.approx(2.5)
+
+
+def test_clock_offset_prefers_least_delayed_sample():
+    clock = ClockOffset(window=4)
+    assert clock.offset is None
+    t1 = 0.0
+    for outbound, inbound in ((0.050, 0.001), (0.001, 0.001), (0.001, 0.030)):
+        clock.update(t1, t1 + outbound - 1.0, t1 + outbound - 1.0, t1 + outbound + inbound)
+        t1 += 1
+    assert clock.offset == pytest.approx(-1.0)
+
+    # The good sample leaves the window, the best of the rest wins with its
+    # error of half the asymmetry, (10 ms - 2 ms) / 2
+    for _ in range(3):
+        clock.update(t1, t1 + 0.010 - 1.0, t1 + 0.010 - 1.0, t1 + 0.012)
+        t1 += 1
+    assert clock.offset == pytest.approx(-0.996)
@@ -1,6 +1,10 @@
-import RPi.GPIO as GPIO
 import time
 
+from gpio_backend_rpi1 import RPiGpioBackend
+import ringlog
+
+log = ringlog.get_logger('motors')
+
 MotorDir = [
     'forward',
     'backward',
@@ -12,21 +16,19 @@ ControlMode = [
 ]
 
 class DRV8825():
-    def __init__(self, dir_pin, step_pin, enable_pin, mode_pins):
+    def __init__(self, dir_pin, step_pin, enable_pin, mode_pins, gpio=None):
         self.dir_pin = dir_pin
         self.step_pin = step_pin        
         self.enable_pin = enable_pin
         self.mode_pins = mode_pins
-        
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        GPIO.setup(self.dir_pin, GPIO.OUT)
-        GPIO.setup(self.step_pin, GPIO.OUT)
-        GPIO.setup(self.enable_pin, GPIO.OUT)
-        GPIO.setup(self.mode_pins, GPIO.OUT)
+
+        # Drivers share one gpio_backend_rpi1 backend, its shadow skips
+        # writes of levels the pins already have
+        self.gpio = gpio or RPiGpioBackend()
+        self.gpio.setup_output([self.dir_pin, self.step_pin, self.enable_pin, *self.mode_pins])
         
     def digital_write(self, pin, value):
-        GPIO.output(pin, value)
+        self.gpio.write(pin, value)
         
     def Stop(self):
         self.digital_write(self.enable_pin, 0)
@@ -47,31 +49,42 @@ class DRV8825():
                      '1/16step': (0, 0, 1),
                      '1/32step': (1, 0, 1)}
 
-        print ("Control mode:", mode)
+        log.debug("Control mode: %s", mode)
         if (mode == ControlMode[1]):
-            print ("set pins")
+            log.debug("set pins")
             self.digital_write(self.mode_pins, microstep[stepformat])
         
-    def TurnStep(self, Dir, steps, stepdelay=0.005):
+    def SetDir(self, Dir):
+        """Enable the driver and set the direction, False (and disabled) for an unknown one"""
         if (Dir == MotorDir[0]):
-            print ("forward")
-            self.digital_write(self.enable_pin, 1)
-            self.digital_write(self.dir_pin, 0)
+            log.debug("forward")
+            self.gpio.write((self.enable_pin, self.dir_pin), (1, 0))
         elif (Dir == MotorDir[1]):
-            print ("backward")
-            self.digital_write(self.enable_pin, 1)
-            self.digital_write(self.dir_pin, 1)
+            log.debug("backward")
+            self.gpio.write((self.enable_pin, self.dir_pin), (1, 1))
         else:
-            print ("the dir must be : 'forward' or 'backward'")
+            log.error("the dir must be : 'forward' or 'backward'")
             self.digital_write(self.enable_pin, 0)
+            return False
+        return True
+
+    def TurnStep(self, Dir, steps, stepdelay=0.005, intervals=None):
+        """
+        Step with stepdelay high and low, or with the step periods in seconds
+        of intervals, e.g. a motion_profile_rpi1 table of steps entries
+        """
+        if not self.SetDir(Dir):
             return
 
         if (steps == 0):
             return
             
-        print ("turn step:",steps)
-        for i in range(steps):
+        log.debug("turn step: %d", steps)
+        if intervals is None:
+            intervals = [2 * stepdelay] * steps
+        # Each step ends its interval, a GPIO write is longer than the
+        # driver's minimum pulse width
+        for interval in intervals[:steps]:
+            time.sleep(interval)
             self.digital_write(self.step_pin, True)
-            time.sleep(stepdelay)
             self.digital_write(self.step_pin, False)
-            time.sleep(stepdelay)
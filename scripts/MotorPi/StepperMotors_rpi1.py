@@ -1,42 +1,99 @@
-import threading
-
 from DRV8825_rpi1 import DRV8825
+from gpio_backend_rpi1 import RPiGpioBackend
+from motion_profile_rpi1 import step_intervals
+from pulse_backend_rpi1 import SoftwareBackend
+from stepping_engine_rpi1 import SteppingEngine
+import ringlog
+
+log = ringlog.get_logger('motors')
+
+# One row per driver, all of them are stepped by one SteppingEngine
+MOTOR_PINS = [
+    {'dir_pin': 13, 'step_pin': 19, 'enable_pin': 12, 'mode_pins': (16, 17, 20)},
+    {'dir_pin': 24, 'step_pin': 18, 'enable_pin': 4, 'mode_pins': (21, 22, 27)},
+]
 
 class Motors:
-    def __init__(self):
-        self.Motor1 = DRV8825(dir_pin=13, step_pin=19, enable_pin=12, mode_pins=(16, 17, 20))
-        self.Motor2 = DRV8825(dir_pin=24, step_pin=18, enable_pin=4, mode_pins=(21, 22, 27))
+    # Directions of the left and the right side. The first half of the
+    # drivers (Motor1, and the middle one of an odd count) drive the left
+    # side, the rest the right one.
+    DIRECTIONS = {
+        'forward': ('forward', 'forward'),
+        'backward': ('backward', 'backward'),
+        'left': ('backward', 'forward'),
+        'right': ('forward', 'backward'),
+    }
+    SIGNS = {'forward': 1, 'backward': -1, None: 0}
+
+    # Motion profile of every move: cruise rate in steps/s, acceleration in
+    # steps/s^2 and jerk in steps/s^3 (None for a trapezoidal profile). The
+    # acceleration ramp lets the motors cruise faster than they can start.
+    max_rate = 2000
+    max_acceleration = 8000
+    max_jerk = 80000
+
+    def __init__(self, backend=None, gpio=None, pin_table=MOTOR_PINS):
+        # All drivers write their pins through one GPIO backend
+        self.gpio = gpio or RPiGpioBackend()
+        self.drivers = [DRV8825(gpio=self.gpio, **pins) for pins in pin_table]
+        # Step pulses go through a pulse backend, by default a Python thread
+        self.engine = SteppingEngine(self.drivers, backend or SoftwareBackend(self.gpio.write_masks))
+        for driver in self.drivers:
+            driver.SetMicroStep('softward', 'fullstep')
+
+    @property
+    def Motor1(self):
+        return self.drivers[0]
+
+    @property
+    def Motor2(self):
+        return self.drivers[1]
+
+    def signs(self, direction):
+        """Sign of every driver's steps for a DIRECTIONS direction"""
+        left, right = self.DIRECTIONS[direction]
+        sides = (len(self.drivers) + 1) // 2
+        return [self.SIGNS[left] if index < sides else self.SIGNS[right] for index in range(len(self.drivers))]
+
+    def profile(self, step_count):
+        """Step intervals of a move of step_count steps, cached per distance"""
+        return step_intervals(step_count, self.max_rate, self.max_acceleration, self.max_jerk)
+
+    def run(self, steps) -> None:
+        """Step each driver its signed number of steps, in sync, and wait until done"""
+        self.engine.move(steps, self.profile(max(abs(count) for count in steps)))
 
     def run_motor1(self, direction, step_count) -> None:
-        print("motor1 starting")
-        self.Motor1.SetMicroStep('softward', 'fullstep')
-        self.Motor1.TurnStep(Dir=direction, steps=step_count, stepdelay=0.000001)
-        print("motor1 finished")
-        self.Motor1.Stop()
+        self.run_motor(0, direction, step_count)
 
     def run_motor2(self, direction, step_count) -> None:
-        print("motor2 starting")
-        self.Motor2.SetMicroStep('softward', 'fullstep')
-        self.Motor2.TurnStep(Dir=direction, steps=step_count, stepdelay=0.000001)
-        print("motor2 finished")
-        self.Motor2.Stop()
+        self.run_motor(1, direction, step_count)
 
-    def run_both_motors_forward(self, step_count) -> None:
-        motor1_thread = threading.Thread(target=self.run_motor1, args=('forward', step_count))
-        motor2_thread = threading.Thread(target=self.run_motor2, args=('forward', step_count))
+    def run_motor(self, index, direction, step_count) -> None:
+        """Step the driver at index step_count steps in direction, the others stay still"""
+        directions = [None] * len(self.drivers)
+        directions[index] = direction
+        self.run_motors(directions, step_count)
+
+    def run_motors(self, directions, step_count) -> None:
+        """Step every driver step_count steps in its direction, None keeps one still"""
+        if any(direction not in self.SIGNS for direction in directions):
+            log.error("the dir must be : 'forward' or 'backward'")
+            return
+        self.run([self.SIGNS[direction] * step_count for direction in directions])
 
-        motor1_thread.start()
-        motor2_thread.start()
+    def run_direction(self, direction, step_count) -> None:
+        """Step every driver step_count steps towards a DIRECTIONS direction"""
+        self.run([sign * step_count for sign in self.signs(direction)])
 
-        motor1_thread.join()
-        motor2_thread.join()
+    def run_both_motors_forward(self, step_count) -> None:
+        self.run_direction('forward', step_count)
 
     def run_both_motors_backward(self, step_count) -> None:
-        motor1_thread = threading.Thread(target=self.run_motor1, args=('backward', step_count))
-        motor2_thread = threading.Thread(target=self.run_motor2, args=('backward', step_count))
+        self.run_direction('backward', step_count)
 
-        motor1_thread.start()
-        motor2_thread.start()
+    def turn_left(self, step_count) -> None:
+        self.run_direction('left', step_count)
 
-        motor1_thread.join()
-        motor2_thread.join()
\ No newline at end of file
+    def turn_right(self, step_count) -> None:
+        self.run_direction('right', step_count)
\ No newline at end of file
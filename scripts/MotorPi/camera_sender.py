@@ -3,6 +3,10 @@ import time
 import signal
 import sys
 
+import ringlog
+
+log = ringlog.get_logger('camera')
+
 # Global variables
 SCREEN_PI_IP = "192.168.230.5"
 VIDEO_PORT = 5000
@@ -14,7 +18,7 @@ video_process = None
 gstreamer_process = None
 
 def signal_handler(sig, frame):
-    print("\nReceived interrupt signal, stopping...")
+    log.info("Received interrupt signal, stopping...")
     cleanup()
     sys.exit(0)
 
@@ -27,16 +31,16 @@ def cleanup():
 
     for name, process in processes:
         if process:
-            print(f"Terminating {name} process...")
+            log.info("Terminating %s process...", name)
             process.terminate()
             try:
                 process.wait(timeout=5)
-                print(f"{name} process terminated gracefully")
+                log.info("%s process terminated gracefully", name)
             except subprocess.TimeoutExpired:
-                print(f"{name} process didn't terminate gracefully, killing...")
+                log.warning("%s process didn't terminate gracefully, killing...", name)
                 process.kill()
                 process.wait()
-                print(f"{name} process killed")
+                log.warning("%s process killed", name)
 
 def create_gstreamer_command():
     libcamera_cmd = (
@@ -62,32 +66,32 @@ def monitor_process(process):
 
         if current_time - last_status_time >= 10:
             runtime = current_time - start_time
-            print(f"Video streaming running... ({runtime:.0f}s)")
+            log.info("Video streaming running... (%.0fs)", runtime)
             last_status_time = current_time
 
         time.sleep(1)
 
     return_code = process.returncode
     runtime = time.time() - start_time
-    print(f"Video process ended after {runtime:.0f}s with return code: {return_code}")
+    log.info("Video process ended after %.0fs with return code: %s", runtime, return_code)
     return return_code
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    print("=== Video Sender Starting ===")
-    print(f"Target: {SCREEN_PI_IP}:{VIDEO_PORT}")
-    print(f"Resolution: {VIDEO_WIDTH}x{VIDEO_HEIGHT} @ {VIDEO_FRAMERATE}fps")
+    log.info("=== Video Sender Starting ===")
+    log.info("Target: %s:%s", SCREEN_PI_IP, VIDEO_PORT)
+    log.info("Resolution: %sx%s @ %sfps", VIDEO_WIDTH, VIDEO_HEIGHT, VIDEO_FRAMERATE)
 
-    print("\n--- Starting Video Stream ---")
+    log.info("--- Starting Video Stream ---")
     libcamera_cmd, gstreamer_cmd = create_gstreamer_command()
-    print(f"libcamera command: {libcamera_cmd}")
-    print(f"GStreamer command: {gstreamer_cmd}")
+    log.info("libcamera command: %s", libcamera_cmd)
+    log.info("GStreamer command: %s", gstreamer_cmd)
 
     try:
         # Start libcamera-vid process
-        print("Starting libcamera-vid...")
+        log.info("Starting libcamera-vid...")
         video_process = subprocess.Popen(
             libcamera_cmd,
             shell=True,
@@ -101,14 +105,14 @@ if __name__ == "__main__":
         # Check if libcamera-vid started successfully
         if video_process.poll() is not None:
             stdout, stderr = video_process.communicate()
-            print(f"libcamera-vid failed to start!")
-            print(f"Return code: {video_process.returncode}")
-            print(f"STDOUT: {stdout}")
-            print(f"STDERR: {stderr}")
+            log.error("libcamera-vid failed to start!")
+            log.error("Return code: %s", video_process.returncode)
+            log.error("STDOUT: %s", stdout)
+            log.error("STDERR: %s", stderr)
             sys.exit(1)
 
         # Start GStreamer process
-        print("Starting GStreamer...")
+        log.info("Starting GStreamer...")
         gstreamer_process = subprocess.Popen(
             gstreamer_cmd,
             shell=True,
@@ -120,8 +124,8 @@ if __name__ == "__main__":
 
         video_process.stdout.close()
 
-        print("Both processes started successfully!")
-        print("Press Ctrl+C to stop...")
+        log.info("Both processes started successfully!")
+        log.info("Press Ctrl+C to stop...")
 
         # Monitor both processes
         start_time = time.time()
@@ -133,32 +137,33 @@ if __name__ == "__main__":
             gstreamer_status = gstreamer_process.poll()
 
             if libcamera_status is not None:
-                print(f"libcamera-vid process ended with code: {libcamera_status}")
+                log.warning("libcamera-vid process ended with code: %s", libcamera_status)
                 _, stderr = video_process.communicate()
                 if stderr:
-                    print(f"libcamera-vid stderr: {stderr}")
+                    log.warning("libcamera-vid stderr: %s", stderr)
                 break
 
             if gstreamer_status is not None:
-                print(f"GStreamer process ended with code: {gstreamer_status}")
+                log.warning("GStreamer process ended with code: %s", gstreamer_status)
                 _, stderr = gstreamer_process.communicate()
                 if stderr:
-                    print(f"GStreamer stderr: {stderr}")
+                    log.warning("GStreamer stderr: %s", stderr)
                 break
 
             current_time = time.time()
             if current_time - last_status_time >= 10:
                 runtime = current_time - start_time
-                print(f"Video streaming running... ({runtime:.0f}s)")
+                log.info("Video streaming running... (%.0fs)", runtime)
                 last_status_time = current_time
 
             time.sleep(1)
 
     except FileNotFoundError:
-        print("ERROR: libcamera-vid or gst-launch-1.0 not found!")
-        print("Make sure libcamera and GStreamer are installed")
+        log.error("libcamera-vid or gst-launch-1.0 not found!")
+        log.error("Make sure libcamera and GStreamer are installed")
     except Exception as e:
-        print(f"ERROR starting video stream: {e}")
+        log.error("Error starting video stream: %s", e)
     finally:
         cleanup()
-        print("Sender cleanup complete.")
+        log.info("Sender cleanup complete.")
+        ringlog.flush()
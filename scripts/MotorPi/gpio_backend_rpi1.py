@@ -0,0 +1,197 @@
+import mmap
+import os
+import threading
+from abc import ABC, abstractmethod
+
+import ringlog
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+log = ringlog.get_logger('motors')
+
+
+def _mask(pins):
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+class GpioBackend(ABC):
+    """Output GPIOs with a shadow of their levels, written as set/clear masks
+
+    ``write_masks`` only passes on the pins whose level changes, the rest
+    is elided, and sets and clears all of them in one hardware write.
+    Counters: writes (pin levels written), elided (pin writes skipped) and
+    flushes (hardware writes). Pins driven by something else, e.g. pigpio
+    waves, must be ``invalidate``d before the shadow is trusted again.
+    """
+
+    def __init__(self):
+        self.levels = 0  # pins that are high
+        self.known = 0   # pins whose level is in levels
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.elided = 0
+        self.flushes = 0
+
+    @abstractmethod
+    def setup_output(self, pins):
+        """Make pins outputs and put what is known of their levels into the shadow"""
+
+    @abstractmethod
+    def _flush(self, set_mask, clear_mask):
+        """Write the changed pins to the hardware, set_mask high and clear_mask low"""
+
+    def write_masks(self, set_mask, clear_mask):
+        """Set the BCM pins in set_mask high and those in clear_mask low"""
+        with self._lock:
+            set_change = set_mask & ~(self.levels & self.known)
+            clear_change = clear_mask & (self.levels | ~self.known)
+            changed = bin(set_change | clear_change).count('1')
+            self.elided += bin(set_mask | clear_mask).count('1') - changed
+            if not changed:
+                return
+            self._flush(set_change, clear_change)
+            self.levels = (self.levels | set_change) & ~clear_change
+            self.known |= set_change | clear_change
+            self.writes += changed
+            self.flushes += 1
+
+    def write(self, pins, values):
+        """RPi.GPIO.output style: one pin and value, or sequences of both"""
+        if isinstance(pins, int):
+            pins, values = (pins,), (values,)
+        set_mask = clear_mask = 0
+        for pin, value in zip(pins, values):
+            if value:
+                set_mask |= 1 << pin
+            else:
+                clear_mask |= 1 << pin
+        self.write_masks(set_mask, clear_mask)
+
+    def invalidate(self, pins):
+        with self._lock:
+            self.known &= ~_mask(pins)
+
+    def close(self):
+        pass
+
+
+class RPiGpioBackend(GpioBackend):
+    """RPi.GPIO, one GPIO.output call with all changed pins per write"""
+
+    def __init__(self):
+        super().__init__()
+        if GPIO is None:
+            raise RuntimeError("RPi.GPIO is not installed")
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def setup_output(self, pins):
+        GPIO.setup(list(pins), GPIO.OUT)
+        # setup leaves the level as it was, the next write goes through
+        self.invalidate(pins)
+
+    def _flush(self, set_mask, clear_mask):
+        channels = [pin for pin in range((set_mask | clear_mask).bit_length()) if (set_mask | clear_mask) >> pin & 1]
+        GPIO.output(channels, [set_mask >> pin & 1 for pin in channels])
+
+
+# SoCs with the BCM2835 GPIO register layout, as named in the device tree.
+# The Pi 5 (bcm2712) has its header GPIOs on the RP1 chip instead.
+BCM_GPIO_SOCS = ('brcm,bcm2835', 'brcm,bcm2836', 'brcm,bcm2837', 'brcm,bcm2711')
+
+
+class MmapGpioBackend(GpioBackend):
+    """The BCM283x GPIO registers through /dev/gpiomem, no system call per write
+
+    A write is one 32-bit store to GPSET0 and one to GPCLR0. Only bank 0
+    (GPIO 0-31) is supported, which holds every pin of the header. Raises
+    OSError on a board whose device tree names none of BCM_GPIO_SOCS.
+    """
+
+    GPFSEL0 = 0x00 // 4
+    GPSET0 = 0x1C // 4
+    GPCLR0 = 0x28 // 4
+    GPLEV0 = 0x34 // 4
+
+    def __init__(self, path='/dev/gpiomem', compatible='/proc/device-tree/compatible'):
+        super().__init__()
+        with open(compatible, 'rb') as device_tree:
+            socs = device_tree.read().decode('ascii', 'replace').split('\0')
+        if not set(socs) & set(BCM_GPIO_SOCS):
+            raise OSError(f"GPIO registers of {', '.join(filter(None, socs))} are not BCM283x ones")
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self._map = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        # Word access, the registers must not be written byte by byte
+        self._registers = memoryview(self._map).cast('I')
+
+    def setup_output(self, pins):
+        for pin in pins:
+            if pin > 31:
+                raise ValueError(f"GPIO {pin} is not in bank 0")
+            register, shift = self.GPFSEL0 + pin // 10, (pin % 10) * 3
+            self._registers[register] = self._registers[register] & ~(7 << shift) | 1 << shift
+        with self._lock:
+            mask = _mask(pins)
+            self.levels = self.levels & ~mask | self._registers[self.GPLEV0] & mask
+            self.known |= mask
+
+    def _flush(self, set_mask, clear_mask):
+        if set_mask:
+            self._registers[self.GPSET0] = set_mask
+        if clear_mask:
+            self._registers[self.GPCLR0] = clear_mask
+
+    def invalidate(self, pins):
+        # The level register tells the truth, nothing has to be forgotten
+        with self._lock:
+            mask = _mask(pins)
+            self.levels = self.levels & ~mask | self._registers[self.GPLEV0] & mask
+
+    def close(self):
+        self._registers.release()
+        self._map.close()
+
+
+class FakeGpioBackend(GpioBackend):
+    """Pure software pins for tests, history holds every (set_mask, clear_mask) flushed"""
+
+    def __init__(self):
+        super().__init__()
+        self.outputs = 0
+        self.history = []
+
+    def setup_output(self, pins):
+        self.outputs |= _mask(pins)
+        with self._lock:
+            self.known |= _mask(pins)
+
+    def _flush(self, set_mask, clear_mask):
+        self.history.append((set_mask, clear_mask))
+
+    def level(self, pin):
+        return self.levels >> pin & 1
+
+
+def make_gpio_backend(name):
+    """GpioBackend by name: "mmap" (falls back to "rpigpio"), "rpigpio" or "fake" """
+    if name == "mmap":
+        try:
+            return MmapGpioBackend()
+        except OSError as e:
+            log.warning("Cannot map the GPIO registers (%s), using RPi.GPIO", e)
+            name = "rpigpio"
+    if name == "rpigpio":
+        return RPiGpioBackend()
+    if name == "fake":
+        return FakeGpioBackend()
+    raise ValueError(f"unknown GPIO backend {name!r}")
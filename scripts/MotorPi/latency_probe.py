@@ -0,0 +1,223 @@
+import json
+import struct
+import threading
+import time
+from collections import deque
+
+import ringlog
+
+log = ringlog.get_logger('probe')
+
+# The Controller Pi sends probes inside joystick/all payloads (see
+# payload_codec.encode_joystick_probe), the Motor Pi answers on ECHO_TOPIC
+# once its control loop picked the position up, and the Controller Pi
+# publishes the retained summary on REPORT_TOPIC for the display
+ECHO_TOPIC = "joystick/probe_echo"
+REPORT_TOPIC = "joystick/latency"
+
+# id, probe id, Controller send time, Motor Pi receive time, Motor Pi act time
+SCHEMA_PROBE_ECHO_V1 = 0x23
+PROBE_ECHO_V1 = struct.Struct('<BIddd')
+
+
+def encode_echo(probe, sent, received, acted):
+    return PROBE_ECHO_V1.pack(SCHEMA_PROBE_ECHO_V1, probe, sent, received, acted)
+
+
+def decode_echo(payload):
+    """(probe, sent, received, acted) of an echo, raises ValueError if invalid"""
+    if len(payload) != PROBE_ECHO_V1.size or payload[0] != SCHEMA_PROBE_ECHO_V1:
+        raise ValueError(f"not a probe echo ({len(payload)} bytes)")
+    return PROBE_ECHO_V1.unpack(payload)[1:]
+
+
+class LatencyHistogram:
+    """Log-linear histogram of latencies in microseconds, in the manner of HdrHistogram
+
+    Values below 2**precision_bits microseconds are counted exactly, above
+    that every power of two is split into 2**(precision_bits - 1) buckets,
+    so a recorded value is off by less than 1% at the default precision.
+    Recording is a few integer operations and memory is fixed.
+    """
+
+    def __init__(self, highest_us=60_000_000, precision_bits=8):
+        self.precision_bits = precision_bits
+        self.highest_us = highest_us
+        self.counts = [0] * (self._index(highest_us) + 1)
+        self.total = 0
+        self.sum_us = 0
+        self.min_us = None
+        self.max_us = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision_bits
+        if shift <= 0:
+            return value
+        return (shift << (self.precision_bits - 1)) + (value >> shift)
+
+    def _highest_equivalent(self, index):
+        half = 1 << (self.precision_bits - 1)
+        if index < 2 * half:
+            return index
+        shift = index // half - 1
+        return ((index - shift * half) << shift) + (1 << shift) - 1
+
+    def record(self, seconds):
+        """Count one latency, negative ones as 0 and long ones as highest_us"""
+        value = min(max(int(seconds * 1e6), 0), self.highest_us)
+        self.counts[self._index(value)] += 1
+        self.total += 1
+        self.sum_us += value
+        self.min_us = value if self.min_us is None else min(self.min_us, value)
+        self.max_us = value if self.max_us is None else max(self.max_us, value)
+
+    def percentile(self, p):
+        """Latency in seconds that p percent of the recorded ones do not exceed"""
+        if not self.total:
+            return None
+        wanted = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._highest_equivalent(index), self.max_us) / 1e6
+        return self.max_us / 1e6
+
+    def summary(self):
+        """Count, mean, min, max and percentiles in milliseconds"""
+        if not self.total:
+            return {'count': 0}
+        result = {
+            'count': self.total,
+            'mean_ms': round(self.sum_us / self.total / 1000, 3),
+            'min_ms': self.min_us / 1000,
+            'max_ms': self.max_us / 1000,
+        }
+        for p in (50, 90, 99, 99.9):
+            result[f'p{p:g}_ms'] = round(self.percentile(p) * 1000, 3)
+        return result
+
+
+class ClockOffset:
+    """NTP style estimate of how far the Motor Pi's clock is ahead of ours
+
+    Each echo gives offset ((t2 - t1) + (t3 - t4)) / 2 and network delay
+    (t4 - t1) - (t3 - t2). The offset of the sample with the smallest
+    delay among the last window ones is the least disturbed by queueing.
+    """
+
+    def __init__(self, window=64):
+        self.samples = deque(maxlen=window)
+
+    def update(self, t1, t2, t3, t4):
+        delay = (t4 - t1) - (t3 - t2)
+        self.samples.append((delay, ((t2 - t1) + (t3 - t4)) / 2))
+
+    @property
+    def offset(self):
+        if not self.samples:
+            return None
+        return min(self.samples)[1]
+
+
+class LatencyProbe:
+    """Controller Pi side: sends probes and measures their echoes
+
+    round_trip is the time from sending a probe until its echo arrives,
+    one_way the time until the Motor Pi acted on it, corrected by the
+    estimated clock offset. A probe without echo after lost_after seconds
+    counts as lost.
+    """
+
+    def __init__(self, interval=0.2, lost_after=10.0):
+        self.interval = interval
+        self.lost_after = lost_after
+        self.round_trip = LatencyHistogram()
+        self.one_way = LatencyHistogram()
+        self.clock = ClockOffset()
+
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._next_id = 1
+        self._last_sent = None
+
+        self.sent = 0
+        self.echoed = 0
+        self.lost = 0
+
+    def due(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self._last_sent is None or now - self._last_sent >= self.interval
+
+    def next_probe(self):
+        """Id and send time of a new probe, to be put into the joystick payload"""
+        self._last_sent = time.monotonic()
+        sent = time.time()
+        with self._lock:
+            probe = self._next_id
+            self._next_id = (self._next_id + 1) & 0xFFFFFFFF or 1
+            self._outstanding[probe] = sent
+            self.sent += 1
+            self._expire(sent)
+        return probe, sent
+
+    def _expire(self, now):
+        for probe, sent in list(self._outstanding.items()):
+            if now - sent > self.lost_after:
+                del self._outstanding[probe]
+                self.lost += 1
+
+    def on_echo(self, client, userdata, msg):
+        received = time.time()
+        try:
+            probe, sent, motor_received, acted = decode_echo(msg.payload)
+        except ValueError as e:
+            log.rate_limited(1.0, ringlog.WARNING, "Invalid probe echo: %s", e)
+            return
+
+        with self._lock:
+            # Echoes of an earlier run or of expired probes are not counted
+            if self._outstanding.pop(probe, None) != sent:
+                return
+            self.echoed += 1
+            self.clock.update(sent, motor_received, acted, received)
+            self.round_trip.record(received - sent)
+            self.one_way.record(acted - self.clock.offset - sent)
+        log.debug("Probe %d: round trip %.1f ms", probe, (received - sent) * 1000)
+
+    def report(self):
+        with self._lock:
+            offset = self.clock.offset
+            return {
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'interval': self.interval,
+                'sent': self.sent,
+                'echoed': self.echoed,
+                'lost': self.lost,
+                'clock_offset_ms': None if offset is None else round(offset * 1000, 3),
+                'round_trip': self.round_trip.summary(),
+                'one_way': self.one_way.summary(),
+            }
+
+    def save(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.report(), output, indent=2)
+            output.write('\n')
+
+
+class ProbeEcho:
+    """Motor Pi side: holds received probes until the control loop acts on them"""
+
+    def __init__(self):
+        self._pending = deque(maxlen=64)
+
+    def received(self, probe, sent):
+        self._pending.append((probe, sent, time.time()))
+
+    def echo(self, publisher):
+        """Answer every probe received so far, called where the joystick is acted on"""
+        while self._pending:
+            probe, sent, received = self._pending.popleft()
+            publisher.publish(ECHO_TOPIC, encode_echo(probe, sent, received, time.time()), qos=0,
+                              coalesce=False)
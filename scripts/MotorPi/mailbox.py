@@ -0,0 +1,51 @@
+import threading
+import time
+from collections import namedtuple
+
+# One delivered value: seq counts the values put into the mailbox,
+# received is the time.monotonic() of the put
+Letter = namedtuple('Letter', ['value', 'seq', 'received'])
+
+
+class LatestValueMailbox:
+    """Holds only the newest value, stamped with a sequence number and receive time
+
+    ``put`` replaces the letter with one reference assignment, so ``get``
+    never takes a lock and never sees a half written value. Consumers that
+    have nothing else to do can ``wait`` for a letter newer than the one
+    they last handled instead of polling. ``fresh`` hides a letter that is
+    older than stale_after seconds, so a sender that went away reads as no
+    input at all.
+    """
+
+    def __init__(self, stale_after=None):
+        self.stale_after = stale_after
+        self._letter = None
+        self._seq = 0
+        self._arrived = threading.Condition()
+
+    def put(self, value):
+        """Deliver a value, called from the receiving thread"""
+        self._seq += 1
+        self._letter = Letter(value, self._seq, time.monotonic())
+        with self._arrived:
+            self._arrived.notify_all()
+
+    def get(self):
+        """The newest letter, or None if nothing was put yet"""
+        return self._letter
+
+    def fresh(self, now=None):
+        """The newest letter if it is not older than stale_after, else None"""
+        letter = self._letter
+        if letter is None or self.stale_after is None:
+            return letter
+        if now is None:
+            now = time.monotonic()
+        return letter if now - letter.received <= self.stale_after else None
+
+    def wait(self, seq, timeout=None):
+        """Wait up to timeout seconds for a letter newer than seq and return the newest letter"""
+        with self._arrived:
+            self._arrived.wait_for(lambda: self._letter is not None and self._letter.seq > seq, timeout)
+        return self._letter
@@ -0,0 +1,218 @@
+import asyncio
+import socket
+
+import paho.mqtt.client as mqtt
+from StepperMotors_rpi1 import Motors
+from motion_controller_rpi1 import MotionController
+from pulse_backend_rpi1 import make_backend
+from gpio_backend_rpi1 import make_gpio_backend
+import mqttJoystickReceive as Receiver
+import main_rpi1 as motor_pi
+from mqtt_connection import MqttConnection
+import ringlog
+
+log = ringlog.get_logger('main')
+
+
+class AsyncSerialReader:
+    """Feed serial frames to a callback whenever a board's tty fd becomes readable"""
+
+    def __init__(self, loop, fanin, on_frames):
+        self.loop = loop
+        self.fanin = fanin
+        self.on_frames = on_frames
+        self.fds = {}
+
+    def start(self):
+        for source, (ser, _) in self.fanin.devices.items():
+            self.fds[source] = ser.fileno()
+            self.loop.add_reader(self.fds[source], self._on_readable, source)
+
+    def stop(self):
+        for fd in self.fds.values():
+            self.loop.remove_reader(fd)
+        self.fds = {}
+
+    def _on_readable(self, source):
+        # The fd is readable, so this returns without waiting for the timeout
+        frames = self.fanin.read(source)
+        if source not in self.fanin.devices:
+            # The board failed and was dropped by the fan-in
+            self.loop.remove_reader(self.fds.pop(source))
+        if frames:
+            self.on_frames(frames)
+
+
+class AsyncMqttAdapter:
+    """Drive a paho client from the asyncio loop instead of loop_start() threads
+
+    Without paho's loop thread nothing reconnects on its own, so ``connect``
+    retries with exponential backoff and runs again whenever the socket
+    closes until ``close`` is called.
+    """
+
+    def __init__(self, loop, client, min_delay=1, max_delay=60):
+        self.loop = loop
+        self.client = client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.misc = None
+        self.connecting = None
+        self.closing = False
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+        if not self.closing:
+            self.start_connecting()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def start_connecting(self):
+        if self.connecting is None or self.connecting.done():
+            self.connecting = self.loop.create_task(self.connect())
+
+    async def connect(self):
+        delay = self.min_delay
+        while not self.closing:
+            try:
+                self.client.reconnect()
+                return
+            except OSError as e:
+                log.warning("MQTT connection failed: %s, retrying in %ss", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_delay)
+
+    def close(self):
+        self.closing = True
+        if self.connecting is not None:
+            self.connecting.cancel()
+        self.client.disconnect()
+
+    async def misc_loop(self):
+        # Keepalive pings and retries, paho only needs this about once a second
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class MotorPiRuntime:
+    """Serial ingestion, MQTT and motion of the Motor Pi on one event loop
+
+    Nothing polls: serial frames and joystick messages arrive through fd
+    callbacks and wake the motion task through an event. The motion task
+    only updates the setpoint of the MotionController, whose thread steps
+    the motors, so the event loop never waits for a move.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.receiver = Receiver.MqttJoystickReceive(stale_after=motor_pi.joystick_stale_after)
+        self.gpio = make_gpio_backend(motor_pi.gpio_backend)
+        self.stepper_motors = Motors(backend=make_backend(motor_pi.pulse_backend, self.gpio.write_masks),
+                                     gpio=self.gpio)
+        self.motion = MotionController(self.stepper_motors)
+        self.motion_wakeup = asyncio.Event()
+
+        self.connection = MqttConnection(
+            "sensor_publisher", use_v5=motor_pi.mqtt_v5, message_expiry=motor_pi.message_expiry,
+            queue_size=motor_pi.publish_queue_size, drop_policy=motor_pi.publish_drop_policy)
+        self.connection.connect_handlers.append(motor_pi.on_connect)
+        for topic, qos in self.receiver.topics:
+            self.connection.subscribe(topic, qos, self.on_message)
+        self.client = self.connection.client
+        self.publisher = self.connection.publisher
+        self.publisher.on_idle = lambda: motor_pi.backlog.forward(self.publisher)
+        self.mqtt_adapter = AsyncMqttAdapter(loop, self.client, motor_pi.reconnect_min_delay,
+                                             motor_pi.reconnect_max_delay)
+
+        self.serial_reader = AsyncSerialReader(loop, motor_pi.fanin, self.on_frames)
+
+    def on_message(self, client, userdata, msg):
+        self.receiver.on_message(client, userdata, msg)
+        self.motion_wakeup.set()
+
+    def on_frames(self, frames):
+        motor_pi.process_frames(frames)
+        motor_pi.publish_sensor_data(self.publisher)
+
+        if motor_pi.obstacle_ahead() and not self.motion.remaining:
+            log.debug("Obstacle ahead, backing off")
+            self.motion.drive('backward', motor_pi.move_steps)
+
+    def steer(self):
+        """Update the motion setpoint from the current joystick position"""
+        x, y = self.receiver.position()
+        self.receiver.probes.echo(self.publisher)
+        direction = motor_pi.joystick_direction(x, y)
+        log.rate_limited(1.0, ringlog.DEBUG, "Joystick %s", direction or "neutral")
+        motor_pi.steer(self.motion, direction)
+
+    async def motion_task(self):
+        self.motion.start()
+        while True:
+            self.steer()
+            # The last snapshot the rate limit held back
+            motor_pi.publish_snapshot(self.publisher, motor_pi.snapshot_limit.due())
+            # Woken by every joystick message, the timeout notices stale input
+            try:
+                await asyncio.wait_for(self.motion_wakeup.wait(), motor_pi.serial_poll_timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.motion_wakeup.clear()
+
+    async def run(self):
+        log.info("Connecting to broker: %s:%s", motor_pi.broker_address, motor_pi.broker_port)
+        self.connection.connect(motor_pi.broker_address, motor_pi.broker_port, 60, start_loop=False)
+        self.mqtt_adapter.start_connecting()
+        self.serial_reader.start()
+
+        try:
+            await self.motion_task()
+        finally:
+            self.serial_reader.stop()
+            self.mqtt_adapter.close()
+            self.motion.close()
+            self.gpio.close()
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runtime = MotorPiRuntime(loop)
+    task = loop.create_task(runtime.run())
+
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        log.info("Program stopped by user")
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+    finally:
+        motor_pi.fanin.close()
+        log.info("Serial ports closed")
+        motor_pi.backlog.close()
+        loop.close()
+        log.info("MQTT connection closed")
+        ringlog.flush()
+
+
+if __name__ == "__main__":
+    main()
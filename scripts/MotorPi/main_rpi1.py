@@ -1,26 +1,125 @@
+import os
 import time
-import serial
-import json
-import paho.mqtt.client as mqtt
 from StepperMotors_rpi1 import Motors
+from motion_controller_rpi1 import MotionController
+from pulse_backend_rpi1 import make_backend
+from gpio_backend_rpi1 import make_gpio_backend
 import mqttJoystickReceive as Receiver
-
-# Set up serial connection
-ser = serial.Serial(
-    port='/dev/ttyACM0',
-    baudrate=9600,
-    timeout=1
-)
+from serial_stream import SerialFrameAssembler
+from serial_binary import BinaryFrameDecoder, negotiate_binary
+from sensor_schema import SENSOR_SCHEMA, compile_schema
+from serial_fanin import SerialFanIn, capture_wall_time, open_serial_devices
+from publish_filter import ChangeFilter, RateLimit
+from payload_codec import encode_sensors, encode_json
+from publish_queue import DROP_OLDEST
+from mqtt_connection import MqttConnection
+from store_forward import StoreForward
+from synthetic_source import SyntheticSensors, SyntheticSerial
+import ringlog
+
+# LOG_LEVELS=debug shows every frame and publish
+log = ringlog.get_logger('main')
+
+# Serial ports of the sensor boards, frames from all of them are merged
+# SENSOR_SERIAL_PORTS overrides them, e.g. with the pty of serial_capture.py replay
+serial_ports = os.environ.get('SENSOR_SERIAL_PORTS', '/dev/ttyACM0').split(',')
+
+# "text" reads the key=value lines, "binary" switches the Uno to CRC-checked
+# frames at binary_baudrate and falls back to text if the board does not answer
+serial_protocol = "text"
+binary_baudrate = 115200
+
+# How long one poll waits for the boards, so the joystick is still checked
+# between sensor frames. The sync loop waits on the joystick instead and
+# reads the boards at least this often.
+serial_poll_timeout = 0.05
+
+# Joystick input older than this counts as neutral, so the robot stops
+# within joystick_stale_after seconds when the Controller Pi goes away
+joystick_stale_after = 1.0
+
+
+def make_assembler(ser):
+    """Frame assembler for one board, binary if configured and the board agrees"""
+    if serial_protocol == "binary":
+        time.sleep(2)  # the Uno resets when the port is opened
+        if negotiate_binary(ser, binary_baudrate):
+            log.info("Serial protocol on %s: binary at %d baud", ser.name, binary_baudrate)
+            return BinaryFrameDecoder()
+
+    # Keeps partial lines between reads, a frame ends with the sens_photo line
+    return SerialFrameAssembler(end_key='sens_photo')
+
+
+# "serial" reads the boards and fails without one, "synthetic" streams seeded
+# synthetic readings instead. The motors then default to the simulated pulse
+# and fake GPIO backends and synthetic obstacles never trigger a back-off.
+# SYNTHETIC_RATE_HZ raises the rate for load tests.
+sensor_source = os.environ.get('SENSOR_SOURCE', 'serial')
+synthetic_seed = int(os.environ.get('SYNTHETIC_SEED', 0))
+synthetic_rate_hz = float(os.environ.get('SYNTHETIC_RATE_HZ', 1))
+
+# Set up serial connections
+fanin = SerialFanIn()
+if sensor_source == 'synthetic':
+    synthetic = SyntheticSerial(SyntheticSensors(seed=synthetic_seed), rate_hz=synthetic_rate_hz)
+    log.warning("SENSOR_SOURCE=synthetic, using synthetic data at %s Hz", synthetic_rate_hz)
+    fanin.add(synthetic.name, synthetic, SerialFrameAssembler(end_key=synthetic.source.end_key))
+elif sensor_source == 'serial':
+    for port, ser in open_serial_devices(serial_ports).items():
+        fanin.add(port, ser, make_assembler(ser))
+    if not fanin.devices:
+        raise RuntimeError(f"No serial port of {serial_ports} available, "
+                           f"SENSOR_SOURCE=synthetic runs without a board")
+else:
+    raise ValueError(f"unknown sensor source {sensor_source!r}")
+
+# Decoder compiled once from the schema, one converter lookup per line
+sensor_decoder = compile_schema(SENSOR_SCHEMA)
 
 # Dictionary to store the sensor values
-sensor_data = {
-    'sens_photo': 0,
-    'sens_humid': 0.0,
-    'sens_temp': 0.0,
-    'sens_lux': 0.0,
-    'sens_range': 0,
-    'led_red': False
-}
+sensor_data = sensor_decoder.defaults()
+
+# Serial port that delivered the current value of each key
+sensor_sources = {}
+
+# Sequence number and monotonic capture time of the newest frame
+sensor_meta = {'seq': -1, 'captured': time.monotonic(), 'pub_seq': 0}
+
+# Only values that moved by more than their deadband are published, each key
+# is republished at least every publish_max_interval seconds as a heartbeat
+publish_max_interval = 5.0
+publish_filter = ChangeFilter(sensor_decoder.deadbands(), max_interval=publish_max_interval,
+                              sentinels=sensor_decoder.sentinels())
+
+# "binary" sends the compact payload_codec layout on the aggregate topic,
+# "json" the previous JSON. Per-key topics are only kept for old subscribers.
+payload_format = "binary"
+publish_per_key = False
+
+# At most publish_queue_size messages wait for a slow or absent broker,
+# beyond that publish_drop_policy decides which ones are lost
+publish_queue_size = 64
+publish_drop_policy = DROP_OLDEST
+
+# Sensor data published while the broker is unreachable is kept in a ring
+# file and forwarded once it is back; reconnects back off exponentially
+backlog_path = os.environ.get('SENSOR_BACKLOG_PATH', '/var/tmp/main_rpi1.backlog')
+backlog = StoreForward(backlog_path)
+reconnect_min_delay = 1
+reconnect_max_delay = 60
+
+# MQTT 5 (mosquitto 1.6 or newer) sends topic aliases instead of the full
+# topic and lets the broker drop sensor data older than its expiry
+mqtt_v5 = False
+message_expiry = {"sensors/all": 5}
+
+# Retained copy of sensors/all that subscribers receive right after
+# subscribing, updated at most snapshot_max_rate times per second. A state
+# held back by the limit is published when its interval ends
+snapshot_topic = "sensors/snapshot"
+snapshot_max_rate = 2
+snapshot_limit = RateLimit(snapshot_max_rate)
 
 
 def on_connect(client, userdata, flags, rc):
@@ -33,12 +132,7 @@ def on_connect(client, userdata, flags, rc):
         4: "Connection refused - bad username or password",
         5: "Connection refused - not authorised"
     }
-    print(f"Connected with result code {rc}: {connection_codes.get(rc, 'Unknown')}")
-
-
-def on_publish(client, userdata, mid):
-    """Callback for when a message is published"""
-    print(f"Message published with id: {mid}")
+    log.info("Connected with result code %s: %s", rc, connection_codes.get(rc, 'Unknown'))
 
 
 # MQTT broker details
@@ -46,120 +140,198 @@ broker_address = "localhost"
 broker_port = 1883
 base_topic = "sensors"  # Base topic for all sensor data
 
+# Joystick thresholds and obstacle distance that trigger a move. x drives
+# forward and backward, y turns; x wins when both are deflected.
+joystick_forward_threshold = 700
+joystick_backward_threshold = 400
+joystick_right_threshold = 700
+joystick_left_threshold = 400
+obstacle_distance = 50
+move_steps = 100000
+
+# Step pulses are timed by the pigpio daemon's DMA engine ("pigpio", start it
+# with sudo pigpiod), by a Python thread ("software", also used when pigpiod
+# is not running) or only recorded ("simulated")
+pulse_backend = os.environ.get('PULSE_BACKEND', 'simulated' if sensor_source == 'synthetic' else 'pigpio')
+
+# Direction, enable and mode pins (and software step pulses) are written to
+# the GPIO registers through /dev/gpiomem ("mmap", RPi.GPIO if that cannot
+# be opened), through RPi.GPIO ("rpigpio") or only kept in memory ("fake")
+gpio_backend = os.environ.get('GPIO_BACKEND', 'fake' if sensor_source == 'synthetic' else 'mmap')
 
-def read_serial_data():
-    """Read data from serial port and update sensor_data dictionary"""
-    global sensor_data
 
-    ser.flushInput()
+def read_serial_data(timeout=serial_poll_timeout):
+    """Read data from the serial ports and update sensor_data dictionary"""
+    return process_frames(fanin.poll(timeout))
 
-    buffer = ""
-    start_time = time.time()
-    timeout = 2
 
-    while time.time() - start_time < timeout:
-        if ser.in_waiting > 0:
-            line = ser.readline().decode('utf-8').strip()
-            buffer += line + "\n"
+def process_frames(frames):
+    """Merge IngestedFrame tuples into sensor_data in order
 
-            if 'sens_photo' in line and len(buffer.strip()) > 10:
-                parse_sensor_data(buffer)
-                buffer = ""
-                return True
+    Returns True if there were any.
+    """
+    for seq, captured, source, frame in frames:
+        if isinstance(frame, dict):
+            # Binary frames arrive already decoded, only the checks are left
+            values = sensor_decoder.validate(frame)
+            sensor_data.update(values)
+        else:
+            values = parse_sensor_data(frame)
+        sensor_sources.update(dict.fromkeys(values, source))
+        sensor_meta['seq'] = seq
+        sensor_meta['captured'] = captured
 
-    return False
+    return bool(frames)
 
 
 def parse_sensor_data(data_string):
     """Parse the received data string into the sensor_data dictionary"""
-    global sensor_data
-
-    # Process each line
-    for line in data_string.strip().split('\n'):
-        if '=' in line:
-            key, value = line.split('=', 1)
-            key = key.strip()
-            value = value.strip()
-
-            if key in sensor_data:
-                if key == 'led_red':
-                    sensor_data[key] = (value.lower() == 'true')
-                elif '.' in value:
-                    try:
-                        sensor_data[key] = float(value)
-                    except ValueError:
-                        print(f"Could not convert {value} to float for {key}")
-                else:
-                    try:
-                        sensor_data[key] = int(value)
-                    except ValueError:
-                        print(f"Could not convert {value} to int for {key}")
-
-
-def publish_sensor_data(mqtt_client):
-    """Publish sensor data to MQTT topics"""
-
-    for sensor, value in sensor_data.items():
+    # Malformed or out of range values are counted in sensor_decoder.errors
+    values = sensor_decoder.decode_frame(data_string)
+    sensor_data.update(values)
+    return values
+
+
+def obstacle_ahead():
+    """True if the range sensor sees something closer than obstacle_distance
+
+    Always False for synthetic data, its obstacles must not move the robot.
+    """
+    if sensor_source != 'serial':
+        return False
+    return sensor_data['sens_range'] < obstacle_distance and sensor_data['sens_range'] != -1
+
+
+def joystick_direction(x, y):
+    """Move requested by the stick position, None in the neutral zone"""
+    if x > joystick_forward_threshold:
+        return 'forward'
+    if x < joystick_backward_threshold:
+        return 'backward'
+    if y > joystick_right_threshold:
+        return 'right'
+    if y < joystick_left_threshold:
+        return 'left'
+    return None
+
+
+def steer(motion, direction):
+    """Point the motion controller in the joystick direction, None stops it
+
+    A back-off from an obstacle (a move with steps left) is finished first.
+    """
+    if motion.remaining:
+        return
+    if direction is None:
+        motion.stop()
+    else:
+        motion.drive(direction)
+
+
+def publish_snapshot(publisher, payload):
+    """Publish payload as the retained sensor snapshot, nothing for None"""
+    if payload is not None:
+        publisher.publish(snapshot_topic, payload, qos=0, retain=True)
+
+
+def publish_sensor_data(publisher):
+    """Publish the sensor values that changed to MQTT topics"""
+    changes = publish_filter.changes(sensor_data)
+    if not changes:
+        return
+
+    # Publish all sensor data as one payload to a single topic with the
+    # sequence number and capture time of the newest frame. pub_seq counts
+    # these messages, so subscribers can tell skipped frames from lost ones.
+    sensor_meta['pub_seq'] += 1
+    encode = encode_sensors if payload_format == "binary" else encode_json
+    payload = encode(sensor_data, sensor_meta['seq'], sensor_meta['pub_seq'],
+                     capture_wall_time(sensor_meta['captured']))
+    if not publisher.client.is_connected():
+        # Kept on disk and forwarded to backlog/sensors/all after reconnecting
+        backlog.append(f"{base_topic}/all", payload)
+        return
+
+    log.debug("Publishing all sensor data to %s/all", base_topic)
+    publisher.publish(f"{base_topic}/all", payload, qos=0)
+    publish_snapshot(publisher, snapshot_limit.offer(payload))
+    backlog.forward(publisher)
+
+    if not publish_per_key:
+        return
+
+    # Compatibility mode: also publish the changed values to their own topics
+    for sensor, value in changes.items():
         topic = f"{base_topic}/{sensor}"
-        print(f"Publishing {sensor}: {value} to {topic}")
-        mqtt_client.publish(topic, str(value), qos=0)
+        log.debug("Publishing %s: %s to %s", sensor, value, topic)
+        publisher.publish(topic, str(value), qos=0)
 
 
 def main():
-    # Initialize MQTT receiver and start it in the background
-    receiver = Receiver.MqttJoystickReceive()
-    receiver.main()
-
-    # Initialize MQTT sender
-    mqtt_sender = mqtt.Client(client_id="sensor_publisher")
-    mqtt_sender.on_connect = on_connect
-    mqtt_sender.on_publish = on_publish
-
-    # Connect to MQTT broker
-    print(f"Connecting to broker: {broker_address}:{broker_port}")
-    mqtt_sender.connect(broker_address, broker_port, 60)
-    mqtt_sender.loop_start()
-
-    # Initialize stepper motors
-    stepper_motors = Motors()
+    # One connection for the joystick receiver and the sensor publisher
+    connection = MqttConnection("sensor_publisher", use_v5=mqtt_v5, message_expiry=message_expiry,
+                                min_delay=reconnect_min_delay, max_delay=reconnect_max_delay,
+                                queue_size=publish_queue_size, drop_policy=publish_drop_policy)
+    connection.connect_handlers.append(on_connect)
+    publisher = connection.publisher
+    publisher.on_idle = lambda: backlog.forward(publisher)
+
+    receiver = Receiver.MqttJoystickReceive(stale_after=joystick_stale_after)
+    receiver.attach(connection)
+
+    # Connect to MQTT broker, the loop keeps retrying while it is unreachable
+    log.info("Connecting to broker: %s:%s", broker_address, broker_port)
+    connection.connect(broker_address, broker_port, 60)
+
+    # Initialize stepper motors, they are stepped by the motion controller's
+    # thread, so this loop only ever changes the setpoint
+    gpio = make_gpio_backend(gpio_backend)
+    stepper_motors = Motors(backend=make_backend(pulse_backend, gpio.write_masks), gpio=gpio)
+    motion = MotionController(stepper_motors)
+    motion.start()
 
     time.sleep(1)
 
     try:
         while True:
-            # Read and process sensor data
-            if read_serial_data():
-                print("Parsed sensor data:")
-                for key, value in sensor_data.items():
-                    print(f"{key}: {value}")
+            # Read and process sensor data that has arrived, the loop waits
+            # on the joystick below
+            if read_serial_data(timeout=0):
+                log.debug("Parsed sensor data: %s", dict(sensor_data))
+
+                publish_sensor_data(publisher)
 
-                publish_sensor_data(mqtt_sender)
+                if obstacle_ahead() and not motion.remaining:
+                    log.debug("Obstacle ahead, backing off")
+                    motion.drive('backward', move_steps)
 
-                if sensor_data['sens_range'] < 50 and sensor_data['sens_range'] != -1:
-                    stepper_motors.run_both_motors_backward(100000)
-                print("\n")
+            # The last snapshot the rate limit held back
+            publish_snapshot(publisher, snapshot_limit.due())
 
-            print(f"Current joystick_x value: {receiver.joystick_x}")
+            letter = receiver.mailbox.get()
+            x, y = receiver.position()
+            receiver.probes.echo(publisher)
+            log.rate_limited(1.0, ringlog.DEBUG, "Current joystick value: %s, %s", x, y)
 
-            if receiver.joystick_x > 700:
-                print("Joystick forward")
-                stepper_motors.run_both_motors_forward(100000)
-            elif receiver.joystick_x < 400:
-                print("Joystick backward")
-                stepper_motors.run_both_motors_backward(100000)
-            else:
-                print("Joystick neutral")
+            direction = joystick_direction(x, y)
+            log.rate_limited(1.0, ringlog.DEBUG, "Joystick %s", direction or "neutral")
+            steer(motion, direction)
 
-            time.sleep(0.001)
+            # Sleep until the next joystick message, or until the boards are due
+            receiver.mailbox.wait(0 if letter is None else letter.seq, serial_poll_timeout)
 
     except KeyboardInterrupt:
-        print("Program stopped by user")
+        log.info("Program stopped by user")
     finally:
-        ser.close()
-        print("Serial port closed")
-        mqtt_sender.loop_stop()
-        mqtt_sender.disconnect()
-        print("MQTT connection closed")
+        motion.close()
+        log.info("GPIO: %d pin writes, %d elided, %d register writes", gpio.writes, gpio.elided, gpio.flushes)
+        gpio.close()
+        fanin.close()
+        log.info("Serial ports closed")
+        connection.close()
+        backlog.close()
+        log.info("MQTT connection closed")
+        ringlog.flush()
 
 
 if __name__ == "__main__":
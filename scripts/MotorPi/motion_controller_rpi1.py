@@ -0,0 +1,437 @@
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import CancelledError, Future
+
+import numpy as np
+
+from motion_profile_rpi1 import (blend_intervals, entry_limit, ramp_intervals, slowdown_intervals,
+                                 speedup_intervals)
+import ringlog
+
+log = ringlog.get_logger('motors')
+
+# Signed rate in steps/s of every driver and the steps left of the fastest
+# one, None for a move that runs until the setpoint changes
+Setpoint = namedtuple('Setpoint', ['rates', 'remaining'])
+
+# A queued or running move and the Future that completes when it was played
+Command = namedtuple('Command', ['setpoint', 'future'])
+
+# A waveform handed to the backend: monotonic time of each of its master
+# steps and their intervals, the number of its first master step in the
+# move, the axis ratios and the master cruise rate of the move
+Sent = namedtuple('Sent', ['times', 'intervals', 'start', 'ratios', 'rate'])
+
+# The deceleration of an aborted move: its step intervals, how many of them
+# were sent, then like Sent
+Braking = namedtuple('Braking', ['intervals', 'done', 'start', 'ratios', 'rate'])
+
+# How submit treats the moves that are queued or running: REPLACE cancels
+# them and starts at once, APPEND starts after them
+REPLACE = 'replace'
+APPEND = 'append'
+
+
+def _signs(rates):
+    return tuple(rate < 0 for rate in rates)
+
+
+class MotionController:
+    """One long-lived thread that steps the motors through a queue of moves
+
+    ``submit`` (and ``drive``, ``set_velocity``) return at once with a
+    Future. REPLACE aborts the queued output and starts the new move after
+    braking; APPEND queues it behind the others. ``cancel`` stops
+    everything. A move with steps runs that many steps of the fastest
+    motor and its Future completes once the last one was played; a move
+    without steps runs until the next command.
+
+    The thread turns the running move into waveforms of about chunk_time
+    seconds on the motors' SteppingEngine, keeps the pulse backend one
+    waveform ahead and sleeps while it plays. Every move follows the
+    motors' motion profile: it accelerates from rest and a bounded one
+    decelerates to rest at its last step. A move appended in the same
+    directions is blended in instead: the one before only slows down to
+    the speed the next one can take over at, which is its rate, what it can
+    still stop from, and for a change of the axis ratios what the axes can
+    jump by as if starting from rest. An unbounded move ended by an
+    appended one slows down to that speed first. An aborted move brakes
+    from the speed it has reached down the mirrored acceleration ramp, so
+    a stop or reversal at cruise speed takes the ramp's time (about 0.3 s)
+    instead of one step period but does not lose steps.
+
+    Futures of moves that were cancelled or replaced raise CancelledError.
+    """
+
+    def __init__(self, motors, rate=None, chunk_time=0.02):
+        self.motors = motors
+        self.engine = motors.engine
+        self.backend = motors.engine.backend
+        # Default cruise speed in steps per second, the one of Motors' moves
+        self.rate = rate or motors.max_rate
+        if self.rate > motors.max_rate:
+            raise ValueError(f"rate {self.rate} above the motors' max_rate {motors.max_rate}")
+        self.chunk_time = chunk_time
+
+        self._current = None     # running Command
+        self._setpoint = None    # its setpoint with the steps left to queue
+        self._queue = deque()    # Commands waiting behind it
+        self._played = []        # (deadline, Future) of fully queued moves
+        self._generation = 0     # changes when the output has to be aborted
+        self._changed = threading.Condition()
+        self._running = False
+        self._thread = None
+
+        self.steps = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="motion", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the motors, the thread and the backend"""
+        self.cancel()
+        with self._changed:
+            self._running = False
+            self._changed.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.backend.close()
+
+    def drive(self, direction, steps=None, rate=None, mode=REPLACE):
+        """Move in a Motors.DIRECTIONS direction, for steps steps or until the next command"""
+        rate = rate or self.rate
+        return self.set_velocity([sign * rate for sign in self.motors.signs(direction)], steps, mode)
+
+    def set_velocity(self, rates, steps=None, mode=REPLACE):
+        """Step every motor at its signed rate in steps per second, e.g. slower on the inside of a curve
+
+        steps counts the steps of the fastest motor. All rates 0 or no steps is a stop;
+        appended, it ends the moves ahead of it and completes once the motors stand.
+        Rates above the motors' max_rate raise ValueError, the drivers would stall.
+        """
+        fastest = max(abs(rate) for rate in rates)
+        if fastest > self.motors.max_rate:
+            raise ValueError(f"rate {fastest} above the motors' max_rate {self.motors.max_rate}")
+        if not any(rates) or steps == 0:
+            if mode == REPLACE:
+                self.cancel()
+                future = Future()
+                future.set_result(True)
+                return future
+            return self.submit(Setpoint((0,) * len(rates), 0), mode)
+        return self.submit(Setpoint(tuple(rates), steps), mode)
+
+    def submit(self, setpoint, mode=REPLACE):
+        """Queue a Setpoint as REPLACE or APPEND, returns its Future"""
+        with self._changed:
+            if mode == REPLACE:
+                # Repeating the running move, e.g. on every joystick message,
+                # must not restart its output
+                pending = [*self._queue] if self._current is None else [self._current, *self._queue]
+                if setpoint.remaining is None and len(pending) == 1 and pending[0].setpoint == setpoint:
+                    return pending[0].future
+                self._cancel_all()
+            elif mode != APPEND:
+                raise ValueError(f"unknown mode {mode!r}")
+
+            command = Command(setpoint, Future())
+            self._queue.append(command)
+            self._changed.notify()
+            return command.future
+
+    def stop(self):
+        self.cancel()
+
+    def cancel(self):
+        """Stop at once and cancel every queued and running move"""
+        with self._changed:
+            if not self.moving:
+                return
+            self._cancel_all()
+            self._changed.notify()
+
+    def _cancel_all(self):
+        for command in self._queue:
+            command.future.cancel()
+        self._queue.clear()
+        running = [future for _, future in self._played]
+        if self._current is not None:
+            running.append(self._current.future)
+        for future in running:
+            if not future.done():
+                future.set_exception(CancelledError())
+        self._current = self._setpoint = None
+        self._played = []
+        self._generation += 1
+
+    @property
+    def remaining(self):
+        """Steps left of a bounded move, None if idle or running until the next command"""
+        setpoint = self._setpoint
+        return None if setpoint is None else setpoint.remaining
+
+    @property
+    def moving(self):
+        return self._current is not None or bool(self._queue) or bool(self._played)
+
+    def _profile(self, setpoint, entry=0, exit=0):
+        """Step intervals of the rest of a bounded move, or of the ramp of an unbounded one
+
+        entry is the master speed in steps/s the move takes over at, exit the
+        one it hands over at, 0 for rest.
+        """
+        rate = max(abs(rate) for rate in setpoint.rates)
+        acceleration, jerk = self.motors.max_acceleration, self.motors.max_jerk
+        if setpoint.remaining is None:
+            return speedup_intervals(entry, rate, acceleration, jerk)
+        return blend_intervals(setpoint.remaining, entry, exit, rate, acceleration, jerk)
+
+    def _junction(self, setpoint, following, exit):
+        """Master speed at which setpoint can hand over to following, which itself ends at exit"""
+        if not any(following.rates) or _signs(setpoint.rates) != _signs(following.rates):
+            return 0
+        rate, next_rate = max(abs(rate) for rate in setpoint.rates), max(abs(rate) for rate in following.rates)
+        acceleration, jerk = self.motors.max_acceleration, self.motors.max_jerk
+        speed = min(rate, next_rate)
+        # Axes whose share of the master rate changes jump in speed, at most
+        # by the speed of the first step from rest
+        jump = max(abs(abs(a) / rate - abs(b) / next_rate) for a, b in zip(setpoint.rates, following.rates))
+        if jump:
+            speed = min(speed, 1 / ramp_intervals(next_rate, acceleration, jerk)[0] / jump)
+        if following.remaining is not None:
+            speed = min(speed, entry_limit(following.remaining, exit, next_rate, acceleration, jerk))
+        return speed
+
+    def _exit_speed(self, setpoint):
+        """Master speed at which setpoint can end given the queued moves behind it, 0 for rest"""
+        moves = [setpoint, *(command.setpoint for command in self._queue)]
+        exit = 0
+        for move, following in reversed(list(zip(moves, moves[1:]))):
+            exit = self._junction(move, following, exit)
+        return exit
+
+    def _chunk(self, profile, done, period, duration=None):
+        """Intervals of the next waveform from profile[done], about duration (by default chunk_time) seconds long"""
+        duration = duration or self.chunk_time
+        limit = self.backend.max_pulses // 2
+        if done < len(profile):
+            intervals = profile[done:done + limit]
+            return intervals[:np.searchsorted(np.cumsum(intervals), duration) + 1]
+        steps = min(limit, max(1, int(duration / period)))
+        return np.full(steps, period)
+
+    def _complete_played(self):
+        """Resolve the Futures of moves whose last step has been played, seconds until the next one"""
+        now = time.monotonic()
+        waiting = []
+        for deadline, future in self._played:
+            if deadline <= now:
+                future.set_result(True)
+            else:
+                waiting.append((deadline, future))
+        self._played = waiting
+        return min((deadline for deadline, _ in waiting), default=now + 3600) - now
+
+    def _brake(self, sent):
+        """Abort the queued output and start slowing down to rest from the speed playing now
+
+        sent holds the waveforms that may still be playing, afterwards the
+        first one of the deceleration. Returns the rest of it as Braking,
+        None if the motors stand.
+        """
+        while True:
+            now = time.monotonic()
+            while sent and sent[0].times[-1] <= now:
+                sent.popleft()
+            if not sent:
+                self.backend.stop()
+                return None
+
+            wave = sent[0]
+            played = int(np.searchsorted(wave.times, now, side='right'))
+            last = wave.times[played - 1] if played else wave.times[0] - wave.intervals[0]
+
+            # The ramp up to the move's rate, backwards from the first
+            # interval longer than the one playing
+            ramp = ramp_intervals(wave.rate, self.motors.max_acceleration, self.motors.max_jerk)
+            count = int(np.searchsorted(-ramp, -wave.intervals[played], side='left'))
+            if count:
+                # The first step follows the last one played, not the abort.
+                # The first waveform is short, so it is ready soon.
+                intervals = ramp[count - 1::-1].copy()
+                intervals[0] -= now - last
+                braking = Braking(intervals, 0, wave.start + played, wave.ratios, wave.rate)
+                first = self._chunk(intervals, 0, None, self.chunk_time / 4)
+                pulses = self.engine.pulses(wave.ratios, first, braking.start)
+
+            # The queued output plays on until it is stopped, a step played
+            # meanwhile would be stepped twice
+            if np.searchsorted(wave.times, time.monotonic(), side='right') == played:
+                break
+
+        self.backend.stop()
+        self.steps -= sum(len(other.times) for other in sent) - played
+        sent.clear()
+        if not count:
+            return None
+        log.debug("braking over %d steps", count)
+        lag = int((time.monotonic() - now) * 1e6)
+        pulses[0] = pulses[0]._replace(delay_us=max(1, pulses[0].delay_us - lag))
+        self._send(sent, wave.ratios, first, braking.start, wave.rate, pulses)
+        return braking._replace(done=len(first)) if len(first) < count else None
+
+    def _send_braking(self, sent, braking):
+        """Send the next waveform of the deceleration, returns the rest or None"""
+        intervals = self._chunk(braking.intervals, braking.done, None)
+        self._send(sent, braking.ratios, intervals, braking.start + braking.done, braking.rate)
+        done = braking.done + len(intervals)
+        return braking._replace(done=done) if done < len(braking.intervals) else None
+
+    def _send(self, sent, ratios, intervals, start, rate, pulses=None):
+        """Hand a waveform (by default the pulses of intervals) to the backend and remember when its steps play"""
+        self.backend.send(pulses or self.engine.pulses(ratios, intervals, start))
+        self.steps += len(intervals)
+        end = time.monotonic() + self.backend.pending()
+        times = np.cumsum(intervals)
+        sent.append(Sent(end - times[-1] + times, intervals, start, ratios, rate))
+
+    def _next_command(self, directions):
+        """Make the first queued move the running one, False if it has to wait for the output to drain"""
+        command = self._queue[0]
+        if not any(command.setpoint.rates):
+            # A stop only waits for what is queued before it
+            self._queue.popleft()
+            if command.future.set_running_or_notify_cancel():
+                self._played.append((time.monotonic() + self.backend.pending(), command.future))
+            return True
+        if directions is not None and _signs(command.setpoint.rates) != directions and self.backend.pending():
+            # The direction pins must not change under steps still playing
+            return False
+        self._queue.popleft()
+        if not command.future.set_running_or_notify_cancel():
+            return True
+        self._current, self._setpoint = command, command.setpoint
+        return True
+
+    def _run(self):
+        output = None      # generation whose steps the backend is playing
+        directions = None  # direction signs of the steps queued last
+        moving = False
+        running = None     # Command whose waveform is being built
+        profile, ratios, master, period, done = None, None, None, None, 0
+        planned_at = 0     # master step of the move that plays profile[0]
+        planned = None     # length of the queue the profile's exit was planned for
+        exit = 0           # master speed the profile ends at
+        speed = 0          # master speed of the last step queued, 0 at rest
+        sent = deque()     # waveforms that may still be playing
+        braking = None     # rest of the deceleration of an aborted move
+
+        while True:
+            with self._changed:
+                if self._generation != output:
+                    # Replaced or cancelled: brake instead of the queued
+                    # output, the directions stay until it has played
+                    output = self._generation
+                    running = None
+                    braking = self._brake(sent)
+                    speed = 0
+                    if not self.backend.pending():
+                        directions = None
+                next_completion = self._complete_played()
+
+                if braking is not None:
+                    # Queued moves wait until the whole deceleration is sent
+                    if self.backend.ready():
+                        braking = self._send_braking(sent, braking)
+                    else:
+                        self._changed.wait(max(self.backend.pending() - self.chunk_time, 0.001))
+                    continue
+                if not self._running:
+                    break
+
+                current = self._current
+                if current is not None and self._queue and self._setpoint.remaining is None:
+                    # An unbounded move ends with the next command, after
+                    # slowing down to the speed that one takes over at
+                    exit = self._exit_speed(current.setpoint)
+                    slowdown = slowdown_intervals(speed, exit, master, self.motors.max_acceleration,
+                                                  self.motors.max_jerk) if running is current else ()
+                    if len(slowdown):
+                        profile, planned_at, planned = slowdown, done, len(self._queue)
+                        self._setpoint = self._setpoint._replace(remaining=len(slowdown))
+                    else:
+                        current.future.set_result(True)
+                        self._current = self._setpoint = current = None
+                elif current is not None and self._queue and self._setpoint.remaining == 0:
+                    # A bounded one waits for it once all of its steps are queued
+                    self._current = self._setpoint = current = None
+                if current is None and self._queue:
+                    if not self._next_command(directions):
+                        self._changed.wait(self.backend.pending())
+                    continue
+
+                if current is None or self._setpoint.remaining == 0:
+                    if current is not None:
+                        self._current = self._setpoint = None
+                    if moving and not self.backend.pending() and not self._played:
+                        log.debug("motion stopped after %d steps", self.steps)
+                        self.engine.disable()
+                        moving = False
+                        directions = None
+                    self._changed.wait(min(next_completion, self.backend.pending() or next_completion))
+                    continue
+
+                if running is not current:
+                    running = current
+                    master = max(abs(rate) for rate in current.setpoint.rates)
+                    ratios = [abs(rate) / master for rate in current.setpoint.rates]
+                    period = 1 / master
+                    done = planned_at = 0
+                    # Taken over from the move before if it is still playing
+                    entry = min(speed, master) if self.backend.pending() else 0
+                    exit = 0 if current.setpoint.remaining is None else self._exit_speed(current.setpoint)
+                    planned = len(self._queue)
+                    profile = self._profile(current.setpoint, entry, exit)
+                elif self._setpoint.remaining and len(self._queue) != planned:
+                    # Moves were appended behind, the move may end faster
+                    planned = len(self._queue)
+                    if self._exit_speed(self._setpoint) != exit:
+                        exit = self._exit_speed(self._setpoint)
+                        profile, planned_at = self._profile(self._setpoint, speed, exit), done
+
+                if not self.backend.ready():
+                    # Wake up again before the queued waveform runs out
+                    self._changed.wait(min(next_completion, max(self.backend.pending() - self.chunk_time, 0.001)))
+                    continue
+
+                setpoint = self._setpoint
+                start = done
+                intervals = self._chunk(profile, done - planned_at, period)
+                done += len(intervals)
+                last = setpoint.remaining is not None and setpoint.remaining <= len(intervals)
+                if setpoint.remaining is not None:
+                    self._setpoint = setpoint._replace(remaining=max(0, setpoint.remaining - len(intervals)))
+
+                if not self.engine.set_directions(setpoint.rates):
+                    self._cancel_all()
+                    continue
+                if not moving:
+                    log.debug("motion %s", setpoint.rates)
+                    moving = True
+                directions = _signs(setpoint.rates)
+
+                # Sent under the lock, so a cancel cannot slip in between
+                self._send(sent, ratios, intervals, start, master)
+                while len(sent) > 3:
+                    sent.popleft()
+                speed = min(1 / intervals[-1], exit) if last else 1 / intervals[-1]
+                if last:
+                    self._played.append((time.monotonic() + self.backend.pending(), current.future))
+
+        # Let the braking finish before the drivers are disabled
+        time.sleep(self.backend.pending())
+        self.backend.stop()
+        self.engine.disable()
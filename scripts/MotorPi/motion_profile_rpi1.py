@@ -0,0 +1,160 @@
+from functools import lru_cache
+import math
+
+import numpy as np
+
+# Motion profiles in steps: v_max in steps/s, a_max in steps/s^2 and jerk in
+# steps/s^3, jerk None for a trapezoidal profile. Tables are intervals in
+# seconds between consecutive steps, read-only and cached per profile.
+
+# Time resolution of the S-curve integration, well below a step period
+_SAMPLES_PER_SECOND = 200000
+
+
+def _ramp_time(v, a_max, jerk):
+    """Jerk phase and constant acceleration phase durations to reach v from rest"""
+    if not jerk:
+        return 0.0, v / a_max
+    if v * jerk >= a_max * a_max:
+        jerk_time = a_max / jerk
+        return jerk_time, v / a_max - jerk_time
+    # a_max is never reached, the ramp is two jerk phases
+    return math.sqrt(v / jerk), 0.0
+
+
+def _ramp_distance(v, a_max, jerk):
+    jerk_time, accel_time = _ramp_time(v, a_max, jerk)
+    # The ramp is point symmetric, its mean velocity is v / 2
+    return v * (2 * jerk_time + accel_time) / 2
+
+
+def _peak_velocity(distance, v_max, a_max, jerk):
+    """Highest velocity a move of distance steps reaches while still stopping in time"""
+    if 2 * _ramp_distance(v_max, a_max, jerk) <= distance:
+        return v_max
+    low, high = 0.0, v_max
+    for _ in range(60):
+        middle = (low + high) / 2
+        if 2 * _ramp_distance(middle, a_max, jerk) <= distance:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def _ramp_velocity(t, v, a_max, jerk):
+    """Velocity at times t of the ramp from rest to v"""
+    jerk_time, accel_time = _ramp_time(v, a_max, jerk)
+    if not jerk_time:
+        return np.minimum(a_max * t, v)
+    a_peak = jerk * jerk_time
+    end = 2 * jerk_time + accel_time
+    v_jerk = a_peak * jerk_time / 2
+    return np.select(
+        [t < jerk_time, t < jerk_time + accel_time, t < end],
+        [jerk * t * t / 2,
+         v_jerk + a_peak * (t - jerk_time),
+         v - jerk * (end - t) ** 2 / 2],
+        v)
+
+
+def _ramp_times(x, v, a_max, jerk):
+    """Times at which the ramp from rest to v passes the positions x"""
+    if not jerk:
+        return np.sqrt(2 * x / a_max)
+    jerk_time, accel_time = _ramp_time(v, a_max, jerk)
+    duration = 2 * jerk_time + accel_time
+    # Only the ramp is integrated, a cruise is linear
+    t = np.linspace(0.0, duration, max(2, int(duration * _SAMPLES_PER_SECOND)))
+    velocity = _ramp_velocity(t, v, a_max, jerk)
+    s = np.concatenate(([0.0], np.cumsum((velocity[1:] + velocity[:-1]) / 2 * np.diff(t))))
+    return np.interp(x, s, t)
+
+
+def _step_times(distance, v_peak, a_max, jerk):
+    """Times at which the move passes the positions 1 .. distance"""
+    jerk_time, accel_time = _ramp_time(v_peak, a_max, jerk)
+    ramp = 2 * jerk_time + accel_time
+    ramp_distance = _ramp_distance(v_peak, a_max, jerk)
+    total = 2 * ramp + (distance - 2 * ramp_distance) / v_peak
+
+    k = np.arange(1, distance + 1, dtype=float)
+    accelerating = k <= ramp_distance
+    decelerating = k > distance - ramp_distance
+    times = ramp + (k - ramp_distance) / v_peak
+    times[accelerating] = _ramp_times(k[accelerating], v_peak, a_max, jerk)
+    times[decelerating] = total - _ramp_times(distance - k[decelerating], v_peak, a_max, jerk)
+    return times
+
+
+@lru_cache(maxsize=32)
+def step_intervals(distance, v_max, a_max, jerk=None):
+    """Intervals of a move of distance steps that starts and ends at rest"""
+    if distance <= 0:
+        return np.zeros(0)
+    v_peak = _peak_velocity(distance, v_max, a_max, jerk)
+    intervals = np.diff(_step_times(distance, v_peak, a_max, jerk), prepend=0.0)
+    # Never faster than v_max, whatever the rounding of the ramp
+    intervals = np.maximum(intervals, 1 / v_max)
+    intervals.setflags(write=False)
+    return intervals
+
+
+@lru_cache(maxsize=32)
+def ramp_intervals(v_max, a_max, jerk=None):
+    """Intervals of the ramp from rest to v_max, for moves without an end"""
+    steps = np.arange(1, math.floor(_ramp_distance(v_max, a_max, jerk)) + 1, dtype=float)
+    intervals = np.maximum(np.diff(_ramp_times(steps, v_max, a_max, jerk), prepend=0.0), 1 / v_max)
+    intervals.setflags(write=False)
+    return intervals
+
+
+def _ramp_index(ramp, v):
+    """Number of leading steps of a ramp table that are not faster than v"""
+    if v <= 0:
+        return 0
+    return int(np.searchsorted(-ramp, -1 / v, side='right'))
+
+
+def speedup_intervals(v_from, v_max, a_max, jerk=None):
+    """Intervals of the ramp to v_max for a move that already runs at v_from"""
+    ramp = ramp_intervals(v_max, a_max, jerk)
+    return ramp[_ramp_index(ramp, v_from):]
+
+
+def slowdown_intervals(v_from, v_to, v_max, a_max, jerk=None):
+    """Intervals down the mirrored ramp to v_max from v_from to v_to, 0 being rest"""
+    ramp = ramp_intervals(v_max, a_max, jerk)
+    return ramp[_ramp_index(ramp, v_to):_ramp_index(ramp, v_from)][::-1]
+
+
+def entry_limit(distance, v_exit, v_max, a_max, jerk=None):
+    """Fastest speed a move of distance steps can be entered at and still slow down to v_exit"""
+    ramp = ramp_intervals(v_max, a_max, jerk)
+    index = _ramp_index(ramp, v_exit) + distance
+    return v_max if index >= len(ramp) else 1 / ramp[index]
+
+
+@lru_cache(maxsize=32)
+def blend_intervals(distance, v_entry, v_exit, v_max, a_max, jerk=None):
+    """Intervals of a move of distance steps entered at v_entry and left at v_exit
+
+    With both 0 this is step_intervals. Otherwise the move continues up the
+    ramp to v_max from v_entry and goes down the mirrored one to v_exit, so
+    it joins the moves before and after it without stopping. Where distance
+    is too short to reach v_max both ramps are cut off at the same speed.
+    """
+    if not v_entry and not v_exit:
+        return step_intervals(distance, v_max, a_max, jerk)
+    ramp = ramp_intervals(v_max, a_max, jerk)
+    up, down = _ramp_index(ramp, min(v_entry, v_max)), _ramp_index(ramp, min(v_exit, v_max))
+    cruise = distance - (len(ramp) - up) - (len(ramp) - down)
+    if cruise >= 0:
+        intervals = np.concatenate((ramp[up:], np.full(cruise, 1 / v_max), ramp[down:][::-1]))
+    else:
+        # Both ramps end at the same step of the table
+        accelerating = min(max(0, (distance + down - up) // 2), distance)
+        decelerating = distance - accelerating
+        intervals = np.concatenate((ramp[up:up + accelerating], ramp[down:down + decelerating][::-1]))
+    intervals.setflags(write=False)
+    return intervals
@@ -1,27 +1,76 @@
-import paho.mqtt.client as mqtt
+from payload_codec import decode_payload
+from mqtt_connection import MqttConnection
+from mailbox import LatestValueMailbox
+from latency_probe import ProbeEcho
+import ringlog
+
+log = ringlog.get_logger('joystick')
 
 
 class MqttJoystickReceive:
-    joystick_x = 504
+    # Stick position at rest, also reported when the input went stale
+    neutral = (504, 504)
+
+    # joystick/all carries both axes in one compact payload, the per-key
+    # topic is still accepted from senders in compatibility mode
+    topics = [("joystick/all", 0), ("joystick/sens_joy_x", 0)]
+
+    def __init__(self, stale_after=1.0):
+        # (x, y) positions from paho's thread, older than stale_after
+        # seconds they count as neutral, so lost input stops the robot
+        self.mailbox = LatestValueMailbox(stale_after)
+        # Latency probes riding on joystick/all, echoed by the control loop
+        # with probes.echo(publisher) where it acts on the position
+        self.probes = ProbeEcho()
+
+    def position(self, now=None):
+        """Current (x, y), neutral if nothing fresh was received"""
+        letter = self.mailbox.fresh(now)
+        if letter is None:
+            letter = self.mailbox.get()
+            if letter is not None:
+                log.rate_limited(5.0, ringlog.WARNING, "Joystick input is stale, stopping")
+            return self.neutral
+        return letter.value
 
-    def on_connect(self, client, userdata, flags, rc):
-        print("Connected with result code", rc)
-        client.subscribe("joystick/sens_joy_x")
+    @property
+    def joystick_x(self):
+        return self.position()[0]
+
+    @property
+    def joystick_y(self):
+        return self.position()[1]
+
+    def attach(self, connection):
+        """Receive the joystick through a shared MqttConnection"""
+        for topic, qos in self.topics:
+            connection.subscribe(topic, qos, self.on_message)
 
     def on_message(self, client, userdata, msg):
-        print(f"Received on topic {msg.topic}: {msg.payload.decode()}")
+        if msg.topic == "joystick/all":
+            try:
+                values = decode_payload(msg.payload)
+                if 'probe' in values:
+                    self.probes.received(values['probe'], values['probe_sent'])
+                self.mailbox.put((values['sens_joy_x'], values['sens_joy_y']))
+            except (ValueError, KeyError) as e:
+                log.rate_limited(1.0, ringlog.WARNING, "Error decoding joystick payload: %s", e)
+            return
+
+        log.debug("Received on topic %s: %r", msg.topic, msg.payload)
         try:
-            self.joystick_x = int(msg.payload.decode())
+            x = int(msg.payload.decode())
+            letter = self.mailbox.get()
+            self.mailbox.put((x, self.neutral[1] if letter is None else letter.value[1]))
         except ValueError:
-            print(f"Error converting joystick value: {msg.payload.decode()}")
+            log.rate_limited(1.0, ringlog.WARNING, "Error converting joystick value: %r", msg.payload)
 
     def main(self):
         broker_address = "localhost"  # Receiver Pi's IP (or localhost if self-hosted)
         # broker_port = 1883  # Default MQTT port
-        client = mqtt.Client(protocol=mqtt.MQTTv311)
-        client.on_connect = self.on_connect
-        client.on_message = self.on_message
+        # Standalone receiver with its own connection, main_rpi1 shares one
+        connection = MqttConnection(client_id="")
+        self.attach(connection)
 
-        client.connect(broker_address)
         # Start the loop in the background instead of blocking
-        client.loop_start()
+        connection.connect(broker_address)
@@ -1,8 +1,19 @@
-import serial
+import os
 import time
-import re
-import json
-import paho.mqtt.client as mqtt
+from serial_stream import SerialFrameAssembler
+from serial_binary import BinaryFrameDecoder, negotiate_binary
+from sensor_schema import SENSOR_SCHEMA, compile_schema
+from serial_fanin import SerialFanIn, capture_wall_time, open_serial_devices
+from publish_filter import ChangeFilter, RateLimit
+from payload_codec import encode_sensors, encode_json
+from publish_queue import DROP_OLDEST
+from mqtt_connection import MqttConnection
+from store_forward import StoreForward
+from synthetic_source import SyntheticSensors, SyntheticSerial
+import ringlog
+
+# LOG_LEVELS=debug shows every frame and publish
+log = ringlog.get_logger('mqtt')
 
 
 # MQTT Callbacks
@@ -16,12 +27,7 @@ def on_connect(client, userdata, flags, rc):
         4: "Connection refused - bad username or password",
         5: "Connection refused - not authorised"
     }
-    print(f"Connected with result code {rc}: {connection_codes.get(rc, 'Unknown')}")
-
-
-def on_publish(client, userdata, mid):
-    """Callback for when a message is published"""
-    print(f"Message published with id: {mid}")
+    log.info("Connected with result code %s: %s", rc, connection_codes.get(rc, 'Unknown'))
 
 
 # MQTT broker details (modify these to match your setup)
@@ -29,150 +35,191 @@ broker_address = "localhost"  # or "127.0.0.1"
 broker_port = 1883  # Default MQTT port
 base_topic = "sensors"  # Base topic for all sensor data
 
-# Create and configure MQTT client
-mqtt_client = mqtt.Client(client_id="sensor_publisher")
-mqtt_client.on_connect = on_connect
-mqtt_client.on_publish = on_publish
+# At most publish_queue_size messages wait for a slow or absent broker,
+# beyond that publish_drop_policy decides which ones are lost
+publish_queue_size = 64
+publish_drop_policy = DROP_OLDEST
+
+# Sensor data published while the broker is unreachable is kept in a ring
+# file and forwarded once it is back; reconnects back off exponentially
+backlog_path = os.environ.get('SENSOR_BACKLOG_PATH', '/var/tmp/mqtt_send_rpi1.backlog')
+backlog = StoreForward(backlog_path)
+reconnect_min_delay = 1
+reconnect_max_delay = 60
+
+# MQTT 5 (mosquitto 1.6 or newer) sends topic aliases instead of the full
+# topic and lets the broker drop sensor data older than its expiry
+mqtt_v5 = False
+message_expiry = {"sensors/all": 5}
+
+# Retained copy of sensors/all that subscribers receive right after
+# subscribing, updated at most snapshot_max_rate times per second. A state
+# held back by the limit is published when its interval ends
+snapshot_topic = "sensors/snapshot"
+snapshot_max_rate = 2
+snapshot_limit = RateLimit(snapshot_max_rate)
+
+# Create and configure MQTT connection
+connection = MqttConnection("sensor_publisher", use_v5=mqtt_v5, message_expiry=message_expiry,
+                            min_delay=reconnect_min_delay, max_delay=reconnect_max_delay,
+                            queue_size=publish_queue_size, drop_policy=publish_drop_policy)
+connection.connect_handlers.append(on_connect)
+publisher = connection.publisher
+publisher.on_idle = lambda: backlog.forward(publisher)
+
+# Connect to MQTT broker, the loop keeps retrying while it is unreachable
+log.info("Connecting to broker: %s:%s", broker_address, broker_port)
+connection.connect(broker_address, broker_port, 60)
+
+# Serial ports of the sensor boards, frames from all of them are merged
+# Change the ports according to your system
+# SENSOR_SERIAL_PORTS overrides them, e.g. with the pty of serial_capture.py replay
+serial_ports = os.environ.get('SENSOR_SERIAL_PORTS', '/dev/ttyACM0').split(',')
+
+# "text" reads the key=value lines, "binary" switches the Uno to CRC-checked
+# frames at binary_baudrate and falls back to text if the board does not answer
+serial_protocol = "text"
+binary_baudrate = 115200
+
+
+def make_assembler(ser):
+    """Frame assembler for one board, binary if configured and the board agrees"""
+    if serial_protocol == "binary":
+        time.sleep(2)  # the Uno resets when the port is opened
+        if negotiate_binary(ser, binary_baudrate):
+            log.info("Serial protocol on %s: binary at %d baud", ser.name, binary_baudrate)
+            return BinaryFrameDecoder()
+
+    # Keeps partial lines between reads, a frame ends with the sens_photo line
+    return SerialFrameAssembler(end_key='sens_photo')
+
+
+# Seeded synthetic readings are streamed when no board can be opened,
+# SYNTHETIC_RATE_HZ raises the rate for load tests
+synthetic_seed = int(os.environ.get('SYNTHETIC_SEED', 0))
+synthetic_rate_hz = float(os.environ.get('SYNTHETIC_RATE_HZ', 1))
+
+# Set up serial connections
+fanin = SerialFanIn()
+for port, ser in open_serial_devices(serial_ports).items():
+    fanin.add(port, ser, make_assembler(ser))
+
+if not fanin.devices:
+    synthetic = SyntheticSerial(SyntheticSensors(seed=synthetic_seed), rate_hz=synthetic_rate_hz)
+    log.warning("No serial port available, using synthetic data at %s Hz", synthetic_rate_hz)
+    fanin.add(synthetic.name, synthetic, SerialFrameAssembler(end_key=synthetic.source.end_key))
+
+# Decoder compiled once from the schema, one converter lookup per line
+sensor_decoder = compile_schema(SENSOR_SCHEMA)
 
-# Connect to MQTT broker
-print(f"Connecting to broker: {broker_address}:{broker_port}")
-mqtt_client.connect(broker_address, broker_port, 60)
-mqtt_client.loop_start()
+# Dictionary to store the sensor values
+sensor_data = sensor_decoder.defaults()
 
-# Set up serial connection
-# Change the port according to your system
-try:
-    ser = serial.Serial(
-        port='/dev/ttyACM0',  # Change this to match your system
-        baudrate=9600,
-        timeout=1
-    )
-    print(f"Connected to serial port: {ser.name}")
-except serial.SerialException as e:
-    print(f"Error opening serial port: {e}")
-    # Create a placeholder for testing without actual hardware
-    ser = None
+# Sequence number and monotonic capture time of the newest frame
+sensor_meta = {'seq': -1, 'captured': time.monotonic(), 'pub_seq': 0}
 
-# Dictionary to store the sensor values
-sensor_data = {
-    'sens_photo': 0,
-    'sens_humid': 0.0,
-    'sens_temp': 0.0,
-    'sens_lux': 0.0,
-    'sens_range': 0,
-    'led_red': False
-}
+# Only values that moved by more than their deadband are published, each key
+# is republished at least every publish_max_interval seconds as a heartbeat
+publish_max_interval = 5.0
+publish_filter = ChangeFilter(sensor_decoder.deadbands(), max_interval=publish_max_interval,
+                              sentinels=sensor_decoder.sentinels())
+
+# "binary" sends the compact payload_codec layout on the aggregate topic,
+# "json" the previous JSON. Per-key topics are only kept for old subscribers.
+payload_format = "binary"
+publish_per_key = False
 
 
 def read_serial_data():
     """Read data from serial port and update sensor_data dictionary"""
-    global sensor_data
-
-    if ser is None:
-        # Return simulated data for testing if no serial connection
-        import random
-        sensor_data = {
-            'sens_photo': random.randint(0, 1023),
-            'sens_humid': round(random.uniform(30, 70), 1),
-            'sens_temp': round(random.uniform(18, 28), 1),
-            'sens_lux': round(random.uniform(100, 1000), 1),
-            'sens_range': random.randint(5, 100),
-            'led_red': random.choice([True, False])
-        }
-        return True
-
-    # Clear any existing data in the input buffer
-    ser.flushInput()
-
-    # Read data until buffer is empty
-    buffer = ""
-    start_time = time.time()
-    timeout = 2  # Timeout in seconds
-
-    while time.time() - start_time < timeout:
-        if ser.in_waiting > 0:
-            line = ser.readline().decode('utf-8').strip()
-            buffer += line + "\n"
-
-            # Look for complete set of sensor readings
-            if 'sens_photo' in line and len(buffer.strip()) > 10:
-                parse_sensor_data(buffer)
-                buffer = ""
-                return True
-
-    return False
+    # Read whatever has arrived on any board, nothing is discarded. Wake up
+    # in time for a held back snapshot
+    wait = snapshot_limit.wait_time()
+    frames = fanin.poll(timeout=1 if wait is None else min(wait, 1))
+
+    for seq, captured, source, frame in frames:
+        if isinstance(frame, dict):
+            # Binary frames arrive already decoded, only the checks are left
+            sensor_data.update(sensor_decoder.validate(frame))
+        else:
+            parse_sensor_data(frame)
+        sensor_meta['seq'] = seq
+        sensor_meta['captured'] = captured
+
+    return bool(frames)
 
 
 def parse_sensor_data(data_string):
     """Parse the received data string into the sensor_data dictionary"""
-    global sensor_data
-
-    # Process each line
-    for line in data_string.strip().split('\n'):
-        if '=' in line:
-            key, value = line.split('=', 1)
-            key = key.strip()
-            value = value.strip()
-
-            if key in sensor_data:
-                if key == 'led_red':
-                    # Convert string 'true'/'false' to boolean
-                    sensor_data[key] = (value.lower() == 'true')
-                elif '.' in value:
-                    # Handle floating point values
-                    try:
-                        sensor_data[key] = float(value)
-                    except ValueError:
-                        print(f"Could not convert {value} to float for {key}")
-                else:
-                    # Handle integer values
-                    try:
-                        sensor_data[key] = int(value)
-                    except ValueError:
-                        print(f"Could not convert {value} to")
+    # Malformed or out of range values are counted in sensor_decoder.errors
+    sensor_data.update(sensor_decoder.decode_frame(data_string))
 
 
 # Wait to ensure MQTT connection is established
 time.sleep(1)
 
 
+def publish_snapshot(publisher, payload):
+    """Publish payload as the retained sensor snapshot, nothing for None"""
+    if payload is not None:
+        publisher.publish(snapshot_topic, payload, qos=0, retain=True)
+
+
 def publish_sensor_data():
-    """Publish sensor data to MQTT topics"""
-    # Publish all sensor data as a JSON payload to a single topic
-    json_payload = json.dumps(sensor_data)
-    print(f"Publishing all sensor data to {base_topic}/all")
-    mqtt_client.publish(f"{base_topic}/all", json_payload, qos=0)
-
-    # Also publish individual sensor values to their own topics
-    for sensor, value in sensor_data.items():
+    """Publish the sensor values that changed to MQTT topics"""
+    changes = publish_filter.changes(sensor_data)
+    if not changes:
+        return
+
+    # Publish all sensor data as one payload to a single topic with the
+    # sequence number and capture time of the newest frame. pub_seq counts
+    # these messages, so subscribers can tell skipped frames from lost ones.
+    sensor_meta['pub_seq'] += 1
+    encode = encode_sensors if payload_format == "binary" else encode_json
+    payload = encode(sensor_data, sensor_meta['seq'], sensor_meta['pub_seq'],
+                     capture_wall_time(sensor_meta['captured']))
+    if not connection.is_connected():
+        # Kept on disk and forwarded to backlog/sensors/all after reconnecting
+        backlog.append(f"{base_topic}/all", payload)
+        return
+
+    log.debug("Publishing all sensor data to %s/all", base_topic)
+    publisher.publish(f"{base_topic}/all", payload, qos=0)
+    publish_snapshot(publisher, snapshot_limit.offer(payload))
+    backlog.forward(publisher)
+
+    if not publish_per_key:
+        return
+
+    # Compatibility mode: also publish the changed values to their own topics
+    for sensor, value in changes.items():
         topic = f"{base_topic}/{sensor}"
-        print(f"Publishing {sensor}: {value} to {topic}")
-        mqtt_client.publish(topic, str(value), qos=0)
+        log.debug("Publishing %s: %s to %s", sensor, value, topic)
+        publisher.publish(topic, str(value), qos=0)
 
 
 try:
-    print("Starting sensor data collection and MQTT publishing...")
-    print("Press Ctrl+C to stop")
+    log.info("Starting sensor data collection and MQTT publishing...")
+    log.info("Press Ctrl+C to stop")
 
     while True:
         if read_serial_data():
-            # Print the parsed sensor data
-            print("\nRead sensor data:")
-            for key, value in sensor_data.items():
-                print(f"{key}: {value} (type: {type(value).__name__})")
+            # Log the parsed sensor data
+            log.debug("Read sensor data: %s", dict(sensor_data))
 
             # Publish the data to MQTT
             publish_sensor_data()
 
-        time.sleep(1)  # Wait a second before reading again
+        # The last snapshot the rate limit held back
+        publish_snapshot(publisher, snapshot_limit.due())
 
 except KeyboardInterrupt:
-    print("\nProgram stopped by user")
+    log.info("Program stopped by user")
 finally:
     # Clean up resources
-    if ser is not None:
-        ser.close()
-        print("Serial port closed")
-    mqtt_client.loop_stop()
-    mqtt_client.disconnect()
-    print("MQTT connection closed")
\ No newline at end of file
+    fanin.close()
+    log.info("Serial ports closed")
+    connection.close()
+    backlog.close()
+    log.info("MQTT connection closed")
+    ringlog.flush()
\ No newline at end of file
@@ -0,0 +1,102 @@
+import json
+import struct
+
+# Compact payloads for the sensors/all and joystick/all topics. The first
+# byte is the schema id, so the layout can change without breaking older
+# subscribers: they reject ids they do not know. A payload starting with
+# '{' is the previous JSON format and is still decoded.
+SCHEMA_SENSORS_V1 = 0x11
+SCHEMA_JOYSTICK_V1 = 0x21
+SCHEMA_JOYSTICK_PROBE_V1 = 0x22
+
+# id, frame seq, publish seq, capture wall time, then the values.
+# Humidity and temperature travel as hundredths, which is all the
+# precision the Uno prints.
+SENSORS_V1 = struct.Struct('<BIIdHHhfhB')
+JOYSTICK_V1 = struct.Struct('<BIIdHH')
+
+# A joystick payload that is also a latency probe: probe id and the send
+# wall time, echoed by the Motor Pi when it acts on the position
+JOYSTICK_PROBE_V1 = struct.Struct('<BIIdHHId')
+
+
+def encode_sensors(values, seq, pub_seq, ts):
+    """Pack the Uno's sensor values into a SCHEMA_SENSORS_V1 payload"""
+    return SENSORS_V1.pack(
+        SCHEMA_SENSORS_V1, seq & 0xFFFFFFFF, pub_seq & 0xFFFFFFFF, ts,
+        values['sens_photo'],
+        round(values['sens_humid'] * 100),
+        round(values['sens_temp'] * 100),
+        values['sens_lux'],
+        values['sens_range'],
+        values['led_red'],
+    )
+
+
+def encode_joystick(values, seq, pub_seq, ts):
+    """Pack the Nano's joystick axes into a SCHEMA_JOYSTICK_V1 payload"""
+    return JOYSTICK_V1.pack(
+        SCHEMA_JOYSTICK_V1, seq & 0xFFFFFFFF, pub_seq & 0xFFFFFFFF, ts,
+        values['sens_joy_x'], values['sens_joy_y'],
+    )
+
+
+def encode_joystick_probe(values, seq, pub_seq, ts, probe, sent):
+    """Pack the joystick axes with a latency probe into a SCHEMA_JOYSTICK_PROBE_V1 payload"""
+    return JOYSTICK_PROBE_V1.pack(
+        SCHEMA_JOYSTICK_PROBE_V1, seq & 0xFFFFFFFF, pub_seq & 0xFFFFFFFF, ts,
+        values['sens_joy_x'], values['sens_joy_y'], probe & 0xFFFFFFFF, sent,
+    )
+
+
+def encode_json(values, seq, pub_seq, ts):
+    """The previous JSON payload, for subscribers that have not been updated"""
+    return json.dumps(dict(values, seq=seq, pub_seq=pub_seq, ts=ts))
+
+
+def _decode_sensors(payload):
+    _, seq, pub_seq, ts, photo, humid, temp, lux, distance, led_red = SENSORS_V1.unpack(payload)
+    return {
+        'sens_photo': photo,
+        'sens_humid': humid / 100,
+        'sens_temp': temp / 100,
+        'sens_lux': round(lux, 2),
+        'sens_range': distance,
+        'led_red': bool(led_red),
+        'seq': seq,
+        'pub_seq': pub_seq,
+        'ts': ts,
+    }
+
+
+def _decode_joystick(payload):
+    _, seq, pub_seq, ts, x, y = JOYSTICK_V1.unpack(payload)
+    return {'sens_joy_x': x, 'sens_joy_y': y, 'seq': seq, 'pub_seq': pub_seq, 'ts': ts}
+
+
+def _decode_joystick_probe(payload):
+    _, seq, pub_seq, ts, x, y, probe, sent = JOYSTICK_PROBE_V1.unpack(payload)
+    return {'sens_joy_x': x, 'sens_joy_y': y, 'seq': seq, 'pub_seq': pub_seq, 'ts': ts,
+            'probe': probe, 'probe_sent': sent}
+
+
+_DECODERS = {
+    SCHEMA_SENSORS_V1: (SENSORS_V1.size, _decode_sensors),
+    SCHEMA_JOYSTICK_V1: (JOYSTICK_V1.size, _decode_joystick),
+    SCHEMA_JOYSTICK_PROBE_V1: (JOYSTICK_PROBE_V1.size, _decode_joystick_probe),
+}
+
+
+def decode_payload(payload):
+    """Decode an aggregate topic payload into a dict, raises ValueError if invalid"""
+    if not payload:
+        raise ValueError("empty payload")
+    if payload[0] == ord('{'):
+        return json.loads(payload)
+
+    size, decode = _DECODERS.get(payload[0], (None, None))
+    if decode is None:
+        raise ValueError(f"unknown payload schema 0x{payload[0]:02x}")
+    if len(payload) != size:
+        raise ValueError(f"payload is {len(payload)} bytes, expected {size}")
+    return decode(payload)
@@ -0,0 +1,361 @@
+"""Benchmark the sensor and joystick publish paths against a local broker
+
+Starts mosquitto on a free port if it is installed, otherwise a minimal
+in-process broker, then publishes synthetic readings through the same
+ChangeFilter, payload codec and MqttConnection the scripts use, at each
+rate for a few seconds, and writes a JSON report:
+
+    python3 publish_benchmark.py --rates 100 500 1000 2000 --output bench.json
+
+Compare two reports (e.g. of two commits) by their per-step msgs_per_s,
+p50_ms/p99_ms publish-to-receive latency, cpu_us_per_msg and rss_kb.
+msgs_per_s counts the messages received by the end of the drain_s wait
+over the publishing time only; nothing is coalesced.
+CPU and memory are those of this process, which also runs the subscriber
+and, without mosquitto, the broker.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import selectors
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from mqtt_connection import MqttConnection
+from payload_codec import decode_payload, encode_joystick, encode_sensors
+from publish_filter import ChangeFilter
+from sensor_schema import JOYSTICK_SCHEMA, SENSOR_SCHEMA, compile_schema
+from synthetic_source import SyntheticJoystick, SyntheticSensors
+
+PATHS = {
+    'sensors': ("sensors/all", SENSOR_SCHEMA, SyntheticSensors, encode_sensors),
+    'joystick': ("joystick/all", JOYSTICK_SCHEMA, SyntheticJoystick, encode_joystick),
+}
+
+
+class MiniBroker:
+    """Just enough of an MQTT 3.1.1 broker for the benchmark
+
+    CONNECT, SUBSCRIBE with + and # filters, QoS 0/1 PUBLISH (delivered
+    as QoS 0), PINGREQ and DISCONNECT, all on one selector thread. It is a
+    stand-in where mosquitto is not installed, not a broker to deploy.
+    """
+
+    def __init__(self, port=0):
+        self.server = socket.create_server(('127.0.0.1', port))
+        self.port = self.server.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.buffers = {}
+        self.subscriptions = {}
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="minibroker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        for sock in list(self.buffers):
+            sock.close()
+        self.server.close()
+
+    def _run(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                if key.fileobj is self.server:
+                    sock, _ = self.server.accept()
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.buffers[sock] = bytearray()
+                    self.selector.register(sock, selectors.EVENT_READ)
+                else:
+                    self._read(key.fileobj)
+
+    def _drop(self, sock):
+        self.selector.unregister(sock)
+        self.buffers.pop(sock, None)
+        self.subscriptions.pop(sock, None)
+        sock.close()
+
+    def _read(self, sock):
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(sock)
+            return
+
+        buffer = self.buffers[sock]
+        buffer += data
+        while True:
+            packet = self._split(buffer)
+            if packet is None:
+                return
+            kind, flags, body = packet
+            if not self._handle(sock, kind, flags, body):
+                self._drop(sock)
+                return
+
+    @staticmethod
+    def _split(buffer):
+        """Take one packet off the front of buffer, None if it is incomplete"""
+        length, multiplier, index = 0, 1, 1
+        while True:
+            if index >= len(buffer):
+                return None
+            byte = buffer[index]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            index += 1
+            if not byte & 0x80:
+                break
+        if len(buffer) < index + length:
+            return None
+        kind, flags = buffer[0] >> 4, buffer[0] & 0x0F
+        body = bytes(buffer[index:index + length])
+        del buffer[:index + length]
+        return kind, flags, body
+
+    @staticmethod
+    def _packet(header, body):
+        length, encoded = len(body), bytearray()
+        while True:
+            byte, length = length % 128, length // 128
+            encoded.append(byte | (0x80 if length else 0))
+            if not length:
+                break
+        return bytes([header]) + bytes(encoded) + body
+
+    def _handle(self, sock, kind, flags, body):
+        if kind == 1:  # CONNECT
+            sock.sendall(b'\x20\x02\x00\x00')
+        elif kind == 3:  # PUBLISH
+            topic_length = int.from_bytes(body[:2], 'big')
+            topic = body[2:2 + topic_length]
+            offset = 2 + topic_length
+            qos = (flags >> 1) & 3
+            if qos:
+                sock.sendall(b'\x40\x02' + body[offset:offset + 2])
+                offset += 2
+            message = self._packet(0x30, body[:2 + topic_length] + body[offset:])
+            for subscriber, filters in list(self.subscriptions.items()):
+                if any(_matches(pattern, topic.decode()) for pattern in filters):
+                    try:
+                        subscriber.sendall(message)
+                    except OSError:
+                        self._drop(subscriber)
+        elif kind == 8:  # SUBSCRIBE
+            offset, granted = 2, bytearray()
+            while offset < len(body):
+                length = int.from_bytes(body[offset:offset + 2], 'big')
+                self.subscriptions.setdefault(sock, set()).add(body[offset + 2:offset + 2 + length].decode())
+                offset += 2 + length + 1
+                granted.append(0)
+            sock.sendall(self._packet(0x90, body[:2] + bytes(granted)))
+        elif kind == 12:  # PINGREQ
+            sock.sendall(b'\xd0\x00')
+        elif kind == 14:  # DISCONNECT
+            return False
+        return True
+
+
+def _matches(pattern, topic):
+    pattern_levels, topic_levels = pattern.split('/'), topic.split('/')
+    for index, level in enumerate(pattern_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels) or (level != '+' and level != topic_levels[index]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+def start_broker(builtin=False):
+    """Start mosquitto, or MiniBroker if it is missing, returns (port, name, stop)"""
+    mosquitto = None if builtin else shutil.which('mosquitto')
+    if mosquitto is None:
+        broker = MiniBroker()
+        return broker.port, 'builtin', broker.stop
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([mosquitto, '-p', str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    def stop():
+        process.terminate()
+        process.wait()
+
+    return port, 'mosquitto', stop
+
+
+def rss_kb():
+    """Current resident set size of this process"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Receiver:
+    """Subscriber that records the publish-to-receive latency of every message"""
+
+    def __init__(self):
+        self.latencies = []
+        self.received = 0
+
+    def on_message(self, client, userdata, msg):
+        received = time.time()
+        values = decode_payload(msg.payload)
+        self.latencies.append(received - values['ts'])
+        self.received += 1
+
+
+def run_step(connection, receiver, path, rate, duration, use_filter, seed):
+    """Publish one path at rate frames per second for duration seconds"""
+    topic, schema, source_class, encode = PATHS[path]
+    source = source_class(seed=seed)
+    decoder = compile_schema(schema)
+    publish_filter = ChangeFilter(decoder.deadbands(), sentinels=decoder.sentinels())
+    publisher = connection.publisher
+
+    receiver.latencies, receiver.received = [], 0
+    sent_before, dropped_before, coalesced_before = publisher.sent, publisher.dropped, publisher.coalesced
+    cpu_start, wall_start = time.process_time(), time.monotonic()
+
+    frames = published = 0
+    interval = 1.0 / rate
+    next_frame = wall_start
+    while True:
+        now = time.monotonic()
+        if now - wall_start >= duration:
+            break
+        if now < next_frame:
+            time.sleep(next_frame - now)
+            continue
+        next_frame += interval
+
+        values = source.frame(now - wall_start)
+        frames += 1
+        if use_filter and not publish_filter.changes(values):
+            continue
+        published += 1
+        # Not coalesced, a newer frame replacing a queued one would be
+        # counted as lost throughput
+        publisher.publish(topic, encode(values, frames, published, time.time()), qos=0, coalesce=False)
+
+    elapsed = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    # Let the last messages arrive before counting, timed on its own
+    drain_start = time.monotonic()
+    deadline = drain_start + 1.0
+    while receiver.received < published - (publisher.dropped - dropped_before) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    drain = time.monotonic() - drain_start
+    latencies = receiver.latencies
+    return {
+        'path': path,
+        'rate': rate,
+        'duration': round(elapsed, 3),
+        'frames': frames,
+        'published': published,
+        'sent': publisher.sent - sent_before,
+        'received': receiver.received,
+        'dropped': publisher.dropped - dropped_before,
+        'coalesced': publisher.coalesced - coalesced_before,
+        'drain_s': round(drain, 3),
+        'msgs_per_s': round(receiver.received / elapsed, 1),
+        'p50_ms': None if not latencies else round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': None if not latencies else round(percentile(latencies, 99) * 1000, 3),
+        'cpu_us_per_msg': None if not published else round(cpu / published * 1e6, 1),
+        'rss_kb': rss_kb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paths', nargs='+', choices=sorted(PATHS), default=sorted(PATHS))
+    parser.add_argument('--rates', nargs='+', type=float, default=[10, 100, 500, 1000, 2000, 5000],
+                        help="frames per second, one step per rate")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds per step")
+    parser.add_argument('--no-filter', action='store_true', help="publish every frame, not only changes")
+    parser.add_argument('--builtin-broker', action='store_true', help="do not use mosquitto")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="report file, default stdout")
+    args = parser.parse_args()
+
+    port, broker_name, stop_broker = start_broker(args.builtin_broker)
+    receiver = Receiver()
+    subscriber = MqttConnection("benchmark_subscriber")
+    for topic, *_ in PATHS.values():
+        subscriber.subscribe(topic, 0, receiver.on_message)
+    publisher = MqttConnection("benchmark_publisher", queue_size=1024)
+
+    try:
+        subscriber.connect('127.0.0.1', port)
+        publisher.connect('127.0.0.1', port)
+        deadline = time.monotonic() + 5
+        while not (subscriber.is_connected() and publisher.is_connected()):
+            if time.monotonic() > deadline:
+                sys.exit("could not connect to the broker")
+            time.sleep(0.05)
+        time.sleep(0.2)  # subscriptions are acknowledged after the connect
+
+        steps = []
+        for path in args.paths:
+            for rate in args.rates:
+                step = run_step(publisher, receiver, path, rate, args.duration, not args.no_filter, args.seed)
+                steps.append(step)
+                print(f"{path} {rate:g}/s: {step['msgs_per_s']} msgs/s, p50 {step['p50_ms']} ms, "
+                      f"p99 {step['p99_ms']} ms, {step['cpu_us_per_msg']} us cpu/msg", file=sys.stderr)
+    finally:
+        publisher.close()
+        subscriber.close()
+        stop_broker()
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'broker': broker_name,
+        'filter': not args.no_filter,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'steps': steps,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import threading
+from collections import OrderedDict
+
+import paho.mqtt.client as mqtt
+
+import ringlog
+
+log = ringlog.get_logger('mqtt')
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+def _notify(callbacks, published):
+    # Called without the queue lock held, a callback may publish again
+    for on_done in callbacks:
+        if on_done is not None:
+            on_done(published)
+
+
+class BoundedPublisher:
+    """Bounded outgoing queue in front of a paho client
+
+    paho queues every publish() without limit while the broker is slow or
+    away. Here at most max_queued messages wait, and only a window of them
+    is handed to paho at a time: max_unsent QoS 0 messages not yet written
+    to the socket and max_inflight QoS 1/2 messages not yet acknowledged.
+    A new message for a topic that is still waiting replaces the old one
+    (latest value wins), and when the queue is full either the oldest
+    waiting message or the new one is dropped. publish() never blocks.
+
+    on_publish and on_disconnect are paho callbacks and have to be set on
+    the client (or called from the client's own callbacks). on_idle, if
+    set, is called whenever the queue has run empty, e.g. to refill it
+    from a backlog. A message's on_done, if given, is called with True once
+    paho reports it published (for QoS 1 when the broker acknowledged it)
+    and with False when it is dropped or replaced.
+
+    paho calls on_publish with its outgoing message lock held, so
+    client.publish is never called with this queue's lock held: the
+    messages are taken from the queue under the lock and handed to paho
+    after releasing it, by one thread at a time.
+    """
+
+    def __init__(self, client, max_queued=64, policy=DROP_OLDEST, max_inflight=16, max_unsent=32):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown drop policy {policy!r}")
+        self.client = client
+        self.max_queued = max_queued
+        self.policy = policy
+        self.max_inflight = max_inflight
+        self.max_unsent = max_unsent
+        client.max_inflight_messages_set(max_inflight)
+
+        self._queue = OrderedDict()
+        self._inflight = {}  # mid -> qos
+        self._windows = [0, 0]  # messages with paho for QoS 0 and QoS 1/2
+        self._early = set()  # mids paho reported before publish() returned them
+        self._sending = False  # a thread is handing messages to paho
+        self._serial = 0
+        self._lock = threading.Lock()
+        self.on_idle = None
+
+        self.queued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.dropped = 0
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def publish(self, topic, payload, qos=0, retain=False, coalesce=True, on_done=None):
+        """Queue a message and hand what the windows allow to paho
+
+        Returns False if the message was dropped right away.
+        """
+        dropped = []
+        with self._lock:
+            if coalesce:
+                key = topic
+            else:
+                self._serial += 1
+                key = (topic, self._serial)
+
+            if key in self._queue:
+                # Keeps its place in the queue, so a busy topic is not starved
+                dropped.append(self._queue[key][4])
+                self._queue[key] = (topic, payload, qos, retain, on_done)
+                self.coalesced += 1
+            else:
+                if len(self._queue) >= self.max_queued:
+                    self.dropped += 1
+                    if self.policy == DROP_NEWEST:
+                        log.rate_limited(5.0, ringlog.WARNING, "Publish queue full, dropping new messages")
+                        _notify([on_done], False)
+                        return False
+                    log.rate_limited(5.0, ringlog.WARNING, "Publish queue full, dropping old messages")
+                    dropped.append(self._queue.popitem(last=False)[1][4])
+                self._queue[key] = (topic, payload, qos, retain, on_done)
+            self.queued += 1
+        _notify(dropped, False)
+        self._pump()
+        return True
+
+    def flush(self):
+        """Hand waiting messages to paho, e.g. after a reconnect"""
+        self._pump()
+
+    def _take(self):
+        """Remove the messages the windows allow from the queue and reserve their window slots"""
+        limits = (self.max_unsent, self.max_inflight)
+        taken = []
+        blocked = set()
+        for key, message in list(self._queue.items()):
+            window = 1 if message[2] else 0
+            if window in blocked:
+                continue
+            if self._windows[window] >= limits[window]:
+                blocked.add(window)
+                if len(blocked) == 2:
+                    break
+                continue
+            del self._queue[key]
+            self._windows[window] += 1
+            taken.append((key, message))
+        return taken
+
+    def _requeue(self, taken):
+        """Put messages paho refused back in front of the queue unless a newer value replaced them
+
+        Returns the on_done callbacks of the replaced ones.
+        """
+        replaced = []
+        for key, message in reversed(taken):
+            self._windows[1 if message[2] else 0] -= 1
+            if key in self._queue:
+                replaced.append(message[4])
+            else:
+                self._queue[key] = message
+                self._queue.move_to_end(key, last=False)
+        return replaced
+
+    def _pump(self):
+        """Hand what the windows allow to paho
+
+        Only one thread sends; a thread that finds it busy leaves, the
+        sender takes its messages on its next round.
+        """
+        with self._lock:
+            if self._sending:
+                return
+            self._sending = True
+
+        while True:
+            with self._lock:
+                taken = self._take() if self.client.is_connected() else []
+                if not taken:
+                    self._sending = False
+                    self._early.clear()
+                    return
+
+            replaced = self._send(taken)
+            if replaced is not None:
+                _notify(replaced, False)
+                return
+
+    def _send(self, taken):
+        """client.publish taken messages, None if paho took them all
+
+        Otherwise the rest goes back to the queue, sending ends and the
+        on_done callbacks of the ones a newer value replaced are returned.
+        """
+        for n, (key, (topic, payload, qos, retain, on_done)) in enumerate(taken):
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            with self._lock:
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # Not connected after all, try again on the next call
+                    replaced = self._requeue(taken[n:])
+                    self._sending = False
+                    self._early.clear()
+                    return replaced
+                window = 1 if qos else 0
+                if info.mid not in self._early:
+                    self._inflight[info.mid] = (window, on_done)
+                    continue
+                # paho's thread was faster than publish() returned
+                self._early.discard(info.mid)
+                self._windows[window] -= 1
+                self.sent += 1
+            _notify([on_done], True)
+        return None
+
+    def on_publish(self, client, userdata, mid):
+        log.debug("Message published with id: %s", mid)
+        with self._lock:
+            entry = self._inflight.pop(mid, None)
+            if entry is not None:
+                window, on_done = entry
+                self._windows[window] -= 1
+                self.sent += 1
+            elif self._sending:
+                self._early.add(mid)
+        if entry is not None:
+            _notify([on_done], True)
+        self._pump()
+        with self._lock:
+            idle = not self._queue
+        if idle and self.on_idle is not None:
+            self.on_idle()
+
+    def on_disconnect(self, client, userdata, rc):
+        # paho resends unacknowledged QoS 1/2 messages after reconnecting,
+        # but unwritten QoS 0 messages are gone
+        dropped = []
+        with self._lock:
+            for mid, (window, on_done) in list(self._inflight.items()):
+                if window == 0:
+                    del self._inflight[mid]
+                    self._windows[0] -= 1
+                    self.dropped += 1
+                    dropped.append(on_done)
+        _notify(dropped, False)
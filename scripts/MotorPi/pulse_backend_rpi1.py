@@ -0,0 +1,238 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque, namedtuple
+
+import ringlog
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None
+
+log = ringlog.get_logger('motors')
+
+# Set the GPIOs in on_mask high and those in off_mask low, then wait
+# delay_us microseconds before the next pulse, like pigpio.pulse
+Pulse = namedtuple('Pulse', ['on_mask', 'off_mask', 'delay_us'])
+
+
+def pins(mask):
+    """BCM pin numbers of the bits set in mask"""
+    return [pin for pin in range(mask.bit_length()) if mask >> pin & 1]
+
+
+def duration(pulses):
+    """Length of a waveform in seconds"""
+    return sum(pulse.delay_us for pulse in pulses) / 1e6
+
+
+class PulseBackend(ABC):
+    """Plays timed edge lists (waveforms) on the GPIOs
+
+    ``send`` queues a waveform to start right after the one that is
+    playing, ``ready`` tells whether another one can be queued, ``pending``
+    how many seconds of output are left and ``stop`` aborts at once. A
+    waveform holds at most max_pulses pulses.
+    """
+
+    max_pulses = 10000
+    # True if the pins are driven past the GPIO backend, whose shadow of
+    # them is stale once the output ends
+    owns_pins = False
+
+    @abstractmethod
+    def send(self, pulses):
+        """Queue a waveform behind the one playing"""
+
+    @abstractmethod
+    def ready(self):
+        """True if another waveform can be queued"""
+
+    @abstractmethod
+    def pending(self):
+        """Seconds of output left"""
+
+    @abstractmethod
+    def stop(self):
+        """Abort the output at once"""
+
+    def close(self):
+        self.stop()
+
+
+class PigpioBackend(PulseBackend):
+    """Waveforms played by the pigpio daemon's DMA engine
+
+    The pulses are timed by hardware and no Python code runs while a
+    waveform plays. pigpio chains one waveform behind the one playing, so
+    ``ready`` is False until the queued one has started.
+    """
+
+    owns_pins = True
+
+    def __init__(self, host='localhost', port=8888):
+        if pigpio is None:
+            raise RuntimeError("pigpio is not installed")
+        self.pi = pigpio.pi(host, port)
+        if not self.pi.connected:
+            raise RuntimeError(f"pigpiod is not running on {host}:{port}")
+        # Two waveforms exist at a time, the playing and the queued one
+        self.max_pulses = self.pi.wave_get_max_pulses() // 2
+        self._waves = []
+        self._end = 0.0
+        self._lock = threading.Lock()
+
+    def send(self, pulses):
+        with self._lock:
+            self.pi.wave_add_generic([pigpio.pulse(*pulse) for pulse in pulses])
+            wave = self.pi.wave_create()
+            self.pi.wave_send_using_mode(wave, pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+            self._waves.append(wave)
+            self._end = max(self._end, time.monotonic()) + duration(pulses)
+
+    def ready(self):
+        with self._lock:
+            if not self._waves:
+                return True
+            playing = self.pi.wave_tx_at()
+            if playing not in self._waves and self.pi.wave_tx_busy():
+                return False
+            # Waves before the playing one are done and may be deleted
+            done = len(self._waves) if playing not in self._waves else self._waves.index(playing)
+            for wave in self._waves[:done]:
+                self.pi.wave_delete(wave)
+            del self._waves[:done]
+            return len(self._waves) <= 1
+
+    def pending(self):
+        return max(0.0, self._end - time.monotonic())
+
+    def stop(self):
+        with self._lock:
+            self.pi.wave_tx_stop()
+            for wave in self._waves:
+                self.pi.wave_delete(wave)
+            self._waves = []
+            self._end = 0.0
+
+    def close(self):
+        self.stop()
+        self.pi.stop()
+
+
+class SoftwareBackend(PulseBackend):
+    """Waveforms played by a Python thread with write(on_mask, off_mask) and sleep
+
+    The fallback where pigpiod is not available. Pulses are timed against
+    absolute deadlines, so sleep jitter delays edges but does not add up.
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self._queue = deque()
+        self._end = 0.0
+        self._abort = threading.Event()
+        self._queued = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="pulses", daemon=True)
+        self._thread.start()
+
+    def send(self, pulses):
+        with self._queued:
+            self._queue.append(pulses)
+            self._end = max(self._end, time.monotonic()) + duration(pulses)
+            self._queued.notify()
+
+    def ready(self):
+        return not self._queue
+
+    def pending(self):
+        return max(0.0, self._end - time.monotonic())
+
+    def stop(self):
+        with self._queued:
+            self._queue.clear()
+            self._end = 0.0
+            self._abort.set()
+
+    def _run(self):
+        while True:
+            with self._queued:
+                while not self._queue:
+                    self._queued.wait()
+                pulses = self._queue.popleft()
+                self._abort.clear()
+
+            deadline = time.monotonic()
+            for on_mask, off_mask, delay_us in pulses:
+                if self._abort.is_set():
+                    break
+                self.write(on_mask, off_mask)
+                deadline += delay_us / 1e6
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class SimulatedBackend(PulseBackend):
+    """Records the edges a waveform would produce instead of driving GPIOs
+
+    ``edges`` holds (time_us, pin, level) tuples on a timeline that follows
+    time.monotonic(), as if the waveforms were played by hardware; edges
+    after a ``stop`` are removed. Runs on any Linux box.
+    """
+
+    def __init__(self):
+        self.edges = []
+        self._start = time.monotonic()
+        self._end = self._start
+        self._last_start = self._start
+        self._lock = threading.Lock()
+
+    def _now_us(self):
+        return (time.monotonic() - self._start) * 1e6
+
+    def send(self, pulses):
+        with self._lock:
+            self._last_start = max(self._end, time.monotonic())
+            at = (self._last_start - self._start) * 1e6
+            for on_mask, off_mask, delay_us in pulses:
+                self.edges.extend((at, pin, 1) for pin in pins(on_mask))
+                self.edges.extend((at, pin, 0) for pin in pins(off_mask))
+                at += delay_us
+            self._end = self._last_start + duration(pulses)
+
+    def ready(self):
+        return time.monotonic() >= self._last_start
+
+    def pending(self):
+        return max(0.0, self._end - time.monotonic())
+
+    def stop(self):
+        with self._lock:
+            now = self._now_us()
+            while self.edges and self.edges[-1][0] > now:
+                self.edges.pop()
+            self._end = self._last_start = time.monotonic()
+
+    def rising_edges(self, pin):
+        """Times in microseconds at which pin went high"""
+        return [at for at, edge_pin, level in self.edges if edge_pin == pin and level]
+
+
+def make_backend(name, write=None):
+    """PulseBackend by name: "pigpio", "software" (needs write) or "simulated"
+
+    pigpio falls back to the software backend if pigpiod is not available.
+    """
+    if name == "pigpio":
+        try:
+            return PigpioBackend()
+        except RuntimeError as e:
+            log.warning("%s, stepping in software", e)
+            name = "software"
+    if name == "software":
+        return SoftwareBackend(write)
+    if name == "simulated":
+        return SimulatedBackend()
+    raise ValueError(f"unknown pulse backend {name!r}")
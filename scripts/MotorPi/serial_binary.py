@@ -0,0 +1,198 @@
+import binascii
+import struct
+import time
+
+# Frame on the wire: COBS(type, seq, payload..., crc16) followed by 0x00.
+# The CRC is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over everything
+# before it, which is what binascii.crc_hqx computes in C.
+FRAME_DELIMITER = 0x00
+
+FRAME_SENSORS = 0x01
+FRAME_JOYSTICK = 0x02
+
+# Field order matches the packed structs in the Arduino sketches
+FRAME_LAYOUTS = {
+    FRAME_SENSORS: (
+        struct.Struct('<BHfffhHB'),
+        ('sens_humid', 'sens_temp', 'sens_lux', 'sens_range', 'sens_photo', 'led_red'),
+    ),
+    FRAME_JOYSTICK: (
+        struct.Struct('<BHHH'),
+        ('sens_joy_x', 'sens_joy_y'),
+    ),
+}
+
+CRC = struct.Struct('<H')
+
+# Command understood by both sketches, the baud rate follows the comma
+BINARY_COMMAND = "proto=bin,{baudrate}\n"
+TEXT_COMMAND = "proto=text\n"
+TEXT_BAUDRATE = 9600
+
+
+def crc16(data):
+    """CRC-16/CCITT-FALSE of data"""
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def cobs_encode(data):
+    """COBS-encode data so that it contains no zero bytes"""
+    out = bytearray([0])
+    code_index = 0
+    code = 1
+
+    for byte in data:
+        if byte:
+            out.append(byte)
+            code += 1
+        if not byte or code == 0xFF:
+            out[code_index] = code
+            code_index = len(out)
+            out.append(0)
+            code = 1
+
+    out[code_index] = code
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """Decode a COBS block (without the delimiter), raises ValueError if malformed"""
+    out = bytearray()
+    i = 0
+    n = len(data)
+
+    while i < n:
+        code = data[i]
+        if code == 0:
+            raise ValueError("zero byte inside COBS block")
+        end = i + code
+        if end > n:
+            raise ValueError("COBS block truncated")
+        out += data[i + 1:end]
+        i = end
+        if code < 0xFF and i < n:
+            out.append(0)
+
+    return bytes(out)
+
+
+def encode_frame(frame_type, seq, values):
+    """Build a complete wire frame from a dict of values, mirrors the sketches"""
+    layout, keys = FRAME_LAYOUTS[frame_type]
+    body = layout.pack(frame_type, seq & 0xFFFF, *(values[key] for key in keys))
+    return cobs_encode(body + CRC.pack(crc16(body))) + bytes([FRAME_DELIMITER])
+
+
+class BinaryFrameDecoder:
+    """Decode CRC-checked COBS frames from the Arduino serial feed
+
+    Drop-in replacement for ``SerialFrameAssembler`` plus ``parse_sensor_data``:
+    ``feed``/``read`` return the decoded frames as dicts that can be merged
+    into ``sensor_data`` directly. Corrupted frames are rejected by length and
+    CRC before anything is unpacked and only show up in the counters.
+    """
+
+    def __init__(self, max_frame_length=64):
+        self.max_frame_length = max_frame_length
+        self._buffer = bytearray()
+        self._last_seq = {}
+
+        self.frames = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.seq_gaps = 0
+
+    def feed(self, data):
+        """Append raw bytes and return the frames they completed as dicts"""
+        self._buffer += data
+        frames = []
+        start = 0
+
+        while True:
+            end = self._buffer.find(FRAME_DELIMITER, start)
+            if end < 0:
+                break
+            block = bytes(self._buffer[start:end])
+            start = end + 1
+            if block:
+                frame = self._decode(block)
+                if frame is not None:
+                    frames.append(frame)
+
+        del self._buffer[:start]
+        if len(self._buffer) > self.max_frame_length:
+            # A frame never gets this long, resynchronise on the next delimiter
+            self.framing_errors += 1
+            self._buffer.clear()
+
+        return frames
+
+    def read(self, ser):
+        """Read everything the port has buffered and return the decoded frames"""
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            return []
+        return self.feed(data)
+
+    def _decode(self, block):
+        try:
+            raw = cobs_decode(block)
+        except ValueError:
+            self.framing_errors += 1
+            return None
+
+        layout_entry = FRAME_LAYOUTS.get(raw[0]) if raw else None
+        if layout_entry is None or len(raw) != layout_entry[0].size + CRC.size:
+            self.framing_errors += 1
+            return None
+
+        body = raw[:-CRC.size]
+        if CRC.unpack_from(raw, len(body))[0] != crc16(body):
+            self.crc_errors += 1
+            return None
+
+        layout, keys = layout_entry
+        frame_type, seq, *values = layout.unpack(body)
+
+        last_seq = self._last_seq.get(frame_type)
+        if last_seq is not None and seq != (last_seq + 1) & 0xFFFF:
+            self.seq_gaps += 1
+        self._last_seq[frame_type] = seq
+        self.frames += 1
+
+        frame = dict(zip(keys, values))
+        if frame_type == FRAME_SENSORS:
+            # Match the two decimals the text protocol prints
+            frame['sens_humid'] = round(frame['sens_humid'], 2)
+            frame['sens_temp'] = round(frame['sens_temp'], 2)
+            frame['sens_lux'] = round(frame['sens_lux'], 2)
+            frame['led_red'] = bool(frame['led_red'])
+        return frame
+
+
+def negotiate_binary(ser, baudrate=115200, timeout=3.0):
+    """Switch the Arduino on ser to binary frames at baudrate
+
+    Sends the mode command at the current baud rate, follows the board to
+    the new rate and waits for one valid frame. Falls back to text mode at
+    9600 baud and returns False if none arrives within timeout, e.g. because
+    the board was still in its bootloader or runs an older sketch.
+    """
+    ser.write(BINARY_COMMAND.format(baudrate=baudrate).encode('ascii'))
+    ser.flush()
+    time.sleep(0.05)
+    ser.baudrate = baudrate
+    ser.reset_input_buffer()
+
+    decoder = BinaryFrameDecoder()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if decoder.read(ser):
+            return True
+
+    ser.write(TEXT_COMMAND.encode('ascii'))
+    ser.flush()
+    time.sleep(0.05)
+    ser.baudrate = TEXT_BAUDRATE
+    ser.reset_input_buffer()
+    return False
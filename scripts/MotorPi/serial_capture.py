@@ -0,0 +1,167 @@
+"""Record raw Arduino serial bytes and replay them into a pty
+
+Record the Uno on the Motor Pi:
+
+    python3 serial_capture.py record /dev/ttyACM0 uno.cap
+
+Replay the capture at 10x into a pseudo terminal and point the scripts at
+the printed device, e.g. SENSOR_SERIAL_PORTS=/dev/pts/3 python3 main_rpi1.py:
+
+    python3 serial_capture.py replay uno.cap --speed 10
+"""
+import argparse
+import os
+import struct
+import time
+import tty
+
+# File header: magic, format version, baud rate, wall clock start time.
+# Then append-only records: monotonic time in ns, length, raw bytes.
+MAGIC = b'SCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBId')
+RECORD = struct.Struct('<QI')
+
+
+def open_capture(path, baudrate):
+    """Open a capture for appending, writing the header if the file is new"""
+    capture = open(path, 'ab')
+    if capture.tell() == 0:
+        capture.write(HEADER.pack(MAGIC, VERSION, baudrate, time.time()))
+    return capture
+
+
+def write_record(capture, data, timestamp_ns=None):
+    """Append one chunk of serial bytes stamped with the monotonic clock"""
+    if timestamp_ns is None:
+        timestamp_ns = time.monotonic_ns()
+    capture.write(RECORD.pack(timestamp_ns, len(data)))
+    capture.write(data)
+
+
+def read_capture(path):
+    """Return the header and a generator of (timestamp_ns, data) records"""
+    capture = open(path, 'rb')
+    magic, version, baudrate, started = HEADER.unpack(capture.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        capture.close()
+        raise ValueError(f"{path} is not a serial capture")
+
+    def records():
+        with capture:
+            while True:
+                head = capture.read(RECORD.size)
+                if len(head) < RECORD.size:
+                    return
+                timestamp_ns, length = RECORD.unpack(head)
+                data = capture.read(length)
+                if len(data) < length:
+                    return  # recording was cut off mid-record
+                yield timestamp_ns, data
+
+    return {'baudrate': baudrate, 'started': started}, records()
+
+
+def record(port, path, baudrate=9600, duration=None):
+    """Copy everything the serial port sends into the capture file"""
+    import serial
+
+    ser = serial.Serial(port=port, baudrate=baudrate, timeout=0.5)
+    deadline = time.monotonic() + duration if duration else None
+    total = 0
+
+    print(f"Recording {port} at {baudrate} baud to {path}, Ctrl+C to stop")
+    with open_capture(path, baudrate) as capture:
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                data = ser.read(ser.in_waiting or 1)
+                if data:
+                    write_record(capture, data)
+                    total += len(data)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            ser.close()
+
+    print(f"Recorded {total} bytes")
+
+
+def replay_to_fd(path, fd, speed=1.0, max_gap=5.0, loop=False):
+    """Write a capture to fd, speed 0 means as fast as the reader takes it
+
+    Gaps between records are scaled by 1/speed and capped at max_gap
+    seconds, which also covers the jump between appended sessions.
+    Returns (bytes written, seconds taken).
+    """
+    total = 0
+    start = time.monotonic()
+
+    while True:
+        _, records = read_capture(path)
+        previous_ns = None
+        next_time = time.monotonic()
+
+        for timestamp_ns, data in records:
+            if speed and previous_ns is not None:
+                gap = (timestamp_ns - previous_ns) / 1e9
+                next_time += min(max(gap, 0.0), max_gap) / speed
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            previous_ns = timestamp_ns
+
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            total += len(data)
+
+        if not loop:
+            return total, time.monotonic() - start
+
+
+def replay(path, speed=1.0, loop=False):
+    """Replay a capture into a new pty and print the device to open"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    tty.setraw(master)
+    print(f"Replaying {path} on {os.ttyname(slave)}, "
+          f"speed {'max' if not speed else f'{speed}x'}")
+    input("Start the reader on that device, then press Enter...")
+
+    try:
+        total, elapsed = replay_to_fd(path, master, speed=speed, loop=loop)
+        print(f"Replayed {total} bytes in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.0f} B/s)")
+        # Give the reader time to drain the pty before it goes away
+        time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = commands.add_parser('record', help="record a serial port")
+    record_parser.add_argument('port')
+    record_parser.add_argument('path')
+    record_parser.add_argument('--baudrate', type=int, default=9600)
+    record_parser.add_argument('--duration', type=float, help="seconds to record")
+
+    replay_parser = commands.add_parser('replay', help="replay a capture into a pty")
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="1 is real time, 10 is 10x")
+    replay_parser.add_argument('--max', action='store_true', help="replay as fast as possible")
+    replay_parser.add_argument('--loop', action='store_true', help="start over at the end")
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.port, args.path, args.baudrate, args.duration)
+    else:
+        replay(args.path, speed=0 if args.max else args.speed, loop=args.loop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+
+from pulse_backend_rpi1 import Pulse
+import ringlog
+
+log = ringlog.get_logger('motors')
+
+# High time of a step pulse in microseconds, the DRV8825 needs at least 1.9
+step_pulse_us = 4
+
+
+def axis_ticks(ratio, start, count):
+    """0/1 per master step start .. start + count where an axis at ratio of the master rate steps
+
+    Bresenham's line drawing with the error term in closed form, so a move
+    can be cut into waveforms anywhere without losing or doubling a step.
+    """
+    k = np.arange(start, start + count, dtype=float)
+    return (np.floor((k + 1) * ratio + 0.5) - np.floor(k * ratio + 0.5)).astype(np.int64)
+
+
+class SteppingEngine:
+    """Steps N DRV8825 drivers from one timeline through a pulse backend
+
+    The axis with the highest rate is the master and steps along the
+    interval table; the others step on the master steps Bresenham picks
+    for their ratio, so the wheels stay in exact sync for any mix of
+    rates. All step pins that rise at the same time are one edge of the
+    waveform, i.e. one GPIO write.
+    """
+
+    def __init__(self, drivers, backend):
+        self.drivers = drivers
+        self.backend = backend
+        self.step_bits = np.array([1 << driver.step_pin for driver in drivers], dtype=np.int64)
+        self._directions = None
+
+    def set_directions(self, signs):
+        """Enable every driver and set its direction from the sign of its steps or rate"""
+        directions = tuple('backward' if sign < 0 else 'forward' for sign in signs)
+        if directions == self._directions:
+            return True
+        for driver, direction in zip(self.drivers, directions):
+            if not driver.SetDir(direction):
+                self.disable()
+                return False
+        self._directions = directions
+        return True
+
+    def disable(self):
+        """Disable every driver and hand the step pins back to the GPIO backend"""
+        for driver in self.drivers:
+            driver.Stop()
+            if self.backend.owns_pins:
+                # The waveforms left the pins at levels the shadow never saw
+                driver.gpio.invalidate([driver.step_pin])
+        self._directions = None
+
+    def pulses(self, ratios, intervals, start=0):
+        """Waveform of master steps start .. start + len(intervals), intervals in seconds
+
+        Every step comes at the end of its interval, so the first interval
+        is the wait after the step before and the waveform ends with its
+        last step. It starts by pulling all step pins low, in case the one
+        before was aborted during a pulse.
+        """
+        masks = np.zeros(len(intervals), dtype=np.int64)
+        for bit, ratio in zip(self.step_bits, ratios):
+            if ratio:
+                masks |= axis_ticks(ratio, start, len(intervals)) * bit
+
+        pulses = []
+        low = int(self.step_bits.sum())
+        for mask, interval in zip(masks.tolist(), (np.asarray(intervals) * 1e6).astype(np.int64).tolist()):
+            if not mask:
+                pulses.append(Pulse(0, low, max(1, interval)))
+                low = 0
+                continue
+            high = min(step_pulse_us, max(1, interval // 2))
+            pulses += (Pulse(0, low, max(1, interval - high)), Pulse(mask, 0, high))
+            low = mask
+        if low:
+            pulses.append(Pulse(0, low, 0))
+        return pulses
+
+    def move(self, steps, intervals):
+        """Step every driver its signed number of steps and wait until done
+
+        intervals holds the master axis' step intervals, at least
+        max(abs(steps)) of them.
+        """
+        master = max(abs(count) for count in steps)
+        if not master:
+            return
+        if not self.set_directions(steps):
+            return
+        ratios = [abs(count) / master for count in steps]
+        chunk = self.backend.max_pulses // 2
+
+        log.debug("move %s", steps)
+        for start in range(0, master, chunk):
+            while not self.backend.ready():
+                time.sleep(0.005)
+            self.backend.send(self.pulses(ratios, intervals[start:min(start + chunk, master)], start))
+        time.sleep(self.backend.pending())
+        self.disable()
@@ -0,0 +1,191 @@
+import fcntl
+import functools
+import mmap
+import os
+import struct
+import threading
+import time
+
+import ringlog
+
+log = ringlog.get_logger('mqtt')
+
+# File layout: a 64 byte header, then `slots` fixed size slots. head and
+# tail count records ever written and acknowledged, the slot of a record is
+# its number modulo slots, so the ring survives restarts.
+MAGIC = b'SFWD'
+VERSION = 1
+HEADER = struct.Struct('<4sBHIQQ')
+HEADER_SIZE = 64
+
+# Every slot: capture wall time, topic length, payload length, then the
+# topic and the payload
+SLOT = struct.Struct('<dBH')
+
+
+class StoreForward:
+    """Fixed size ring of timestamped messages in a memory-mapped file
+
+    Messages that cannot be published while the broker is unreachable are
+    appended here; when the ring is full the oldest ones are overwritten
+    and counted in ``dropped``. Appending is a copy into the mapping, the
+    kernel writes the pages back, so a crash or restart keeps the backlog
+    without an fsync per message.
+
+    ``forward`` hands the stored messages to a BoundedPublisher in batches
+    as QoS 1 on backlog_prefix + topic, so live subscribers of the original
+    topics do not see old values. Set it as the publisher's on_idle to
+    drain as fast as the broker acknowledges them. A message stays in the
+    ring until the broker acknowledged it and every older one; messages the
+    publisher dropped are forwarded again, and after a crash or restart
+    all unacknowledged ones are, so delivery is at least once.
+    """
+
+    def __init__(self, path, slots=4096, slot_size=256, backlog_prefix="backlog/", batch=32):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.backlog_prefix = backlog_prefix
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._forward_lock = threading.Lock()
+        self._outstanding = set()  # record numbers with the publisher
+        self._acked = set()        # acknowledged ones behind an unacknowledged one
+
+        self.stored = 0
+        self.forwarded = 0
+        self.dropped = 0
+
+        size = HEADER_SIZE + slots * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # A second process on the same file would corrupt it
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.fd)
+            raise RuntimeError(f"{path} is used by another process")
+
+        reuse = os.fstat(self.fd).st_size == size
+        if not reuse:
+            os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+
+        magic, version, slot_size, slot_count, head, tail = HEADER.unpack_from(self.mm, 0)
+        if reuse and (magic, version, slot_size, slot_count) == (MAGIC, VERSION, self.slot_size, slots):
+            self.head, self.tail = head, tail
+            if len(self):
+                log.info("%d stored messages in %s", len(self), path)
+        else:
+            self.head = self.tail = 0
+            self._write_header()
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def _write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.slot_size, self.slots, self.head, self.tail)
+
+    def append(self, topic, payload, ts=None):
+        """Store one message, overwriting the oldest if the ring is full"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        if SLOT.size + len(topic) + len(payload) > self.slot_size:
+            raise ValueError(f"message of {len(topic) + len(payload)} bytes does not fit a slot")
+
+        with self._lock:
+            offset = HEADER_SIZE + (self.head % self.slots) * self.slot_size
+            SLOT.pack_into(self.mm, offset, time.time() if ts is None else ts, len(topic), len(payload))
+            start = offset + SLOT.size
+            self.mm[start:start + len(topic)] = topic
+            self.mm[start + len(topic):start + len(topic) + len(payload)] = payload
+
+            self.head += 1
+            if self.head - self.tail > self.slots:
+                self.tail = self.head - self.slots
+                self._acked.discard(self.tail - 1)
+                self.dropped += 1
+            self._write_header()
+            self.stored += 1
+
+    def _read(self, number):
+        offset = HEADER_SIZE + (number % self.slots) * self.slot_size
+        ts, topic_length, payload_length = SLOT.unpack_from(self.mm, offset)
+        start = offset + SLOT.size
+        topic = self.mm[start:start + topic_length].decode()
+        payload = self.mm[start + topic_length:start + topic_length + payload_length]
+        return ts, topic, payload
+
+    def peek(self, count):
+        """Up to count of the oldest messages as (ts, topic, payload), not removed"""
+        with self._lock:
+            return [self._read(number) for number in range(self.tail, min(self.head, self.tail + count))]
+
+    def consume(self, count):
+        """Remove the count oldest messages"""
+        with self._lock:
+            self.tail = min(self.head, self.tail + count)
+            self._acked = {number for number in self._acked if number >= self.tail}
+            self._write_header()
+
+    def _claim(self, count):
+        """Up to count of the oldest messages not with the publisher yet, as (number, ts, topic, payload)"""
+        records = []
+        if count <= 0:
+            return records
+        with self._lock:
+            for number in range(self.tail, self.head):
+                if len(records) == count:
+                    break
+                if number not in self._outstanding and number not in self._acked:
+                    self._outstanding.add(number)
+                    records.append((number, *self._read(number)))
+        return records
+
+    def _delivered(self, number, published):
+        """on_done of a forwarded message, the ring only gives up its acknowledged oldest ones"""
+        with self._lock:
+            self._outstanding.discard(number)
+            if not published or number < self.tail:
+                # Dropped by the publisher, the next forward sends it again
+                return
+            self._acked.add(number)
+            while self.tail in self._acked:
+                self._acked.remove(self.tail)
+                self.tail += 1
+                self.forwarded += 1
+            self._write_header()
+            drained = not len(self)
+        if drained:
+            log.info("Backlog forwarded, %d messages dropped while it was full", self.dropped)
+
+    def forward(self, publisher):
+        """Hand the next batch to the publisher if it is connected and has room
+
+        At most half of the publisher's queue is used, live messages keep
+        the rest. Returns the number of messages handed over.
+        """
+        if not len(self) or not publisher.client.is_connected():
+            return 0
+        # Called from the main loop and from paho's thread, only one forwards
+        if not self._forward_lock.acquire(blocking=False):
+            return 0
+        try:
+            room = publisher.max_queued // 2 - publisher.pending
+            if room <= 0:
+                return 0
+            records = self._claim(min(self.batch, room))
+            for number, ts, topic, payload in records:
+                publisher.publish(self.backlog_prefix + topic, payload, qos=1, coalesce=False,
+                                  on_done=functools.partial(self._delivered, number))
+        finally:
+            self._forward_lock.release()
+        return len(records)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        os.close(self.fd)
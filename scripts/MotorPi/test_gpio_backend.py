@@ -0,0 +1,81 @@
+import pytest
+
+from DRV8825_rpi1 import DRV8825
+from gpio_backend_rpi1 import FakeGpioBackend, GpioBackend, MmapGpioBackend
+
+
+def counters(gpio):
+    return gpio.writes, gpio.elided, gpio.flushes
+
+
+def test_unchanged_pins_are_elided():
+    gpio = FakeGpioBackend()
+    gpio.write_masks(0b0110, 0b1001)
+    assert counters(gpio) == (4, 0, 1)
+
+    gpio.write_masks(0b0110, 0b1001)
+    assert counters(gpio) == (4, 4, 1)
+
+    # Only the changed pin reaches the hardware
+    gpio.write_masks(0b0111, 0b1000)
+    assert counters(gpio) == (5, 7, 2)
+    assert gpio.history == [(0b0110, 0b1001), (0b0001, 0)]
+    assert gpio.levels == 0b0111
+
+
+def test_setup_output_starts_low():
+    gpio = FakeGpioBackend()
+    gpio.setup_output([5, 6])
+    gpio.write([5, 6], [0, 1])
+    assert counters(gpio) == (1, 1, 1)
+    assert gpio.history == [(1 << 6, 0)]
+    assert (gpio.level(5), gpio.level(6)) == (0, 1)
+
+
+def test_invalidated_pins_are_written_again():
+    gpio = FakeGpioBackend()
+    gpio.write(7, 1)
+    gpio.write(7, 1)
+    assert counters(gpio) == (1, 1, 1)
+
+    # e.g. a pigpio wave drove the pin in the meantime
+    gpio.invalidate([7])
+    gpio.write(7, 1)
+    gpio.write(7, 0)
+    assert counters(gpio) == (3, 1, 3)
+    assert gpio.history == [(1 << 7, 0), (1 << 7, 0), (0, 1 << 7)]
+
+
+def test_driver_direction_changes_write_only_the_direction_pin():
+    gpio = FakeGpioBackend()
+    driver = DRV8825(dir_pin=13, step_pin=19, enable_pin=12, mode_pins=(16, 17, 20), gpio=gpio)
+    driver.SetDir('forward')
+    writes, elided, flushes = counters(gpio)
+
+    driver.SetDir('forward')
+    assert counters(gpio) == (writes, elided + 2, flushes)
+
+    driver.SetDir('backward')
+    assert counters(gpio) == (writes + 1, elided + 3, flushes + 1)
+    assert gpio.history[-1] == (1 << 13, 0)
+
+
+def test_incomplete_backend_fails_at_construction():
+    class NoFlush(GpioBackend):
+        def setup_output(self, pins):
+            pass
+
+    with pytest.raises(TypeError):
+        NoFlush()
+
+
+def test_mmap_backend_refuses_other_socs(tmp_path):
+    compatible = tmp_path / "compatible"
+    compatible.write_bytes(b"raspberrypi,5-model-b\0brcm,bcm2712\0")
+    with pytest.raises(OSError, match="bcm2712"):
+        MmapGpioBackend(path=str(tmp_path / "gpiomem"), compatible=str(compatible))
+
+    # A BCM2711 gets as far as opening the device
+    compatible.write_bytes(b"raspberrypi,4-model-b\0brcm,bcm2711\0")
+    with pytest.raises(FileNotFoundError):
+        MmapGpioBackend(path=str(tmp_path / "gpiomem"), compatible=str(compatible))
@@ -0,0 +1,224 @@
+import importlib
+import sys
+import time
+from concurrent.futures import CancelledError
+
+import numpy as np
+import pytest
+
+from gpio_backend_rpi1 import FakeGpioBackend
+from motion_controller_rpi1 import APPEND, MotionController
+from motion_profile_rpi1 import ramp_intervals
+import mqttJoystickReceive as Receiver
+from pulse_backend_rpi1 import SimulatedBackend
+from StepperMotors_rpi1 import Motors
+
+
+@pytest.fixture
+def motors():
+    return Motors(backend=SimulatedBackend(), gpio=FakeGpioBackend())
+
+
+@pytest.fixture
+def motion(motors):
+    controller = MotionController(motors)
+    controller.start()
+    yield controller
+    controller.close()
+
+
+def steps(motors, motor):
+    """Times in microseconds of the steps motor played"""
+    return np.array(motors.engine.backend.rising_edges(motor.step_pin))
+
+
+def test_appended_moves_blend_without_stopping(motors, motion):
+    first = motion.drive('forward', 300)
+    second = motion.drive('forward', 300, mode=APPEND)
+    assert first.result(5) and second.result(5)
+
+    left = steps(motors, motors.Motor1)
+    assert len(left) == len(steps(motors, motors.Motor2)) == 600
+    # At cruise speed across the junction, one step from rest takes 42 ms
+    assert np.diff(left)[280:320].max() < 600
+    alone = motors.profile(600).sum() * 1e6
+    assert left[-1] - left[0] < alone * 1.02
+
+
+def test_append_in_other_directions_stops_in_between(motors, motion):
+    first = motion.drive('forward', 200)
+    second = motion.drive('left', 200, mode=APPEND)
+    assert first.result(5) and second.result(5)
+    left = steps(motors, motors.Motor1)
+    assert len(left) == 400
+    assert np.diff(left)[199] > 20_000
+
+
+def test_unbounded_move_ends_with_the_next_command(motors, motion):
+    drive = motion.drive('forward')
+    time.sleep(0.4)
+    slower = motion.drive('forward', 400, rate=1000, mode=APPEND)
+    assert drive.result(5) and slower.result(5)
+    intervals = np.diff(steps(motors, motors.Motor1))
+    # Slowed down to the new rate instead of dropping to it
+    assert intervals[-460:-300].max() < 1001
+    assert intervals[-300:-250] == pytest.approx(1000)
+
+
+def test_appended_stop_completes_once_the_motors_stand(motors, motion):
+    drive = motion.drive('forward')
+    time.sleep(0.3)
+    stop = motion.set_velocity([0, 0], mode=APPEND)
+    assert stop.result(5) and drive.result(5)
+    assert motors.engine.backend.pending() == 0
+    assert np.diff(steps(motors, motors.Motor1))[-1] > 20_000
+
+
+def test_replace_cancels_running_and_queued_moves(motors, motion):
+    running = motion.drive('forward', 5000)
+    queued = motion.drive('forward', 100, mode=APPEND)
+    time.sleep(0.2)
+    replacement = motion.drive('backward', 100)
+    assert replacement.result(5)
+    for future in (running, queued):
+        with pytest.raises(CancelledError):
+            future.result(0)
+
+
+def test_cancel_stops_everything(motors, motion):
+    running = motion.drive('forward', 5000)
+    queued = motion.drive('right', 100, mode=APPEND)
+    time.sleep(0.2)
+    motion.cancel()
+    with pytest.raises(CancelledError):
+        running.result(0)
+    assert queued.cancelled()
+    deadline = time.monotonic() + 2
+    while motors.engine.backend.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not motion.moving and motors.engine.backend.pending() == 0
+
+
+def test_stop_without_motion_is_done_at_once(motion):
+    assert motion.set_velocity([0, 0]).result(0)
+    assert motion.drive('forward', 0).result(0)
+
+
+def test_rates_above_max_rate_are_rejected(motors, motion):
+    with pytest.raises(ValueError):
+        motion.set_velocity([motors.max_rate + 1, 0])
+    with pytest.raises(ValueError):
+        MotionController(motors, rate=motors.max_rate * 2)
+
+
+class DirectionWatch(FakeGpioBackend):
+    """Records how much step output was still queued whenever a direction pin flipped"""
+
+    def __init__(self):
+        super().__init__()
+        self.backend = None
+        self.direction_mask = 0
+        self.pending_at_flip = []
+
+    def _flush(self, set_mask, clear_mask):
+        super()._flush(set_mask, clear_mask)
+        if self.backend is not None and (set_mask | clear_mask) & self.direction_mask:
+            self.pending_at_flip.append(self.backend.pending())
+
+
+def wait_until(condition, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def enabled(motors):
+    return [motors.gpio.level(driver.enable_pin) for driver in motors.drivers]
+
+
+def test_stop_brakes_down_the_ramp_and_disables(motors, motion):
+    drive = motion.drive('forward')
+    time.sleep(0.5)
+    backend = motors.engine.backend
+    stopped_at = (time.monotonic() - backend._start) * 1e6
+    motion.stop()
+    with pytest.raises(CancelledError):
+        drive.result(0)
+
+    assert wait_until(lambda: enabled(motors) == [0, 0])
+    left = steps(motors, motors.Motor1)
+    braking = left[left > stopped_at]
+    ramp = ramp_intervals(motors.max_rate, motors.max_acceleration, motors.max_jerk)
+    assert abs(len(braking) - len(ramp)) <= 2
+    assert len(steps(motors, motors.Motor2)) == len(left)
+    # Slower with every step, after the first one that follows the abort
+    intervals = np.diff(braking)[1:]
+    assert (intervals[1:] >= intervals[:-1] - 1).all()
+    assert not motion.moving
+
+
+def test_reversal_drains_before_the_direction_pins_change():
+    gpio = DirectionWatch()
+    motors = Motors(backend=SimulatedBackend(), gpio=gpio)
+    gpio.backend = motors.engine.backend
+    gpio.direction_mask = sum(1 << driver.dir_pin for driver in motors.drivers)
+    motion = MotionController(motors)
+    motion.start()
+    try:
+        motion.drive('forward')
+        time.sleep(0.4)
+        forward = len(steps(motors, motors.Motor1))
+        assert motion.drive('backward', 200).result(5)
+    finally:
+        motion.close()
+
+    # Forward leaves the direction pins low, backward flips one per driver
+    assert gpio.pending_at_flip == [0, 0]
+    assert len(steps(motors, motors.Motor1)) > forward + 200
+
+
+def test_repeated_replace_does_not_restart(motors, motion):
+    drive = motion.drive('forward')
+    time.sleep(0.4)
+    for _ in range(20):
+        assert motion.drive('forward') is drive
+        time.sleep(0.01)
+    time.sleep(0.1)
+    motion.cancel()
+
+    intervals = np.diff(steps(motors, motors.Motor1))
+    cruise = intervals[len(ramp_intervals(motors.max_rate, motors.max_acceleration, motors.max_jerk)):-400]
+    assert len(cruise) > 300 and cruise.max() < 510
+
+
+@pytest.fixture
+def main_rpi1(tmp_path, monkeypatch):
+    monkeypatch.setenv('SENSOR_SOURCE', 'synthetic')
+    monkeypatch.setenv('SENSOR_BACKLOG_PATH', str(tmp_path / 'main_rpi1.backlog'))
+    module = importlib.import_module('main_rpi1')
+    yield module
+    module.fanin.close()
+    module.backlog.close()
+    del sys.modules['main_rpi1']
+
+
+def test_stale_joystick_stops_through_steer(main_rpi1, motors, motion):
+    receiver = Receiver.MqttJoystickReceive(stale_after=0.2)
+    receiver.mailbox.put((900, 504))
+    drives = set()
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        main_rpi1.steer(motion, main_rpi1.joystick_direction(*receiver.position()))
+        if motion._current is not None:
+            drives.add(motion._current.future)
+        time.sleep(0.02)
+
+    # One drive, kept while fresh, then stopped when the input went stale
+    assert len(drives) == 1
+    with pytest.raises(CancelledError):
+        drives.pop().result(0)
+    assert wait_until(lambda: enabled(motors) == [0, 0])
+    assert not motion.moving
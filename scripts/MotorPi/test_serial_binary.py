@@ -0,0 +1,159 @@
+import os
+import pty
+import random
+import select
+import threading
+import time
+
+import pytest
+import serial
+
+from sensor_schema import JOYSTICK_SCHEMA, SENSOR_SCHEMA, compile_schema
+from serial_binary import (FRAME_JOYSTICK, FRAME_SENSORS, TEXT_BAUDRATE, BinaryFrameDecoder, cobs_decode,
+                           cobs_encode, crc16, encode_frame, negotiate_binary)
+from synthetic_source import SyntheticSensors, SyntheticSerial
+
+SENSORS = {'sens_humid': 45.5, 'sens_temp': 21.25, 'sens_lux': 320.75, 'sens_range': -1, 'sens_photo': 512,
+           'led_red': True}
+JOYSTICK = {'sens_joy_x': 0, 'sens_joy_y': 1023}
+
+
+def test_crc16_is_ccitt_false():
+    assert crc16(b"123456789") == 0x29B1
+
+
+@pytest.mark.parametrize('length', [0, 1, 253, 254, 255, 256, 600])
+def test_cobs_round_trip(length):
+    rng = random.Random(length)
+    for data in (bytes(length), bytes([0xAB]) * length, bytes(rng.randrange(4) for _ in range(length))):
+        encoded = cobs_encode(data)
+        assert 0 not in encoded
+        assert cobs_decode(encoded) == data
+
+
+def test_cobs_rejects_malformed_blocks():
+    with pytest.raises(ValueError):
+        cobs_decode(b"\x05ab")
+    with pytest.raises(ValueError):
+        cobs_decode(b"\x02a\x00")
+
+
+def test_frames_round_trip_in_pieces():
+    wire = encode_frame(FRAME_SENSORS, 7, SENSORS) + encode_frame(FRAME_JOYSTICK, 3, JOYSTICK)
+    decoder = BinaryFrameDecoder()
+    frames = []
+    for index in range(len(wire)):
+        frames += decoder.feed(wire[index:index + 1])
+    assert frames == [SENSORS, JOYSTICK]
+    assert (decoder.frames, decoder.crc_errors, decoder.framing_errors) == (2, 0, 0)
+
+
+def test_corrupted_frames_are_counted_not_decoded():
+    decoder = BinaryFrameDecoder()
+    raw = bytearray(cobs_decode(encode_frame(FRAME_SENSORS, 1, SENSORS)[:-1]))
+    raw[5] ^= 0x01
+    assert decoder.feed(cobs_encode(bytes(raw)) + b"\x00") == []
+    assert decoder.crc_errors == 1
+
+    assert decoder.feed(cobs_encode(bytes(raw[:-3])) + b"\x00") == []
+    assert decoder.feed(b"\x01" * 100) == []
+    assert decoder.framing_errors == 2
+
+    # Resynchronises on the next delimiter
+    assert decoder.feed(b"\x00" + encode_frame(FRAME_SENSORS, 2, SENSORS)) == [SENSORS]
+
+
+def test_sequence_gaps_per_frame_type():
+    decoder = BinaryFrameDecoder()
+    for frame_type, seq, values in ((FRAME_SENSORS, 0xFFFF, SENSORS), (FRAME_JOYSTICK, 5, JOYSTICK),
+                                    (FRAME_SENSORS, 0, SENSORS), (FRAME_SENSORS, 2, SENSORS)):
+        decoder.feed(encode_frame(frame_type, seq, values))
+    assert decoder.seq_gaps == 1
+
+
+def test_decoded_frames_get_the_schema_checks():
+    sensors, joystick = compile_schema(SENSOR_SCHEMA), compile_schema(JOYSTICK_SCHEMA)
+    decoder = BinaryFrameDecoder()
+    wire = (encode_frame(FRAME_SENSORS, 1, dict(SENSORS, sens_humid=float('nan'), sens_range=300))
+            + encode_frame(FRAME_JOYSTICK, 1, dict(JOYSTICK, sens_joy_x=60000)))
+    frame, stick = decoder.feed(wire)
+
+    assert sensors.validate(frame) == {key: value for key, value in SENSORS.items()
+                                       if key not in ('sens_humid', 'sens_range')}
+    assert joystick.validate(stick) == {'sens_joy_y': 1023}
+    assert sensors.errors == {('sens_humid', 'malformed'): 1, ('sens_range', 'out_of_range'): 1}
+    assert joystick.errors == {('sens_joy_x', 'out_of_range'): 1}
+    assert sensors.validate(SENSORS) == SENSORS
+
+
+class FakeBoard:
+    """The far end of a pty that answers like a sketch, or stays silent like an old one"""
+
+    def __init__(self, speaks_binary):
+        self.speaks_binary = speaks_binary
+        self.master, slave = pty.openpty()
+        self.port = serial.Serial(os.ttyname(slave), 9600, timeout=0.05)
+        os.close(slave)
+        self.commands = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        received, binary, seq = b"", False, 0
+        while not self.stopped.is_set():
+            if select.select([self.master], [], [], 0.01)[0]:
+                received += os.read(self.master, 256)
+                *lines, received = received.split(b"\n")
+                for line in lines:
+                    self.commands.append(line.decode())
+                    binary = self.speaks_binary and line.startswith(b"proto=bin")
+            if binary:
+                os.write(self.master, encode_frame(FRAME_SENSORS, seq, SENSORS))
+                seq += 1
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.port.close()
+        os.close(self.master)
+
+
+def test_negotiate_binary_over_pty():
+    board = FakeBoard(speaks_binary=True)
+    try:
+        assert negotiate_binary(board.port, baudrate=115200, timeout=2.0)
+        assert board.port.baudrate == 115200
+        assert board.commands == ["proto=bin,115200"]
+    finally:
+        board.close()
+
+
+def test_negotiate_falls_back_to_text_over_pty():
+    board = FakeBoard(speaks_binary=False)
+    try:
+        assert not negotiate_binary(board.port, baudrate=115200, timeout=0.3)
+        assert board.port.baudrate == TEXT_BAUDRATE
+        time.sleep(0.1)  # the text command reaches the board
+        assert board.commands == ["proto=bin,115200", "proto=text"]
+    finally:
+        board.close()
+
+
+def test_stalled_reader_skips_the_oldest_frames():
+    port = SyntheticSerial(SyntheticSensors(), rate_hz=20000, protocol='binary', timeout=0.1)
+    try:
+        # The writer blocks on the full pipe while nobody reads
+        time.sleep(0.5)
+        decoder = BinaryFrameDecoder()
+        frames = []
+        deadline = time.monotonic() + 0.3
+        while time.monotonic() < deadline:
+            frames += decoder.read(port)
+    finally:
+        port.close()
+
+    assert port.frames_skipped > 0
+    assert decoder.seq_gaps >= 1 and not decoder.crc_errors and not decoder.framing_errors
+    # Each batch fits one pipe buffer, the catch-up does not replay the stall
+    assert 0 < len(frames) <= port.frames_written
@@ -0,0 +1,144 @@
+import time
+
+import numpy as np
+import pytest
+
+from gpio_backend_rpi1 import FakeGpioBackend
+from pulse_backend_rpi1 import Pulse, PulseBackend, SimulatedBackend, duration
+from stepping_engine_rpi1 import axis_ticks, step_pulse_us
+from StepperMotors_rpi1 import MOTOR_PINS, Motors
+
+
+def rising_edges(pulses, pin):
+    """Times in microseconds, from the waveform's start, at which pin goes high"""
+    times, at = [], 0
+    for on_mask, off_mask, delay_us in pulses:
+        if on_mask >> pin & 1:
+            times.append(at)
+        at += delay_us
+    return times
+
+
+def test_simulated_edges_follow_the_delays():
+    backend = SimulatedBackend()
+    backend.send([Pulse(1 << 5, 0, 100_000), Pulse(0, 1 << 5, 250_000), Pulse(1 << 6, 0, 50_000)])
+    backend.send([Pulse(1 << 5, 0, 10_000)])
+    start = backend.edges[0][0]
+    # The second waveform is chained at the end of the first
+    assert [(round(at - start, 3), pin, level) for at, pin, level in backend.edges] == [
+        (0, 5, 1), (100_000, 5, 0), (350_000, 6, 1), (400_000, 5, 1)]
+    assert not backend.ready()
+    assert 0.3 < backend.pending() <= 0.41
+
+
+def test_simulated_stop_removes_future_edges():
+    backend = SimulatedBackend()
+    backend.send([Pulse(1 << 5, 1 << 5, 1000)] * 1000)
+    time.sleep(0.05)
+    backend.stop()
+    played = backend.rising_edges(5)
+    assert 20 <= len(played) < 1000
+    assert played[-1] <= (time.monotonic() - backend._start) * 1e6
+    assert backend.ready() and backend.pending() == 0
+
+    # The next waveform starts now, not where the aborted one would have ended
+    backend.send([Pulse(1 << 6, 0, 10)])
+    assert backend.rising_edges(6)[0] - played[-1] < 50_000
+
+
+def test_incomplete_backend_fails_at_construction():
+    class NoStop(PulseBackend):
+        def send(self, pulses):
+            pass
+
+        def ready(self):
+            return True
+
+        def pending(self):
+            return 0.0
+
+    with pytest.raises(TypeError):
+        NoStop()
+
+
+@pytest.mark.parametrize('ratio', [1.0, 0.5, 0.377, 1 / 3, 0.999, 0.001])
+def test_axis_ticks_do_not_depend_on_the_cuts(ratio):
+    whole = axis_ticks(ratio, 0, 3000)
+    assert whole.sum() == round(3000 * ratio)
+    assert set(whole.tolist()) <= {0, 1}
+    cuts = [0, 1, 17, 999, 1000, 2500, 3000]
+    pieces = np.concatenate([axis_ticks(ratio, a, b - a) for a, b in zip(cuts, cuts[1:])])
+    assert (pieces == whole).all()
+
+
+@pytest.fixture
+def motors():
+    return Motors(backend=SimulatedBackend(), gpio=FakeGpioBackend())
+
+
+def test_pulses_step_at_the_end_of_each_interval(motors):
+    engine = motors.engine
+    intervals = [0.002, 0.001, 0.0005]
+    pulses = engine.pulses([1.0, 0.0], intervals)
+    pin = motors.Motor1.step_pin
+    assert rising_edges(pulses, pin) == [2000 - step_pulse_us, 3000 - step_pulse_us, 3500 - step_pulse_us]
+    assert duration(pulses) == pytest.approx(sum(intervals))
+    assert pulses[-1] == Pulse(0, 1 << pin, 0)
+    assert rising_edges(pulses, motors.Motor2.step_pin) == []
+
+
+@pytest.mark.parametrize('steps', [(600, 600), (600, -227), (-1, 599), (0, 400)])
+def test_bresenham_step_counts_over_chunks(motors, steps):
+    engine = motors.engine
+    master = max(abs(count) for count in steps)
+    ratios = [abs(count) / master for count in steps]
+    intervals = [0.0005] * master
+    counts = [0, 0]
+    for start in range(0, master, 128):
+        pulses = engine.pulses(ratios, intervals[start:start + 128], start)
+        for axis, driver in enumerate(motors.drivers):
+            counts[axis] += len(rising_edges(pulses, driver.step_pin))
+    assert counts == [abs(count) for count in steps]
+
+
+def test_run_plays_every_step_in_sync(motors):
+    motors.run((300, -100))
+    backend = motors.engine.backend
+    left = backend.rising_edges(motors.Motor1.step_pin)
+    right = backend.rising_edges(motors.Motor2.step_pin)
+    assert (len(left), len(right)) == (300, 100)
+    # Every third master step, at the same edge
+    assert set(right) <= set(left)
+    profile = motors.profile(300)
+    assert np.diff(left) == pytest.approx(profile[1:] * 1e6, abs=2)
+
+
+def test_step_pins_are_handed_back_after_external_output():
+    class External(SimulatedBackend):
+        owns_pins = True
+
+    gpio = FakeGpioBackend()
+    motors = Motors(backend=External(), gpio=gpio)
+    pin = motors.Motor1.step_pin
+    flushes = gpio.flushes
+    gpio.write(pin, 0)
+    assert gpio.flushes == flushes
+
+    # The waveforms drove the pin, the next write reaches it again
+    motors.run((20, 20))
+    flushes = gpio.flushes
+    gpio.write(pin, 0)
+    assert gpio.flushes == flushes + 1
+
+
+@pytest.mark.parametrize('table, signs', [
+    (MOTOR_PINS[:1], [-1]),
+    (MOTOR_PINS, [-1, 1]),
+    (MOTOR_PINS + [{'dir_pin': 5, 'step_pin': 6, 'enable_pin': 26, 'mode_pins': (7, 8, 25)}], [-1, -1, 1]),
+])
+def test_any_number_of_drivers(table, signs):
+    motors = Motors(backend=SimulatedBackend(), gpio=FakeGpioBackend(), pin_table=table)
+    assert motors.signs('left') == signs
+    assert motors.signs('forward') == [1] * len(table)
+    motors.turn_left(10)
+    assert [len(motors.engine.backend.rising_edges(driver.step_pin)) for driver in motors.drivers] == [10] * len(table)
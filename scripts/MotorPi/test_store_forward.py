@@ -0,0 +1,213 @@
+import shutil
+import socket
+import subprocess
+import time
+
+import paho.mqtt.client as mqtt
+import pytest
+
+from mqtt_connection import MqttConnection
+from publish_benchmark import MiniBroker
+from publish_queue import BoundedPublisher
+from store_forward import StoreForward
+
+
+class FakeClient:
+    """paho stand-in that keeps published messages until ack() is called"""
+
+    def __init__(self):
+        self.connected = True
+        self.mid = 0
+        self.unacked = {}
+        self.delivered = []
+
+    def is_connected(self):
+        return self.connected
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if not self.connected:
+            return _Info(mqtt.MQTT_ERR_NO_CONN, 0)
+        self.mid += 1
+        self.unacked[self.mid] = (topic, bytes(payload))
+        return _Info(mqtt.MQTT_ERR_SUCCESS, self.mid)
+
+    def ack(self, publisher, count=None):
+        for mid in sorted(self.unacked)[:count]:
+            self.delivered.append(self.unacked.pop(mid))
+            publisher.on_publish(self, None, mid)
+
+
+class _Info:
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+
+@pytest.fixture
+def backlog_path(tmp_path):
+    return str(tmp_path / "test.backlog")
+
+
+def fill(backlog, count):
+    for n in range(count):
+        backlog.append("sensors/all", f"{n}".encode(), ts=n)
+
+
+def test_records_stay_until_acknowledged(backlog_path):
+    client = FakeClient()
+    publisher = BoundedPublisher(client, max_queued=64, max_inflight=8)
+    backlog = StoreForward(backlog_path, slots=16, batch=4)
+    fill(backlog, 10)
+
+    assert backlog.forward(publisher) == 4
+    assert len(backlog) == 10
+    client.ack(publisher, 2)
+    assert len(backlog) == 8
+    assert backlog.forwarded == 2
+    backlog.close()
+
+    # Crash before the rest was acknowledged: all of it is still there
+    backlog = StoreForward(backlog_path, slots=16, batch=4)
+    assert len(backlog) == 8
+    assert [payload for _, _, payload in backlog.peek(2)] == [b"2", b"3"]
+    backlog.close()
+
+
+def test_tail_only_advances_over_acknowledged_prefix(backlog_path):
+    client = FakeClient()
+    publisher = BoundedPublisher(client, max_queued=64, max_inflight=8)
+    backlog = StoreForward(backlog_path, slots=16, batch=4)
+    fill(backlog, 4)
+    backlog.forward(publisher)
+
+    first, *rest = sorted(client.unacked)
+    for mid in rest:
+        del client.unacked[mid]
+        publisher.on_publish(client, None, mid)
+    assert len(backlog) == 4
+    client.ack(publisher)
+    assert len(backlog) == 0
+    backlog.close()
+
+
+def test_dropped_messages_are_forwarded_again(backlog_path):
+    client = FakeClient()
+    publisher = BoundedPublisher(client, max_queued=64, max_inflight=2)
+    backlog = StoreForward(backlog_path, slots=16, batch=4)
+    fill(backlog, 4)
+
+    # Two go to paho, two wait in the queue and are evicted by live data
+    backlog.forward(publisher)
+    client.connected = False
+    publisher.max_queued = 2
+    publisher.publish("sensors/all", b"live1")
+    publisher.publish("sensors/all2", b"live2")
+    assert publisher.dropped == 2
+
+    client.connected = True
+    publisher.max_queued = 64
+    publisher.flush()
+    while client.unacked or len(backlog):
+        client.ack(publisher)
+        backlog.forward(publisher)
+    forwarded = sorted(payload for topic, payload in client.delivered if topic.startswith("backlog/"))
+    assert forwarded == [b"0", b"1", b"2", b"3"]
+    assert backlog.forwarded == 4
+    backlog.close()
+
+
+def test_nearly_full_publisher_gets_nothing(backlog_path):
+    client = FakeClient()
+    publisher = BoundedPublisher(client, max_queued=64, max_inflight=8)
+    backlog = StoreForward(backlog_path, slots=256, batch=32)
+    fill(backlog, 100)
+
+    # Live messages queued while paho was busy, more than half the queue
+    client.connected = False
+    for n in range(40):
+        publisher.publish(f"sensors/{n}", b"live")
+    client.connected = True
+    assert publisher.pending == 40
+    assert backlog.forward(publisher) == 0
+    assert backlog._claim(-8) == []
+
+    # Once paho took them the backlog gets its batch again
+    publisher.flush()
+    room = publisher.max_queued // 2 - publisher.pending
+    assert 0 < room
+    assert backlog.forward(publisher) == min(backlog.batch, room)
+    assert len(backlog) == 100
+    backlog.close()
+
+
+def _start_broker(port):
+    """mosquitto on port, or the benchmark's MiniBroker where it is not installed; returns stop()"""
+    if shutil.which("mosquitto") is None:
+        return MiniBroker(port).stop
+
+    process = subprocess.Popen(["mosquitto", "-p", str(port)], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+
+    def stop():
+        process.terminate()
+        process.wait()
+
+    assert _wait(lambda: _listening(port)), "mosquitto did not start"
+    return stop
+
+
+def _listening(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+        return True
+    except OSError:
+        return False
+
+
+def _wait(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_backlog_survives_broker_restart(backlog_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    stop_broker = _start_broker(port)
+
+    received = []
+    subscriber = MqttConnection("backlog_test_sub", min_delay=0.1, max_delay=0.5)
+    subscriber.subscribe("backlog/#", 1, lambda client, userdata, msg: received.append(msg.payload))
+    subscriber.connect("127.0.0.1", port)
+
+    connection = MqttConnection("backlog_test_pub", min_delay=0.1, max_delay=0.5)
+    backlog = StoreForward(backlog_path, slots=256)
+    connection.publisher.on_idle = lambda: backlog.forward(connection.publisher)
+    try:
+        connection.connect("127.0.0.1", port)
+        assert _wait(connection.is_connected)
+
+        # Broker down: everything goes to the ring
+        stop_broker()
+        assert _wait(lambda: not connection.is_connected())
+        fill(backlog, 100)
+
+        stop_broker = _start_broker(port)
+        assert _wait(lambda: connection.is_connected() and subscriber.is_connected())
+        time.sleep(0.2)  # the subscriber's subscription
+        backlog.forward(connection.publisher)
+        assert _wait(lambda: not len(backlog))
+        assert _wait(lambda: len(set(received)) == 100)
+        assert set(received) == {f"{n}".encode() for n in range(100)}
+    finally:
+        subscriber.close()
+        connection.close()
+        backlog.close()
+        stop_broker()
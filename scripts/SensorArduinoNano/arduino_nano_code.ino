@@ -1,19 +1,140 @@
 #define VRX_PIN  A1 
 #define VRY_PIN  A0
 
+// Serial protocol, the host switches to binary with "proto=bin,<baud>\n"
+// and back with "proto=text\n" (see serial_binary.py on the Pi)
+#define FRAME_JOYSTICK 0x02
+#define TEXT_BAUDRATE 9600
+
+// Streaming: the stick is sampled every SAMPLE_PERIOD_MS and a frame is only
+// sent when an axis moved by DEADBAND or after KEEPALIVE_MS without one.
+// A text frame takes about 35 ms at 9600 baud, so text frames are spaced
+// at least TEXT_MIN_PERIOD_MS apart.
+#define SAMPLE_PERIOD_MS 2
+#define DEADBAND 4
+#define KEEPALIVE_MS 100
+#define TEXT_MIN_PERIOD_MS 40
+
+struct __attribute__((packed)) JoystickFrame {
+  uint8_t type;
+  uint16_t seq;
+  uint16_t x;
+  uint16_t y;
+  uint16_t crc;
+};
+
 int xValue = 0;
 int yValue = 0;
+int sentX = -1;
+int sentY = -1;
+unsigned long lastSent = 0;
+
+bool binaryMode = false;
+uint16_t frameSeq = 0;
+char command[24];
+uint8_t commandLen = 0;
+
+// CRC-16/CCITT-FALSE, same as binascii.crc_hqx(data, 0xFFFF)
+uint16_t crc16(const uint8_t *data, size_t len) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// COBS-encode a frame and write it followed by the 0x00 delimiter
+void writeCobsFrame(const uint8_t *data, size_t len) {
+  uint8_t out[32];
+  size_t codeIndex = 0;
+  size_t outIndex = 1;
+  uint8_t code = 1;
+
+  for (size_t i = 0; i < len; i++) {
+    if (data[i] != 0) {
+      out[outIndex++] = data[i];
+      code++;
+    }
+    if (data[i] == 0 || code == 0xFF) {
+      out[codeIndex] = code;
+      codeIndex = outIndex++;
+      code = 1;
+    }
+  }
+  out[codeIndex] = code;
+  out[outIndex++] = 0;
+  Serial.write(out, outIndex);
+}
+
+void handleCommand(const char *cmd) {
+  if (strncmp(cmd, "proto=bin,", 10) == 0) {
+    long baudrate = atol(cmd + 10);
+    if (baudrate > 0) {
+      Serial.flush();
+      Serial.begin(baudrate);
+      binaryMode = true;
+    }
+  } else if (strcmp(cmd, "proto=text") == 0) {
+    Serial.flush();
+    Serial.begin(TEXT_BAUDRATE);
+    binaryMode = false;
+  }
+}
+
+void checkHostCommand() {
+  while (Serial.available()) {
+    char c = Serial.read();
+    if (c == '\n') {
+      command[commandLen] = '\0';
+      handleCommand(command);
+      commandLen = 0;
+    } else if (commandLen < sizeof(command) - 1) {
+      command[commandLen++] = c;
+    }
+  }
+}
 
 void setup() {
-  Serial.begin(9600) ;
+  Serial.begin(TEXT_BAUDRATE) ;
 }
 
-void loop() {
-  xValue = analogRead(VRX_PIN);
-  yValue = analogRead(VRY_PIN);
+void sendFrame() {
+  if (binaryMode) {
+    JoystickFrame frame;
+    frame.type = FRAME_JOYSTICK;
+    frame.seq = frameSeq++;
+    frame.x = xValue;
+    frame.y = yValue;
+    frame.crc = crc16((const uint8_t *)&frame, sizeof(frame) - sizeof(frame.crc));
+    writeCobsFrame((const uint8_t *)&frame, sizeof(frame));
+    return;
+  }
+
   Serial.print("sens_joy_x=");
   Serial.println(xValue);
   Serial.print("sens_joy_y=");
   Serial.println(yValue);
-  delay(200);
+}
+
+void loop() {
+  checkHostCommand();
+
+  xValue = analogRead(VRX_PIN);
+  yValue = analogRead(VRY_PIN);
+
+  unsigned long now = millis();
+  unsigned long sinceSent = now - lastSent;
+  bool moved = abs(xValue - sentX) >= DEADBAND || abs(yValue - sentY) >= DEADBAND;
+  unsigned long minPeriod = binaryMode ? 0 : TEXT_MIN_PERIOD_MS;
+
+  if ((moved && sinceSent >= minPeriod) || sinceSent >= KEEPALIVE_MS) {
+    sendFrame();
+    sentX = xValue;
+    sentY = yValue;
+    lastSent = now;
+  }
+  delay(SAMPLE_PERIOD_MS);
 }
@@ -23,9 +23,96 @@ const int redLED = 9;
 int photoIn = 0;
 int tempIn = 0;
 
+// Serial protocol, the host switches to binary with "proto=bin,<baud>\n"
+// and back with "proto=text\n" (see serial_binary.py on the Pi)
+#define FRAME_SENSORS 0x01
+#define TEXT_BAUDRATE 9600
+#define TEXT_PERIOD_MS 1000
+#define BINARY_PERIOD_MS 20
+
+struct __attribute__((packed)) SensorFrame {
+  uint8_t type;
+  uint16_t seq;
+  float humid;
+  float temp;
+  float lux;
+  int16_t range;
+  uint16_t photo;
+  uint8_t ledRed;
+  uint16_t crc;
+};
+
+bool binaryMode = false;
+uint16_t frameSeq = 0;
+char command[24];
+uint8_t commandLen = 0;
+
+// CRC-16/CCITT-FALSE, same as binascii.crc_hqx(data, 0xFFFF)
+uint16_t crc16(const uint8_t *data, size_t len) {
+  uint16_t crc = 0xFFFF;
+  for (size_t i = 0; i < len; i++) {
+    crc ^= (uint16_t)data[i] << 8;
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+// COBS-encode a frame and write it followed by the 0x00 delimiter
+void writeCobsFrame(const uint8_t *data, size_t len) {
+  uint8_t out[64];
+  size_t codeIndex = 0;
+  size_t outIndex = 1;
+  uint8_t code = 1;
+
+  for (size_t i = 0; i < len; i++) {
+    if (data[i] != 0) {
+      out[outIndex++] = data[i];
+      code++;
+    }
+    if (data[i] == 0 || code == 0xFF) {
+      out[codeIndex] = code;
+      codeIndex = outIndex++;
+      code = 1;
+    }
+  }
+  out[codeIndex] = code;
+  out[outIndex++] = 0;
+  Serial.write(out, outIndex);
+}
+
+void handleCommand(const char *cmd) {
+  if (strncmp(cmd, "proto=bin,", 10) == 0) {
+    long baudrate = atol(cmd + 10);
+    if (baudrate > 0) {
+      Serial.flush();
+      Serial.begin(baudrate);
+      binaryMode = true;
+    }
+  } else if (strcmp(cmd, "proto=text") == 0) {
+    Serial.flush();
+    Serial.begin(TEXT_BAUDRATE);
+    binaryMode = false;
+  }
+}
+
+void checkHostCommand() {
+  while (Serial.available()) {
+    char c = Serial.read();
+    if (c == '\n') {
+      command[commandLen] = '\0';
+      handleCommand(command);
+      commandLen = 0;
+    } else if (commandLen < sizeof(command) - 1) {
+      command[commandLen++] = c;
+    }
+  }
+}
+
 void setup() {
 
-  Serial.begin(9600);
+  Serial.begin(TEXT_BAUDRATE);
   dht.begin();
   
   // wait for serial port to open on native usb devices
@@ -42,7 +129,9 @@ void setup() {
 }
 
 void loop() {
-  // Temp & Humid
+  checkHostCommand();
+
+  // Temp & Humid (the DHT library caches readings for 2 seconds)
   float humidity = dht.readHumidity();
   float temperature = dht.readTemperature();
 
@@ -52,6 +141,12 @@ void loop() {
     return;
   }
 
+  if (binaryMode) {
+    sendBinaryFrame(humidity, temperature);
+    delay(BINARY_PERIOD_MS);
+    return;
+  }
+
   Serial.print("sens_humid=");
   Serial.println(humidity);
   //Serial.print(" %\t"); // not included for communication
@@ -91,5 +186,25 @@ void loop() {
   Serial.println(photoIn);
 
   //delay
-  delay(1000);
+  delay(TEXT_PERIOD_MS);
+}
+
+void sendBinaryFrame(float humidity, float temperature) {
+  SensorFrame frame;
+  frame.type = FRAME_SENSORS;
+  frame.seq = frameSeq++;
+  frame.humid = humidity;
+  frame.temp = temperature;
+  frame.lux = vl.readLux(VL6180X_ALS_GAIN_5);
+
+  uint8_t range = vl.readRange();
+  frame.range = (vl.readRangeStatus() == VL6180X_ERROR_NONE) ? range : -1;
+
+  photoIn = analogRead(AnalogPhoto);
+  frame.photo = photoIn;
+  frame.ledRed = photoIn < 320;
+  analogWrite(redLED, frame.ledRed ? 255 : 0);
+
+  frame.crc = crc16((const uint8_t *)&frame, sizeof(frame) - sizeof(frame.crc));
+  writeCobsFrame((const uint8_t *)&frame, sizeof(frame));
 }